@@ -0,0 +1,491 @@
+"""
+效能量測（用合成資料，不連 BigQuery / Google Sheet）
+
+    python benchmarks.py suite [--repeat 5] [--output bench.json] [--compare old.json]
+    python benchmarks.py daily-fetch --residents 200 --days 183 --repeat 5
+    python benchmarks.py startup [--repeat 5] [--target-ms 500]
+
+suite：量報表計算的熱點，資料來自 fake_data.SyntheticDataset（固定到 2025-12-31，每次都一樣）
+  - 輔助函式：DailyColumns、翻身間隔、30 分鐘作息格、半年 Python 彙總，各跑 31 / 180 / 365 天
+  - 評分：report_scoring.score_month（31 天）
+  - 頁面：/report、/half_report、/report_30days（Flask test client，快照停用）
+  每個項目記錄：
+    wall_ms      ：repeat 次中的最小 / 中位數
+    backend_calls：資料來源呼叫次數（正式環境每次就是一個 BigQuery job / Sheets 讀取）
+    backend_ms   ：花在資料來源裡的時間（正式環境是網路等待），compute_ms = wall - backend
+    alloc_peak_kib / alloc_blocks：tracemalloc 量到的記憶體高峰與新配置的 block 數（另外跑一次）
+  結果可以存成 JSON（--output），再用 --compare 跟舊版本比較，變慢超過 --threshold 會回傳 1
+
+daily-fetch：比較 DAILY_TABLE 資料轉成 DailyColumns 的兩條路徑
+  - rows ：逐列讀 BigQuery Row（目前 REST 分頁的做法）→ DailyColumns.from_rows
+  - arrow：整批 Arrow Table → DailyColumns.split_arrow_by_resident
+只量「查詢結果 → 報表欄位」這一段，不含網路傳輸時間
+（Storage Read API 省下的分頁往返時間要在正式環境看）
+
+startup：在新的 process 裡 import daily_report（DATA_SOURCE=bigquery、不給任何 Google 憑證），
+  量 import 時間的中位數，並檢查 Google 套件沒有在 import 時載入；
+  超過 --target-ms 或載入了 Google 套件就回傳 1（可以放進 CI）
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import date, datetime, time as dt_time, timedelta
+
+# 量測一律用假資料、不讀寫報表快照與共用快取
+os.environ.setdefault("DATA_SOURCE", "fake")
+os.environ.setdefault("REPORT_SNAPSHOT_DB", "")
+# 共用快取也關掉，每次都量到查詢 + 計算（評語表每次重讀，見 view 的 setup）
+os.environ.setdefault("SHARED_CACHE_URL", "none://")
+# 頁面的 DEBUG / 未命中評語等訊息不輸出，免得干擾量測與結果表
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+
+import daily_report as dr  # noqa: E402
+import fake_data  # noqa: E402
+import report_scoring  # noqa: E402
+
+SUITE_END_DATE = date(2025, 12, 31)
+SUITE_DAY_SIZES = (31, 180, 365)
+
+
+# ================== 資料來源計數 ==================
+
+class CountingBackend(dr.DataBackend):
+    """包住另一個 DataBackend，記錄呼叫次數與花費時間"""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.name = inner.name
+        self.supports_monthly_aggregates = inner.supports_monthly_aggregates
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+            self.seconds = 0.0
+
+    def _call(self, method, *args):
+        t0 = time.perf_counter()
+        try:
+            return getattr(self.inner, method)(*args)
+        finally:
+            elapsed = time.perf_counter() - t0
+            with self._lock:
+                self.calls += 1
+                self.seconds += elapsed
+
+    def get_resident_by_login(self, *args):
+        return self._call("get_resident_by_login", *args)
+
+    def list_active_residents(self, *args):
+        return self._call("list_active_residents", *args)
+
+    def latest_created_dates(self, *args):
+        return self._call("latest_created_dates", *args)
+
+    def daily_rows(self, *args, **kwargs):
+        return self._call("daily_rows", *args)
+
+    def daily_columns(self, *args):
+        return self._call("daily_columns", *args)
+
+    def bed_turn_rows(self, *args):
+        return self._call("bed_turn_rows", *args)
+
+    def toc_slot_priorities(self, *args):
+        return self._call("toc_slot_priorities", *args)
+
+    def monthly_daily_aggregates(self, *args):
+        return self._call("monthly_daily_aggregates", *args)
+
+    def sheet_values(self, *args):
+        return self._call("sheet_values", *args)
+
+
+# ================== 量測工具 ==================
+
+def _best_of(fn, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def measure(name: str, fn, repeat: int, backend: CountingBackend, setup=None):
+    """
+    跑 fn repeat 次量時間，再另外跑一次量記憶體；
+    setup（每次執行前呼叫，不計時）用來清掉 request 內的快取等狀態
+    """
+    walls, backend_secs, calls = [], [], []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        backend.reset()
+        t0 = time.perf_counter()
+        fn()
+        walls.append(time.perf_counter() - t0)
+        backend_secs.append(backend.seconds)
+        calls.append(backend.calls)
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    new_blocks = sum(s.count_diff for s in after.compare_to(before, "filename") if s.count_diff > 0)
+
+    i = walls.index(min(walls))
+    return {
+        "name": name,
+        "wall_ms_min": round(walls[i] * 1000, 3),
+        "wall_ms_median": round(statistics.median(walls) * 1000, 3),
+        "backend_calls": calls[i],
+        "backend_ms": round(backend_secs[i] * 1000, 3),
+        "compute_ms": round(max(walls[i] - backend_secs[i], 0.0) * 1000, 3),
+        "alloc_peak_kib": round(peak / 1024, 1),
+        "alloc_blocks": new_blocks,
+    }
+
+
+def _git_revision():
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, timeout=5,
+        )
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+# ================== suite ==================
+
+def make_suite_dataset():
+    """1 個機構、4 位住民；臥床住民每天 40~80 次翻身，作息點每小時 12 筆"""
+    return fake_data.SyntheticDataset(
+        n_agencies=1, residents_per_agency=4, n_days=400,
+        end_date=SUITE_END_DATE, seed=0, flips_per_day=(40, 80), toc_points_per_hour=12,
+    )
+
+
+def run_suite(repeat: int = 5):
+    dataset = make_suite_dataset()
+    backend = CountingBackend(dr.RowSourceBackend("fake", dataset))
+    dr.set_data_backend(backend)
+
+    # 臥床型住民（翻身資料最多）
+    resident = next(r for r in dataset.residents if r["resident_id"] % 2 == 0)
+    rid = resident["resident_id"]
+    results = []
+
+    for n_days in SUITE_DAY_SIZES:
+        start = SUITE_END_DATE - timedelta(days=n_days - 1)
+        rows = dataset.daily_rows([rid], start, SUITE_END_DATE)
+        turn_rows = dataset.bed_turn_rows([rid], start, SUITE_END_DATE + timedelta(days=1))
+        daily = dr.DailyColumns.from_rows(rows)
+
+        results.append(measure(
+            f"daily_columns.from_rows[{n_days}d]",
+            lambda: dr.DailyColumns.from_rows(rows), repeat, backend,
+        ))
+
+        if dr.pa is not None:
+            table = dr.pa.Table.from_pylist(rows)
+            results.append(measure(
+                f"daily_columns.from_arrow[{n_days}d]",
+                lambda: dr.DailyColumns.from_arrow(table), repeat, backend,
+            ))
+
+        def flip_intervals():
+            index = dr.FlipIndex(dr.build_flip_datetimes(turn_rows))
+            for pos in daily.iter_positions():
+                d = daily.date_at(pos)
+                ns, ne = dr.build_night_interval_for_day(
+                    d, daily.asleep_start[pos], daily.value("night_sleep", pos)
+                )
+                index.day_night_avg_intervals(d, ns, ne, max_minutes=dr.TURN_INTERVAL_MAX_MIN)
+
+        results.append(measure(
+            f"flip_intervals[{n_days}d,{len(turn_rows)}flips]", flip_intervals, repeat, backend,
+        ))
+
+        # 翻身時間是字串（本機副本 / BigQuery 回傳 STRING）；每次清掉解析快取，量第一次解析的成本
+        text_turn_rows = [dict(r, time_start=r["time_start"].strftime("%H:%M:%S")) for r in turn_rows]
+        results.append(measure(
+            f"flip_datetimes.text[{n_days}d,{len(turn_rows)}flips]",
+            lambda: dr.build_flip_datetimes(text_turn_rows), repeat, backend,
+            setup=dr._parse_time_text.cache_clear,
+        ))
+
+        results.append(measure(
+            f"slots_30min[{n_days}windows]",
+            lambda: dr.get_30min_slots_for_range(rid, start, SUITE_END_DATE), repeat, backend,
+        ))
+
+        # 逐日結果（day records）→ 每月彙總（半年報的 Python 版）
+        range_data = dr.ResidentRangeData(rid, start, SUITE_END_DATE, daily=daily, turn_rows=turn_rows)
+        records = dr.derive_day_records(range_data, start, SUITE_END_DATE)
+        results.append(measure(
+            f"day_records[{n_days}d]",
+            lambda: dr.derive_day_records(range_data, start, SUITE_END_DATE), repeat, backend,
+        ))
+
+        records_by_month = {}
+        for rec in records:
+            records_by_month.setdefault((rec["d"].year, rec["d"].month), []).append(rec)
+        results.append(measure(
+            f"aggregate_by_month[{n_days}d]",
+            lambda: dr.aggregate_day_records_by_month(records_by_month), repeat, backend,
+        ))
+
+    # 評分（一個月，已經轉好的欄位）
+    start, end = dr.month_date_range(SUITE_END_DATE.year, SUITE_END_DATE.month)
+    ctx_cols = report_scoring.empty_columns((end - start).days + 1)
+    month_daily = dr.DailyColumns.from_rows(dataset.daily_rows([rid], start, end))
+    for pos in month_daily.iter_positions():
+        i = (month_daily.date_at(pos) - start).days
+        for name in ("night_on_bed", "night_sleep", "sleep_respiration", "day_on_bed", "day_leave",
+                     "asleep_leave", "std_dev"):
+            ctx_cols[name][i] = getattr(month_daily, name)[pos]
+    results.append(measure(
+        "score_month[31d]", lambda: report_scoring.score_month(ctx_cols), repeat, backend,
+    ))
+
+    # 頁面（整個 request，包含查詢、計算與 template）
+    client = dr.app.test_client()
+    client.post("/login", data={"serial_id": resident["serial_id"], "agency_id": str(resident["agency_id"])})
+    year, month = SUITE_END_DATE.year, SUITE_END_DATE.month
+
+    for url in (
+        f"/report?year={year}&month={month}",
+        f"/half_report?year={year}&month={month}",
+        f"/report_30days?year={year}&month={month}",
+    ):
+        def view(url=url):
+            resp = client.get(url)
+            if resp.status_code != 200:
+                raise RuntimeError(f"{url} 回傳 {resp.status_code}")
+
+        results.append(measure(
+            f"view:{url.split('?')[0]}", view, repeat, backend,
+            # 每次都重新讀評語表，跟正式環境快取過期後的第一個 request 一樣
+            setup=dr.invalidate_sheet_comment_cache,
+        ))
+
+    return {
+        "meta": {
+            "git_revision": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "run_at": datetime.now().isoformat(timespec="seconds"),
+            "repeat": repeat,
+            "pyarrow": dr.pa is not None,
+        },
+        "results": results,
+    }
+
+
+def print_results(report):
+    print(f"{'name':<44} {'min ms':>9} {'med ms':>9} {'calls':>6} {'backend':>9} {'compute':>9} {'peak KiB':>9} {'blocks':>8}")
+    for r in report["results"]:
+        print(
+            f"{r['name']:<44} {r['wall_ms_min']:>9.2f} {r['wall_ms_median']:>9.2f} {r['backend_calls']:>6} "
+            f"{r['backend_ms']:>9.2f} {r['compute_ms']:>9.2f} {r['alloc_peak_kib']:>9.1f} {r['alloc_blocks']:>8}"
+        )
+
+
+def compare_results(old, new, threshold: float):
+    """列出 wall_ms_min 變慢超過 threshold（比例）或 backend_calls 變多的項目，回傳是否有退步"""
+    old_by_name = {r["name"]: r for r in old["results"]}
+    regressed = False
+    for r in new["results"]:
+        o = old_by_name.get(r["name"])
+        if o is None:
+            continue
+        ratio = r["wall_ms_min"] / o["wall_ms_min"] if o["wall_ms_min"] else 1.0
+        flags = []
+        if ratio > 1 + threshold:
+            flags.append(f"慢了 {ratio:.2f}x")
+        if r["backend_calls"] > o["backend_calls"]:
+            flags.append(f"查詢 {o['backend_calls']} → {r['backend_calls']}")
+        if flags:
+            regressed = True
+            print(f"[REGRESSION] {r['name']}: {', '.join(flags)}")
+    if not regressed:
+        print(f"沒有退步（門檻 {threshold:.0%}）")
+    return regressed
+
+
+# ================== daily-fetch ==================
+
+def make_daily_rows(n_residents: int, n_days: int, seed: int = 0):
+    """產生 n_residents x n_days 筆跟 DAILY_REPORT_COLUMNS 同格式的 daily 資料（dict）"""
+    rnd = random.Random(seed)
+    start = datetime(2025, 1, 1, 3, 0)
+    rows = []
+    for rid in range(1, n_residents + 1):
+        for i in range(n_days):
+            night_on_bed = round(rnd.uniform(1.0, 12.0), 2)
+            rows.append({
+                "resident_id": rid,
+                "created_at": start + timedelta(days=i),
+                "night_on_bed": night_on_bed,
+                "night_sleep": round(night_on_bed * rnd.uniform(0.5, 0.95), 2),
+                "sleep_respiration": round(rnd.uniform(8, 30), 1) if rnd.random() > 0.05 else None,
+                "day_on_bed": round(rnd.uniform(0, 8), 2),
+                "day_leave": round(rnd.uniform(0, 8), 2),
+                "asleep_leave": float(rnd.choice([0, 1, 2, 3])),
+                "asleep_leave_minute": float(rnd.randint(0, 90)),
+                "asleep_start": dt_time(rnd.choice([20, 21, 22, 23, 0, 1]), rnd.randint(0, 59)).strftime("%H:%M:%S"),
+                "respiration_analy": '{"std_dev": %.2f}' % rnd.uniform(1, 8),
+            })
+    return rows
+
+
+def _as_bq_rows(rows):
+    from google.cloud.bigquery.table import Row
+
+    fields = ("resident_id",) + dr.DAILY_REPORT_COLUMNS
+    field_to_index = {name: i for i, name in enumerate(fields)}
+    return [Row(tuple(r[name] for name in fields), field_to_index) for r in rows]
+
+
+def bench_daily_fetch(n_residents: int, n_days: int, repeat: int):
+    rows = make_daily_rows(n_residents, n_days)
+    bq_rows = _as_bq_rows(rows)
+
+    def rows_path():
+        result = {}
+        for r in bq_rows:
+            rid = r["resident_id"]
+            if rid not in result:
+                result[rid] = dr.DailyColumns()
+            result[rid].append(r)
+        return result
+
+    results = {"rows": _best_of(rows_path, repeat)}
+
+    if dr.pa is None:
+        print("[WARN] 沒有安裝 pyarrow，略過 arrow 路徑")
+    else:
+        table = dr.pa.Table.from_pylist(rows)
+        results["arrow"] = _best_of(lambda: dr.DailyColumns.split_arrow_by_resident(table), repeat)
+
+    print(f"daily-fetch: residents={n_residents} days={n_days} rows={len(rows)} repeat={repeat}")
+    for name, sec in results.items():
+        print(f"  {name:<6} {sec * 1000:9.1f} ms  ({len(rows) / sec:,.0f} rows/s)")
+    if "arrow" in results:
+        print(f"  arrow speedup: {results['rows'] / results['arrow']:.1f}x")
+    return results
+
+
+# ================== startup ==================
+
+# import 時不應該載入的套件（第一次查詢 / 第一次走 Arrow 取數時才載入）
+DEFERRED_MODULES = ("google.cloud.bigquery", "google.oauth2", "gspread", "pyarrow")
+
+_STARTUP_PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import daily_report
+elapsed = time.perf_counter() - t0
+loaded = [m for m in %r if m in sys.modules]
+print(json.dumps({"import_ms": elapsed * 1000, "loaded": loaded}))
+""" % (DEFERRED_MODULES,)
+
+
+def bench_startup(repeat: int, target_ms: float):
+    env = dict(os.environ)
+    env["DATA_SOURCE"] = "bigquery"
+    env.pop("GOOGLE_SERVICE_ACCOUNT_JSON", None)
+    cwd = os.path.dirname(os.path.abspath(__file__))
+
+    samples, loaded = [], set()
+    for i in range(repeat + 1):
+        out = subprocess.run(
+            [sys.executable, "-c", _STARTUP_PROBE], cwd=cwd, env=env,
+            capture_output=True, text=True, timeout=120,
+        )
+        if out.returncode != 0:
+            print(out.stderr)
+            raise RuntimeError("import daily_report 失敗（沒有憑證時也必須能 import）")
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        if i == 0:
+            continue  # 第一次當暖機（.pyc、檔案快取）
+        samples.append(result["import_ms"])
+        loaded.update(result["loaded"])
+
+    median = statistics.median(samples)
+    print(f"startup: import daily_report median={median:.0f} ms min={min(samples):.0f} ms "
+          f"(target {target_ms:.0f} ms, repeat={repeat})")
+    failed = False
+    if loaded:
+        print(f"[REGRESSION] import 時載入了：{', '.join(sorted(loaded))}")
+        failed = True
+    if median > target_ms:
+        print(f"[REGRESSION] import 時間超過目標 {target_ms:.0f} ms")
+        failed = True
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="報表計算效能量測（合成資料）")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_suite = sub.add_parser("suite", help="量測報表計算熱點與頁面")
+    p_suite.add_argument("--repeat", type=int, default=5)
+    p_suite.add_argument("--output", help="結果存成 JSON")
+    p_suite.add_argument("--compare", help="跟之前存的 JSON 比較")
+    p_suite.add_argument("--threshold", type=float, default=0.2,
+                         help="變慢超過多少比例算退步（預設 0.2 = 20%%）")
+
+    p_fetch = sub.add_parser("daily-fetch", help="比較逐列讀取與 Arrow 轉 DailyColumns")
+    p_fetch.add_argument("--residents", type=int, default=200)
+    p_fetch.add_argument("--days", type=int, default=183)
+    p_fetch.add_argument("--repeat", type=int, default=5)
+
+    p_startup = sub.add_parser("startup", help="量 import daily_report 的時間（不給憑證）")
+    p_startup.add_argument("--repeat", type=int, default=5)
+    p_startup.add_argument("--target-ms", type=float, default=500)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "startup":
+        return 1 if bench_startup(args.repeat, args.target_ms) else 0
+
+    if args.command == "daily-fetch":
+        bench_daily_fetch(args.residents, args.days, args.repeat)
+        return 0
+
+    report = run_suite(args.repeat)
+    print_results(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果已存到 {args.output}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            old = json.load(f)
+        if compare_results(old, report, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
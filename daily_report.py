@@ -1,11 +1,27 @@
 import os
 import re
 import json
-import traceback
+import hashlib
 import sys                   # ← 新增
+import sqlite3
+import argparse
+import importlib.util
+import atexit
+import logging
+import logging.handlers
+import queue
+import random
+import multiprocessing
+import threading
+import contextvars
+import time as time_mod
 from datetime import date, datetime, time, timedelta
-from functools import wraps
+from functools import lru_cache, wraps
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 from calendar import monthrange
+from bisect import bisect_left
+from array import array
 
 
 def resource_path(relative_path: str) -> str:
@@ -18,12 +34,45 @@ def resource_path(relative_path: str) -> str:
     KEY_PATH = resource_path(os.path.join("key", "yv-bq-key.json"))
 
 from flask import (
-    Flask, request, redirect, url_for, session, render_template
+    Flask, request, redirect, url_for, session, render_template, g,
+    has_app_context, has_request_context, jsonify, abort,
 )
-from google.cloud import bigquery
+from markupsafe import escape
+from werkzeug.security import check_password_hash, generate_password_hash
 
-import gspread
-from google.oauth2.service_account import Credentials
+import report_scoring
+import report_charts
+import report_pdf
+import metrics
+import shared_cache
+import local_replica
+from local_replica import LocalReplica
+
+
+class _LazyModule:
+    """第一次用到屬性時才 import；google-cloud-bigquery 這類很重的套件不在啟動時載入"""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+
+bigquery = _LazyModule("google.cloud.bigquery")
+
+# pyarrow（+ google-cloud-bigquery-storage）是選用套件：有裝才能走 Arrow 取數；
+# 一樣延遲到第一次用到才 import（import 要 70ms 以上），沒裝的話 pa / pc 為 None
+if importlib.util.find_spec("pyarrow") is not None:
+    pa = _LazyModule("pyarrow")
+    pc = _LazyModule("pyarrow.compute")
+else:
+    pa = None
+    pc = None
 
 # ================== 1. BigQuery / Google Sheet 連線設定 ==================
 
@@ -32,6 +81,33 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 # ---- Google Sheet - 評語設定 ----
 SHEET_SPREADSHEET_ID = "1uGA6GBkhItPp730Fbj7anMSQ1LS_eK7T0GQcb5iVt3w"
 SHEET_GID = 0
+# 評語表讀進來後在共用快取保留多久（秒）
+SHEET_CACHE_TTL = int(os.environ.get("SHEET_CACHE_TTL", "300"))
+
+# ---- 跨 worker 共用快取（見 shared_cache.py）----
+# memory://（預設，process 內）/ sqlite:///cache/shared_cache.sqlite3（同機器 worker 共用）/
+# redis://host:6379/0（多台共用）/ none://（不快取）
+# 存放：登入查詢、最新資料日、評語表索引、區間查詢結果、月報 / 半年報計算結果
+SHARED_CACHE_URL = os.environ.get("SHARED_CACHE_URL", "memory://")
+SHARED_CACHE_MAX_ENTRIES = int(os.environ.get("SHARED_CACHE_MAX_ENTRIES", "5000"))
+# SHARED_CACHE_MAX_BYTES：總大小上限（Redis 為單筆上限）；沒設定時 memory:// 不限大小（只限筆數，
+# 限大小的話每次寫入都要 pickle 估算），sqlite / redis 為 256MB
+SHARED_CACHE_MAX_BYTES = os.environ.get("SHARED_CACHE_MAX_BYTES")
+SHARED_CACHE_MAX_BYTES = int(SHARED_CACHE_MAX_BYTES) if SHARED_CACHE_MAX_BYTES else None
+# 區間查詢結果（key 含資料版本，新資料進來會換 key）與報表計算結果保留幾秒
+QUERY_CACHE_TTL = int(os.environ.get("QUERY_CACHE_TTL", "600"))
+REPORT_CONTEXT_CACHE_TTL = int(os.environ.get("REPORT_CONTEXT_CACHE_TTL", "86400"))
+
+# ---- 登入查詢 / 最新資料日快取（秒，0 = 不快取）----
+# RESIDENT_CACHE_TTL：serial_id + agency_id 查到的住民資料
+# LATEST_DATE_CACHE_TTL：每位住民最後一筆 daily 的日期（也存在 session，換頁不用重查）
+RESIDENT_CACHE_TTL = int(os.environ.get("RESIDENT_CACHE_TTL", "600"))
+LATEST_DATE_CACHE_TTL = int(os.environ.get("LATEST_DATE_CACHE_TTL", "300"))
+
+# ---- 照護人員帳號（機構總覽 /agency_dashboard 用，跟家屬登入分開）----
+# STAFF_ACCOUNTS：JSON，{"帳號": {"password_hash": "...", "agency_id": 1}, ...}
+# password_hash 用 python daily_report.py staff-password 產生；沒設定時沒有人能看機構總覽
+STAFF_ACCOUNTS = json.loads(os.environ.get("STAFF_ACCOUNTS") or "{}")
 
 # 只給 Sheet 用的 scopes
 SHEETS_SCOPES = [
@@ -44,36 +120,152 @@ ALL_GOOGLE_SCOPES = SHEETS_SCOPES + [
     "https://www.googleapis.com/auth/bigquery",
 ]
 
+# ---- 資料來源 ----
+# bigquery（預設）/ replica（本機副本，見 sync-replica）/ fake（假資料，不需要 Google 憑證）
+DATA_SOURCE = os.environ.get("DATA_SOURCE", "bigquery")
+
 # Render 上：service account JSON 放在環境變數 GOOGLE_SERVICE_ACCOUNT_JSON 裡
 SERVICE_ACCOUNT_JSON = os.environ.get("GOOGLE_SERVICE_ACCOUNT_JSON")
 
-if SERVICE_ACCOUNT_JSON:
-    # 從環境變數讀 JSON
-    key_info = json.loads(SERVICE_ACCOUNT_JSON)
-
-    google_creds = Credentials.from_service_account_info(
-        key_info,
-        scopes=ALL_GOOGLE_SCOPES,
-    )
-
-    bq_client = bigquery.Client(
-        credentials=google_creds,
-        project=key_info.get("project_id"),
-    )
-else:
-    # 本機開發：改回用 key 檔
-    KEY_PATH = resource_path(os.path.join("key", "yv-bq-key.json"))
-    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = KEY_PATH
+# 憑證與 BigQuery / gspread client 都在第一次用到時才建立（也才 import Google 套件），
+# import 本模組不需要憑證；假資料模式完全不會碰到
+_google_clients = {}
+_google_clients_lock = threading.RLock()
 
-    google_creds = Credentials.from_service_account_file(
-        KEY_PATH,
-        scopes=ALL_GOOGLE_SCOPES,
-    )
 
-    bq_client = bigquery.Client()
+def get_google_credentials():
+    """service account 憑證（已含 sheet + drive + bigquery scopes）"""
+    with _google_clients_lock:
+        if "creds" not in _google_clients:
+            from google.oauth2.service_account import Credentials
 
-# gspread 用同一組憑證（已含 sheet + drive + bigquery scopes）
-sheets_client = gspread.authorize(google_creds)
+            if SERVICE_ACCOUNT_JSON:
+                # 從環境變數讀 JSON
+                key_info = json.loads(SERVICE_ACCOUNT_JSON)
+                _google_clients["creds"] = Credentials.from_service_account_info(
+                    key_info,
+                    scopes=ALL_GOOGLE_SCOPES,
+                )
+                _google_clients["project_id"] = key_info.get("project_id")
+            else:
+                # 本機開發：改回用 key 檔
+                key_path = resource_path(os.path.join("key", "yv-bq-key.json"))
+                os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = key_path
+                _google_clients["creds"] = Credentials.from_service_account_file(
+                    key_path,
+                    scopes=ALL_GOOGLE_SCOPES,
+                )
+                _google_clients["project_id"] = None  # bigquery.Client() 從 key 檔讀
+        return _google_clients["creds"]
+
+
+def get_bq_client():
+    """BigQuery client（第一次呼叫時建立，之後共用；client 本身可以跨 thread 使用）"""
+    client = _google_clients.get("bq")
+    if client is None:
+        with _google_clients_lock:
+            client = _google_clients.get("bq")
+            if client is None:
+                creds = get_google_credentials()
+                project_id = _google_clients["project_id"]
+                if project_id:
+                    client = bigquery.Client(credentials=creds, project=project_id)
+                else:
+                    client = bigquery.Client()
+                _google_clients["bq"] = client
+    return client
+
+
+def get_sheets_client():
+    """gspread client，用同一組憑證"""
+    client = _google_clients.get("sheets")
+    if client is None:
+        with _google_clients_lock:
+            client = _google_clients.get("sheets")
+            if client is None:
+                import gspread
+
+                client = _google_clients["sheets"] = gspread.authorize(get_google_credentials())
+    return client
+
+
+def set_google_clients(bq_client=None, sheets_client=None):
+    """直接指定 client（離線測試 / 工具用）；沒給的維持原狀"""
+    with _google_clients_lock:
+        if bq_client is not None:
+            _google_clients["bq"] = bq_client
+        if sheets_client is not None:
+            _google_clients["sheets"] = sheets_client
+
+# ---- 報表快照（SQLite）----
+# 設成空字串就停用快照，每次都重新計算
+REPORT_SNAPSHOT_DB = os.environ.get(
+    "REPORT_SNAPSHOT_DB", os.path.join(BASE_DIR, "cache", "report_snapshots.sqlite3")
+)
+# 月份結束後再等幾天才視為 closed（快照不再重建）：月底最後一天的翻身間隔要用到下個月 1 號的翻身資料，
+# 那一天的資料整天都會陸續進來；預設 1 → 下個月 2 號有資料（1 號已經過完）才 closed
+SNAPSHOT_CLOSE_GRACE_DAYS = int(os.environ.get("SNAPSHOT_CLOSE_GRACE_DAYS", "1"))
+
+# ---- 同一個 request 內的 BigQuery / Sheets 查詢並行執行 ----
+# FETCH_WORKERS：共用 thread pool 大小；FETCH_TIMEOUT_SEC：單一查詢最多等幾秒
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", "8"))
+FETCH_TIMEOUT_SEC = float(os.environ.get("FETCH_TIMEOUT_SEC", "60"))
+
+# ---- 半年報：快取裡沒有逐日結果的月份在 BigQuery 彙總（每月一列；設 0 改成撈逐日資料在 Python 彙總）----
+HALF_REPORT_AGGREGATE_IN_BQ = os.environ.get("HALF_REPORT_AGGREGATE_IN_BQ", "1") == "1"
+
+# ---- 逐日計算結果快取（day records）----
+# 1（預設）：每天的有效天判斷、上床時間、離床總時長、日夜翻身間隔等算一次就存進共用快取（以月為單位），
+#           月報從這些逐日結果彙總；半年報的月份快取裡有就直接用，沒有的才查詢
+# 0：不快取，每次都重新計算
+DAY_RECORD_CACHE = os.environ.get("DAY_RECORD_CACHE", "1") == "1"
+
+# ---- daily 資料以 Arrow 取回（需要 pyarrow；有裝 google-cloud-bigquery-storage 會走 Storage Read API）----
+# 設 0 改回逐列讀取；沒裝 pyarrow 時自動用逐列讀取
+BQ_ARROW_FETCH = os.environ.get("BQ_ARROW_FETCH", "1") == "1"
+
+# ---- 本機副本（離線模式）----
+# python daily_report.py sync-replica 把 BigQuery 資料增量複製到 LOCAL_REPLICA_DB；
+# DATA_SOURCE=replica 時報表查詢都改讀本機副本（Google Sheet 評語仍然線上讀，讀不到就顯示空白）
+LOCAL_REPLICA_DB = os.environ.get(
+    "LOCAL_REPLICA_DB", os.path.join(BASE_DIR, "cache", "bq_replica.sqlite3")
+)
+# 第一次同步往回抓幾天
+REPLICA_INITIAL_DAYS = int(os.environ.get("REPLICA_INITIAL_DAYS", "400"))
+
+# ---- 日誌 ----
+# LOG_LEVEL：DEBUG / INFO（預設）/ WARNING / ERROR
+# LOG_DEBUG_SAMPLE：0~1，LOG_LEVEL 不是 DEBUG 時抽樣這個比例的 request 輸出 DEBUG（例如 0.01）
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_DEBUG_SAMPLE = float(os.environ.get("LOG_DEBUG_SAMPLE", "0"))
+
+# ---- 效能量測 ----
+# 每個 response 加 Server-Timing header（BigQuery / Sheets / 計算各花多少時間），
+# 並在 /metrics 提供 Prometheus 格式的統計；設 0 關閉
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+
+# ---- 報表圖表 ----
+# 1（預設）：月報 / 半年報的圖在伺服器端畫成 SVG 直接嵌進頁面（見 report_charts.py），
+#           頁面不用再載 Chart.js；每位住民每月的圖存在共用快取
+# 0：改回瀏覽器端 Chart.js 繪圖
+SERVER_CHARTS = os.environ.get("SERVER_CHARTS", "1") == "1"
+
+# ---- PDF 匯出 ----
+# /report.pdf、/half_report.pdf 在伺服器端產生 PDF（見 report_pdf.py）；
+# python daily_report.py export-pdf --agency-id A 批次輸出整個機構，同時用幾個 process 產生
+PDF_EXPORT_WORKERS = int(os.environ.get("PDF_EXPORT_WORKERS", "4"))
+PDF_EXPORT_DIR = os.environ.get("PDF_EXPORT_DIR", os.path.join(BASE_DIR, "pdf"))
+
+# ---- 月初預熱（prewarm）----
+# 同時計算幾位住民；換月後自動預熱上個月的排程有兩種開法（都是每小時檢查一次）：
+#   - python daily_report.py prewarm --schedule（獨立 process，gunicorn 多 worker 時用這個）
+#   - PREWARM_SCHEDULER=1 時 python daily_report.py 啟動網頁也會在背景跑
+# 上個月要等到 closed（見 SNAPSHOT_CLOSE_GRACE_DAYS：下個月 2 號有資料）資料才到齊，太早預熱的快照
+# 會在資料進來時失效；所以排程在 1 號不預熱，之後先只預熱已經 closed 的住民，其他住民等下一輪，
+# 可以 closed 之後再等 PREWARM_WAIT_DAYS 天仍沒有新資料（例如設備沒開）才直接預熱
+PREWARM_WORKERS = int(os.environ.get("PREWARM_WORKERS", "4"))
+PREWARM_SCHEDULER = os.environ.get("PREWARM_SCHEDULER", "") == "1"
+PREWARM_WAIT_DAYS = int(os.environ.get("PREWARM_WAIT_DAYS", "1"))
 
 # ---- BigQuery 表名 ----
 RESIDENT_TABLE   = "`skillful-signer-322707.Big_Query_SQL_Daily.resdient_agency_device`"
@@ -83,6 +275,57 @@ TOC_FIG_TABLE    = "`skillful-signer-322707.Big_Query_SQL_Daily.N_bq_toC_fig`"
 
 # ================== 2. Flask App 基本設定 ==================
 
+# ---------- 日誌 ----------
+# 呼叫端只把 record 丟進 queue，由背景 QueueListener 組字串、寫到 stdout，request 不用等 I/O；
+# 訊息一律用 %-格式的參數（logger.debug("x=%s", x)），沒開 DEBUG 時不會組字串
+
+logger = logging.getLogger("daily_report")
+
+# 這個 request（或 CLI）要不要輸出 DEBUG；丟到 submit_fetch 的查詢會沿用同一個值
+_debug_sampled = contextvars.ContextVar("debug_sampled", default=LOG_LEVEL == "DEBUG")
+
+
+class _SampledDebugFilter(logging.Filter):
+    """LOG_DEBUG_SAMPLE 模式：DEBUG 只放行被抽中的 request"""
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or _debug_sampled.get()
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """同一個 process 內的 queue 不需要先把 record 轉成字串，原樣丟進去，由背景 thread 組字串"""
+
+    def prepare(self, record):
+        return record
+
+
+def _setup_logging():
+    if logger.handlers:
+        return
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)  # 結束前把 queue 裡剩下的寫完
+
+    logger.addHandler(_DeferredQueueHandler(log_queue))
+    logger.propagate = False
+    if LOG_LEVEL != "DEBUG" and LOG_DEBUG_SAMPLE > 0:
+        logger.setLevel(logging.DEBUG)
+        logger.addFilter(_SampledDebugFilter())
+    else:
+        logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+
+
+def debug_enabled() -> bool:
+    """現在會不會輸出 DEBUG；DEBUG 訊息的參數本身很花時間（例如要另外組 list）時先檢查"""
+    return logger.isEnabledFor(logging.DEBUG) and _debug_sampled.get()
+
+
+_setup_logging()
+
+
 app = Flask(
     __name__,
     template_folder=resource_path("templates"),
@@ -101,1526 +344,2672 @@ def login_required(f):
     return wrapper
 
 
-# ================== 3. BigQuery / Sheets 輔助函式 ==================
-
-
-def get_resident_by_login(serial_id: str, agency_id: int):
+def staff_required(f):
     """
-    用 SERIAL_ID + AGENCY_ID 當帳密，從 resdient_agency_device 找住民：
-      - note 必須為 'C'
-      - serial_id 不得為空
-    找到就回傳 dict，找不到回傳 None
+    照護人員登入檢查（/staff_login）：
+      - 家屬登入（serial_id + agency_id）只能看自己的報表 → 403
+      - 都沒登入 → 導到照護人員登入頁
     """
-    query = f"""
-    SELECT
-      resident_id,
-      resident_name,
-      agency_id,
-      agency_name,
-      codename,
-      bed_number,
-      note,
-      serial_id
-    FROM {RESIDENT_TABLE}
-    WHERE
-      serial_id = @serial_id
-      AND agency_id = @agency_id
-      AND note = 'C'
-      AND serial_id IS NOT NULL
-      AND serial_id != ''
-    LIMIT 1
-    """
-
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("serial_id", "STRING", serial_id),
-            bigquery.ScalarQueryParameter("agency_id", "INT64", agency_id),
-        ]
-    )
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if "staff_user" not in session:
+            if "serial_id" in session:
+                abort(403)
+            return redirect(url_for("staff_login"))
+        return f(*args, **kwargs)
+    return wrapper
 
-    rows = list(bq_client.query(query, job_config=job_config).result())
-    if not rows:
-        return None
-    return dict(rows[0])
 
+# ---------- 效能量測（Server-Timing / Prometheus） ----------
 
-def get_latest_created_date(resident_id: int) -> date:
-    """
-    回傳這個 resident 在 DAILY_TABLE 中最後一筆 created_at 的「日期」。
-    若沒有任何資料，回傳今天。
-    """
-    query = f"""
-    SELECT
-      DATE(MAX(created_at)) AS last_date
-    FROM {DAILY_TABLE}
-    WHERE
-      resident_id = @resident_id
-    """
+HTTP_REQUEST_SECONDS = metrics.Histogram(
+    "http_request_duration_seconds", "每個 route 的回應時間（秒）", ("route", "method", "status"),
+)
+DATA_QUERY_SECONDS = metrics.Histogram(
+    "data_query_duration_seconds", "資料來源查詢時間（秒），BigQuery 為送出到 job 完成", ("source", "query"),
+)
+BQ_JOBS = metrics.Counter("bigquery_jobs_total", "BigQuery job 數", ("query", "cache_hit"))
+BQ_BYTES_PROCESSED = metrics.Counter(
+    "bigquery_bytes_processed_total", "BigQuery 掃描的 bytes（total_bytes_processed）", ("query",),
+)
+BQ_SLOT_MILLIS = metrics.Counter("bigquery_slot_milliseconds_total", "BigQuery slot 毫秒數", ("query",))
+SHEETS_SECONDS = metrics.Histogram("sheets_call_duration_seconds", "讀整張評語表的時間（秒）")
+STAGE_SECONDS = metrics.Histogram(
+    "report_stage_duration_seconds", "報表各階段（快照、計算、畫面）的時間（秒）", ("stage",),
+)
 
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("resident_id", "INT64", resident_id),
-        ]
-    )
 
-    rows = list(bq_client.query(query, job_config=job_config).result())
-    if rows and rows[0].get("last_date") is not None:
-        last_date = rows[0]["last_date"]
-        if isinstance(last_date, datetime):
-            return last_date.date()
-        return last_date
-    return date.today()
+@app.before_request
+def _sample_debug_logging():
+    if LOG_LEVEL != "DEBUG" and LOG_DEBUG_SAMPLE > 0:
+        _debug_sampled.set(random.random() < LOG_DEBUG_SAMPLE)
 
 
-def get_daily_for_resident_by_range(resident_id: int, start_date: date, end_date: date):
-    """
-    撈某個 resident 在指定日期區間的所有紀錄
-    提供 /daily 列表用
-    """
-    query = f"""
-    SELECT
-      d.*
-    FROM {DAILY_TABLE} AS d
-    WHERE
-      d.resident_id = @resident_id
-      AND DATE(d.created_at) BETWEEN @start_date AND @end_date
-    ORDER BY d.created_at
-    """
-
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("resident_id", "INT64", resident_id),
-            bigquery.ScalarQueryParameter("start_date", "DATE", start_date),
-            bigquery.ScalarQueryParameter("end_date", "DATE", end_date),
-        ]
+@app.before_request
+def _begin_request_timing():
+    if METRICS_ENABLED:
+        metrics.begin_request()
+
+
+@app.after_request
+def _finish_request_timing(response):
+    timings = metrics.current_timings()
+    if timings is None:
+        return response
+    route = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+    HTTP_REQUEST_SECONDS.observe(
+        time_mod.perf_counter() - timings.started,
+        route=route, method=request.method, status=str(response.status_code),
     )
+    response.headers["Server-Timing"] = timings.server_timing_header()
+    return response
 
-    rows = list(bq_client.query(query, job_config=job_config).result())
-    return [dict(r) for r in rows]
 
+@app.teardown_request
+def _end_request_timing(exc=None):
+    metrics.end_request()
 
-def get_30min_slots_for_date(resident_id: int, day_date: date):
-    """
-    從 N_bq_toC_fig 撈出某一天的作息資料：
-      - 時間範圍：day_date 12:00 ~ (day_date + 1 天) 12:00
-      - 切成 30 分鐘一格，共 48 格
-      - 同一格若有多筆，優先順序：08 > 07 > 00
-      - 回傳長度 48 的 list，每格可能是 '08' / '07' / '00' / 'none'
-    """
-    start_dt = datetime.combine(day_date, time(12, 0, 0))
-    end_dt = start_dt + timedelta(days=1)
 
-    query = f"""
-    SELECT
-      slot_index,
-      MAX(priority) AS max_p
-    FROM (
-      SELECT
-        CAST(TIMESTAMP_DIFF(detect_at, @start_ts, MINUTE) / 30 AS INT64) AS slot_index,
-        CASE value
-          WHEN '08' THEN 3
-          WHEN '07' THEN 2
-          WHEN '00' THEN 1
-          ELSE 0
-        END AS priority
-      FROM {TOC_FIG_TABLE}
-      WHERE
-        resident_id = @resident_id
-        AND detect_at >= @start_ts
-        AND detect_at < @end_ts
-        AND value IN ('00', '07', '08')
-    )
-    GROUP BY slot_index
-    HAVING slot_index BETWEEN 0 AND 47
-    ORDER BY slot_index
-    """
+# ================== 3. BigQuery / Sheets 輔助函式 ==================
 
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("resident_id", "INT64", resident_id),
-            bigquery.ScalarQueryParameter("start_ts", "TIMESTAMP", start_dt),
-            bigquery.ScalarQueryParameter("end_ts", "TIMESTAMP", end_dt),
-        ]
-    )
 
-    rows = list(bq_client.query(query, job_config=job_config).result())
+# 彼此獨立的查詢丟到這個 pool 同時跑，頁面等待時間約等於最慢的那一個。
+# 注意：丟進 pool 的函式裡不要再 submit_fetch 並等待，避免 pool 被自己卡死。
+_fetch_pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="fetch")
 
-    # 預設 48 格都沒有資料
-    slots = ["none"] * 48
-    priority_to_value = {3: "08", 2: "07", 1: "00"}
+_RAISE = object()
 
-    for r in rows:
-        idx = r["slot_index"]
-        max_p = r["max_p"]
-        val = priority_to_value.get(max_p)
-        if val is None:
-            continue
-        if 0 <= idx < 48:
-            slots[idx] = val
 
-    return slots
+# 目前是不是在 submit_fetch 的背景 task 裡：task 可能在 wait_fetch 逾時、response 已經送出後才跑完，
+# 不能讀寫 session（get_latest_created_date 會看這個）
+_in_fetch_task = contextvars.ContextVar("in_fetch_task", default=False)
 
 
-def convert_asleep_start_to_hour(value):
+def _run_fetch_task(fn, args, kwargs):
+    _in_fetch_task.set(True)
+    return fn(*args, **kwargs)
+
+
+def submit_fetch(fn, *args, **kwargs):
     """
-    將 asleep_start 轉成「數值小時」，方便畫圖：
-      - 先取時間 (HH:MM)
-      - 如果時間 < 12:00，視為「隔天凌晨」=> +24
-      - 這樣 y 軸大約是 20 ~ 32 (晚上8點~隔天早上8點)
+    把一個查詢丟到背景執行，回傳 Future（帶著目前的 contextvars，查詢時間會記到同一個 request）；
+    需要最新資料日（資料版本）的查詢請在 request thread 先查好當參數傳進去
     """
-    if value is None:
-        return None
+    ctx = contextvars.copy_context()
+    return _fetch_pool.submit(ctx.run, _run_fetch_task, fn, args, kwargs)
 
-    t = None
 
-    if isinstance(value, datetime):
-        t = value.time()
-    elif isinstance(value, time):
-        t = value
-    else:
-        s = str(value)
-        for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S",
-                    "%H:%M:%S", "%H:%M"):
-            try:
-                t = datetime.strptime(s, fmt).time()
-                break
-            except ValueError:
-                continue
-        if t is None:
-            return None
+def wait_fetch(future, name: str = "", timeout=None, default=_RAISE):
+    """
+    等待 submit_fetch 的結果：
+      - 超過 timeout 秒（預設 FETCH_TIMEOUT_SEC）→ 有給 default 就回傳 default，否則丟 TimeoutError
+      - 查詢本身的例外：有給 default 就印警告並回傳 default，否則原樣丟出
+    """
+    timeout = FETCH_TIMEOUT_SEC if timeout is None else timeout
+    try:
+        return future.result(timeout=timeout)
+    except FuturesTimeoutError:
+        future.cancel()
+        if default is _RAISE:
+            raise TimeoutError(f"查詢逾時（{timeout:.0f} 秒）：{name}")
+        logger.warning("查詢逾時（%.0f 秒），改用預設值：%s", timeout, name)
+        return default
+    except Exception as e:
+        if default is _RAISE:
+            raise
+        logger.warning("查詢失敗，改用預設值：%s %r", name, e)
+        return default
 
-    h = t.hour + t.minute / 60.0 + t.second / 3600.0
 
-    # 凌晨 (例如 01:30) 視為「隔日」，加 24 小時
-    if h < 12:
-        h += 24.0
+# ---------- 共用快取 ----------
+# 依 SHARED_CACHE_URL 建立一次；key 一律加上版本前綴，資料格式改變時改 CACHE_KEY_VERSION 即可讓舊值失效
 
-    return h
+CACHE_KEY_VERSION = "v1"
 
+_app_cache = None
+_app_cache_lock = threading.Lock()
 
-def build_night_interval_for_day(day_date, asleep_value, night_sleep_hours):
-    """
-    建立某天 d 的「夜間區間」：
-      night_start = d + asleep_start
-      night_end   = night_start + night_sleep_hours(小時)
-    可能跨日（例如 21:00 ~ 翌日 08:00）
-    """
-    if asleep_value is None or night_sleep_hours is None:
-        return None, None
 
-    # 把 asleep_value 轉成 time
-    if isinstance(asleep_value, datetime):
-        t = asleep_value.time()
-    elif isinstance(asleep_value, time):
-        t = asleep_value
-    else:
-        s = str(asleep_value)
-        t = None
-        for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S",
-                    "%H:%M:%S", "%H:%M"):
-            try:
-                t = datetime.strptime(s, fmt).time()
-                break
-            except ValueError:
-                continue
-        if t is None:
-            return None, None
+def app_cache() -> shared_cache.CacheBackend:
+    """目前使用的共用快取"""
+    global _app_cache
+    if _app_cache is None:
+        with _app_cache_lock:
+            if _app_cache is None:
+                _app_cache = shared_cache.create_cache(
+                    SHARED_CACHE_URL,
+                    max_entries=SHARED_CACHE_MAX_ENTRIES,
+                    max_bytes=SHARED_CACHE_MAX_BYTES,
+                )
+    return _app_cache
 
-    try:
-        nh = float(night_sleep_hours)
-    except (TypeError, ValueError):
-        return None, None
 
-    night_start = datetime.combine(day_date, t)
-    night_end = night_start + timedelta(hours=nh)
-    return night_start, night_end
+def set_app_cache(cache: shared_cache.CacheBackend):
+    """換掉共用快取（量測用）"""
+    global _app_cache
+    with _app_cache_lock:
+        _app_cache = cache
 
 
-def compute_day_night_avg_intervals(day_date, night_start_dt, night_end_dt, flip_datetimes):
-    """
-    計算某天 day_date 的：
-      - 夜間翻身平均間隔（分鐘）
-      - 日間翻身平均間隔（分鐘）
+def cache_key(namespace: str, *parts) -> str:
+    return ":".join([CACHE_KEY_VERSION, namespace] + [str(p) for p in parts])
 
-    規則：
-      - 只考慮 flip_dt.date() 在 { day_date, day_date+1 } 的翻身
-      - 若 night_start_dt <= flip_dt < night_end_dt → 夜間翻身
-        其他 → 日間翻身
-    """
-    day0 = day_date
-    day1 = day_date + timedelta(days=1)
-    night_flips = []
-    day_flips = []
 
-    for flip_dt in flip_datetimes:
-        fdate = flip_dt.date()
-        if fdate < day0 or fdate > day1:
-            continue
-        if (night_start_dt is not None and night_end_dt is not None
-                and night_start_dt <= flip_dt < night_end_dt):
-            night_flips.append(flip_dt)
-        else:
-            day_flips.append(flip_dt)
+# ---------- 資料來源（backend） ----------
+#
+# 報表需要的查詢都經過 DataBackend，依 DATA_SOURCE 選擇：
+#   - bigquery：BigQuery + Google Sheet（正式環境）
+#   - replica ：sync-replica 建的本機 SQLite 副本（評語仍讀 Google Sheet）
+#   - fake    ：fake_data.SyntheticDataset 產生的固定假資料，不需要任何 Google 憑證
+# 每個查詢回傳的格式都跟 BigQuery 查詢結果一樣（dict，欄位名稱相同）
 
-    def avg_interval(flips):
-        if len(flips) < 2:
-            return None
-        flips_sorted = sorted(flips)
-        diffs = []
-        for i in range(1, len(flips_sorted)):
-            delta_min = (flips_sorted[i] - flips_sorted[i - 1]).total_seconds() / 60.0
-            if delta_min > 0:
-                diffs.append(delta_min)
-        if not diffs:
-            return None
-        return sum(diffs) / len(diffs)
 
-    return avg_interval(night_flips), avg_interval(day_flips)
+class DataBackend:
+    """報表資料來源的介面"""
 
+    name = ""
+    # 能不能在資料端直接做半年報的每月彙總（只有 BigQuery 可以）
+    supports_monthly_aggregates = False
 
-def get_date_key(v) -> str:
-    """把 created_at 轉成 'YYYY-MM-DD' 字串，方便跟月份每一天對齊。"""
-    if v is None:
-        return ""
-    if hasattr(v, "strftime"):
-        try:
-            if isinstance(v, datetime):
-                return v.date().strftime("%Y-%m-%d")
-            return v.strftime("%Y-%m-%d")
-        except Exception:
-            pass
-    s = str(v)
-    return s[:10]  # '2025-10-03 00:00:00' -> '2025-10-03'
+    def get_resident_by_login(self, serial_id: str, agency_id: int):
+        """用 serial_id + agency_id 找可登入的住民（note='C'），找不到回傳 None"""
+        raise NotImplementedError
 
+    def list_active_residents(self, agency_id=None):
+        """可登入住民清單（list of dict），依 agency_id、resident_id 排序"""
+        raise NotImplementedError
 
-def parse_month_cell(text):
-    """
-    從「月份」欄位文字裡抓出 (year, month)，例如：
-      2025/10、2025-10、2025年10月 -> (2025, 10)
-    找不到就回傳 (None, None)
-    """
-    s = str(text or "").strip()
-    m = re.search(r"(\d{4}).*?(\d{1,2})", s)
-    if not m:
-        return None, None
-    try:
-        y = int(m.group(1))
-        mth = int(m.group(2))
-        return y, mth
-    except ValueError:
-        return None, None
+    def latest_created_dates(self, resident_ids):
+        """{resident_id: 最後一筆 daily 的日期}；沒有資料的住民不列"""
+        raise NotImplementedError
 
+    def daily_rows(self, resident_ids, start_date: date, end_date: date, columns=None):
+        """
+        DATE(created_at) 在區間內的 daily 列（含 resident_id），依 resident_id、created_at 排序；
+        columns 為 None 時回傳全部欄位
+        """
+        raise NotImplementedError
 
-def to_int_or_none(x):
-    if x is None or x == "":
-        return None
-    try:
-        return int(float(x))
-    except (TypeError, ValueError):
-        return None
+    def daily_columns(self, resident_ids, start_date: date, end_date: date):
+        """報表用的 daily 欄位，回傳 {resident_id: DailyColumns}（每位住民都會有，可能是空的）"""
+        result = {rid: DailyColumns() for rid in resident_ids}
+        for r in self.daily_rows(resident_ids, start_date, end_date, columns=DAILY_REPORT_COLUMNS):
+            result[r["resident_id"]].append(r)
+        return result
 
+    def bed_turn_rows(self, resident_ids, start_date: date, end_date: date):
+        """
+        N_bq_Duration24 中 bed_state='09'、duration <= 15 小時（或沒有 duration）的段落：
+        [{"resident_id", "d", "time_start", "duration_sec"}, ...]，依 resident_id、d、time_start 排序
+        """
+        raise NotImplementedError
 
-# ---------- 評語比對用的輔助函式 ----------
+    def toc_slot_priorities(self, resident_id: int, start_dt: datetime, n_windows: int):
+        """
+        N_bq_toC_fig 從 start_dt 起 n_windows 天、每 30 分鐘一格的最高優先值（08 > 07 > 00 → 3 / 2 / 1）：
+        [{"window_index", "slot_index", "max_p"}, ...]
+        """
+        raise NotImplementedError
 
-def _norm_text(s):
-    """
-    將文字標準化：
-      - None -> ""
-      - 轉成 str
-      - 移除全形空白、所有空白
-      - 轉小寫
-    """
-    if s is None:
-        return ""
-    s = str(s).replace("\u3000", " ")
-    s = re.sub(r"\s+", "", s)
-    return s.lower()
+    def monthly_daily_aggregates(self, resident_id: int, start_date: date, end_date: date):
+        """半年報每月彙總（supports_monthly_aggregates 為 True 才會被呼叫）"""
+        raise NotImplementedError
 
+    def sheet_values(self, spreadsheet_id: str, gid: int):
+        """評語表整張工作表的值（list of list，第一列是表頭）；失敗直接丟例外"""
+        raise NotImplementedError
 
-def _norm_digits(x):
-    """
-    只保留數字，例如：
-      '  001-23 ' -> '00123'
-      112 -> '112'
-    """
-    if x is None:
-        return ""
-    s = str(x)
-    digits = re.findall(r"\d+", s)
-    return "".join(digits)
+
+def _read_google_sheet_values(spreadsheet_id: str, gid: int):
+    """用 gspread 讀整張工作表；找不到 gid 就讀第一張"""
+    sh = get_sheets_client().open_by_key(spreadsheet_id)
+    try:
+        ws = sh.get_worksheet_by_id(gid)
+    except Exception:
+        ws = sh.get_worksheet(0)
+    logger.debug("Sheet='%s', WS='%s', gid=%s", sh.title, ws.title, ws.id)
+    return ws.get_all_values()
 
 
-def get_month_comments_from_sheet(serial_id: str, agency_id: int, year: int, month: int):
+def run_bq_query(query: str, job_config=None, name: str = "query"):
     """
-    讀取 Google Sheet 評語；對 serial/agency 進行強力正規化比對。
-    支援：
-      - 同一個住民 / 月份，可以用「一列填離床」、「另一列填臥床」。
+    送出 BigQuery 查詢並等 job 完成，回傳 job（之後 job.result() 直接讀已完成的結果）；
+    順便記錄 job 時間、掃描 bytes、slot 毫秒數與是否命中 BigQuery 快取
     """
-    result = {
-        "active_summary": "", "active_resp": "", "active_sleep_range": "",
-        "active_asleep_start": "", "active_night_leave": "",
-        "active_trend": "", "active_trend_summary": "",
-        "bed_summary": "", "bed_resp": "", "bed_night_bed": "",
-        "bed_leave_total": "", "bed_turn": "", "bed_trend": "",
-        "bed_trend_summary": "",
-    }
-
-    # 先打開試算表
+    t0 = time_mod.perf_counter()
+    job = get_bq_client().query(query, job_config=job_config)
     try:
-        sh = sheets_client.open_by_key(SHEET_SPREADSHEET_ID)
-        try:
-            ws = sh.get_worksheet_by_id(SHEET_GID)
-        except Exception:
-            ws = sh.get_worksheet(0)
-        print(f"[DEBUG] Sheet='{sh.title}', WS='{ws.title}', gid={ws.id}")
-    except Exception as e:
-        print("[WARN] 開啟試算表失敗（repr）：", repr(e))
-        traceback.print_exc()
-        return result
+        job.result()
+    finally:
+        metrics.record("bq", time_mod.perf_counter() - t0, DATA_QUERY_SECONDS, source="bigquery", query=name)
+        bytes_processed = getattr(job, "total_bytes_processed", None) or 0
+        slot_millis = getattr(job, "slot_millis", None) or 0
+        cache_hit = bool(getattr(job, "cache_hit", None))
+        BQ_JOBS.inc(query=name, cache_hit="true" if cache_hit else "false")
+        BQ_BYTES_PROCESSED.inc(bytes_processed, query=name)
+        BQ_SLOT_MILLIS.inc(slot_millis, query=name)
+        timings = metrics.current_timings()
+        if timings is not None:
+            timings.add_total("bq_bytes", bytes_processed)
+            timings.add_total("bq_slot_ms", slot_millis)
+            timings.add_total("bq_cache_hits", int(cache_hit))
+    return job
+
+
+class BigQueryBackend(DataBackend):
+    """正式環境：查 BigQuery、讀 Google Sheet"""
+
+    name = "bigquery"
+    supports_monthly_aggregates = True
+
+    @staticmethod
+    def _ids_param(resident_ids):
+        return bigquery.ArrayQueryParameter("resident_ids", "INT64", list(resident_ids))
+
+    def get_resident_by_login(self, serial_id: str, agency_id: int):
+        query = f"""
+        SELECT
+          resident_id,
+          resident_name,
+          agency_id,
+          agency_name,
+          codename,
+          bed_number,
+          note,
+          serial_id
+        FROM {RESIDENT_TABLE}
+        WHERE
+          serial_id = @serial_id
+          AND agency_id = @agency_id
+          AND note = 'C'
+          AND serial_id IS NOT NULL
+          AND serial_id != ''
+        LIMIT 1
+        """
+
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ScalarQueryParameter("serial_id", "STRING", serial_id),
+                bigquery.ScalarQueryParameter("agency_id", "INT64", agency_id),
+            ]
+        )
 
-    # 讀資料
-    try:
-        values = ws.get_all_values()
-    except Exception as e:
-        print(f"[WARN] 讀取試算表失敗：{e}")
+        rows = list(run_bq_query(query, job_config, "resident_by_login").result())
+        if not rows:
+            return None
+        return dict(rows[0])
+
+    def list_active_residents(self, agency_id=None):
+        agency_filter = "AND agency_id = @agency_id" if agency_id is not None else ""
+        query = f"""
+        SELECT
+          resident_id,
+          resident_name,
+          agency_id,
+          agency_name,
+          codename,
+          bed_number,
+          note,
+          serial_id
+        FROM {RESIDENT_TABLE}
+        WHERE
+          note = 'C'
+          AND serial_id IS NOT NULL
+          AND serial_id != ''
+          {agency_filter}
+        ORDER BY agency_id, resident_id
+        """
+
+        params = []
+        if agency_id is not None:
+            params.append(bigquery.ScalarQueryParameter("agency_id", "INT64", agency_id))
+        job_config = bigquery.QueryJobConfig(query_parameters=params)
+
+        rows = list(run_bq_query(query, job_config, "active_residents").result())
+        return [dict(r) for r in rows]
+
+    def latest_created_dates(self, resident_ids):
+        query = f"""
+        SELECT
+          resident_id,
+          DATE(MAX(created_at)) AS last_date
+        FROM {DAILY_TABLE}
+        WHERE
+          resident_id IN UNNEST(@resident_ids)
+        GROUP BY resident_id
+        """
+
+        job_config = bigquery.QueryJobConfig(query_parameters=[self._ids_param(resident_ids)])
+
+        result = {}
+        for r in run_bq_query(query, job_config, "latest_created_dates").result():
+            last_date = r["last_date"]
+            if last_date is None:
+                continue
+            if isinstance(last_date, datetime):
+                last_date = last_date.date()
+            result[r["resident_id"]] = last_date
         return result
 
-    if not values or len(values) < 2:
-        print("[WARN] 試算表沒有資料/只有表頭")
+    def _daily_job(self, resident_ids, start_date: date, end_date: date, columns=None):
+        """DAILY_TABLE 區間查詢，回傳 query job；columns 為 None 時撈全部欄位（d.*）"""
+        if columns is None:
+            select_list = "d.*"
+        else:
+            select_list = ", ".join(f"d.{c}" for c in ("resident_id",) + tuple(columns))
+        query = f"""
+        SELECT
+          {select_list}
+        FROM {DAILY_TABLE} AS d
+        WHERE
+          d.resident_id IN UNNEST(@resident_ids)
+          AND DATE(d.created_at) BETWEEN @start_date AND @end_date
+        ORDER BY d.resident_id, d.created_at
+        """
+
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                self._ids_param(resident_ids),
+                bigquery.ScalarQueryParameter("start_date", "DATE", start_date),
+                bigquery.ScalarQueryParameter("end_date", "DATE", end_date),
+            ]
+        )
+
+        return run_bq_query(query, job_config, "daily")
+
+    def daily_rows(self, resident_ids, start_date: date, end_date: date, columns=None):
+        job = self._daily_job(resident_ids, start_date, end_date, columns)
+        return [dict(r) for r in job.result()]
+
+    def daily_columns(self, resident_ids, start_date: date, end_date: date):
+        """優先走 Arrow（DailyColumns.split_arrow_by_resident），失敗就逐列讀取"""
+        job = self._daily_job(resident_ids, start_date, end_date, DAILY_REPORT_COLUMNS)
+        result = {rid: DailyColumns() for rid in resident_ids}
+
+        table = _fetch_arrow_table(job)
+        if table is not None:
+            try:
+                result.update(DailyColumns.split_arrow_by_resident(table))
+                return result
+            except Exception as e:
+                logger.warning("DailyColumns.from_arrow failed, fallback to row iteration: %s", e)
+
+        for r in job.result():
+            rid = r["resident_id"]
+            if rid not in result:
+                result[rid] = DailyColumns()
+            result[rid].append(r)
         return result
 
-    # 表頭正規化
-    raw_headers = values[0]
-    headers, seen = [], set()
-    for i, h in enumerate(raw_headers):
-        name = (h or "").strip().replace("\u3000", " ")
-        if not name:
-            name = f"__col{i}__"
-        if name in seen:
-            name = f"{name}_{i}"
-        seen.add(name)
-        headers.append(name)
-    print("[DEBUG] Headers:", headers)
+    def bed_turn_rows(self, resident_ids, start_date: date, end_date: date):
+        query = f"""
+        SELECT
+          resident_id,
+          DATE(created_at) AS d,
+          time_start,
+          SAFE_CAST(duration AS FLOAT64) AS duration_sec
+        FROM {DURATION_TABLE}
+        WHERE
+          resident_id IN UNNEST(@resident_ids)
+          AND bed_state = '09'
+          AND DATE(created_at) BETWEEN @start_date AND @end_date
+          AND (
+            SAFE_CAST(duration AS FLOAT64) IS NULL
+            OR SAFE_CAST(duration AS FLOAT64) <= 15 * 3600
+          )
+        ORDER BY resident_id, d, time_start
+        """
+
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                self._ids_param(resident_ids),
+                bigquery.ScalarQueryParameter("start_date", "DATE", start_date),
+                bigquery.ScalarQueryParameter("end_date", "DATE", end_date),
+            ]
+        )
 
-    # 目標（正規化）
-    target_serial_norm = _norm_text(serial_id)
-    target_agency_norm = _norm_digits(agency_id)
-    print(f"[DEBUG] Target serial='{target_serial_norm}', agency='{target_agency_norm}', ym={year}-{month:02d}")
+        return [dict(r) for r in run_bq_query(query, job_config, "bed_turns").result()]
+
+    def toc_slot_priorities(self, resident_id: int, start_dt: datetime, n_windows: int):
+        # 格子的切法：全域格號 = TIMESTAMP_DIFF(..., MINUTE) / 30，再減掉 48 * 第幾條
+        query = f"""
+        SELECT
+          window_index,
+          slot_index,
+          MAX(priority) AS max_p
+        FROM (
+          SELECT
+            DIV(TIMESTAMP_DIFF(detect_at, @start_ts, MINUTE), 1440) AS window_index,
+            CAST(TIMESTAMP_DIFF(detect_at, @start_ts, MINUTE) / 30 AS INT64)
+              - 48 * DIV(TIMESTAMP_DIFF(detect_at, @start_ts, MINUTE), 1440) AS slot_index,
+            CASE value
+              WHEN '08' THEN 3
+              WHEN '07' THEN 2
+              WHEN '00' THEN 1
+              ELSE 0
+            END AS priority
+          FROM {TOC_FIG_TABLE}
+          WHERE
+            resident_id = @resident_id
+            AND detect_at >= @start_ts
+            AND detect_at < @end_ts
+            AND value IN ('00', '07', '08')
+        )
+        GROUP BY window_index, slot_index
+        HAVING slot_index BETWEEN 0 AND 47
+        ORDER BY window_index, slot_index
+        """
+
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ScalarQueryParameter("resident_id", "INT64", resident_id),
+                bigquery.ScalarQueryParameter("start_ts", "TIMESTAMP", start_dt),
+                bigquery.ScalarQueryParameter("end_ts", "TIMESTAMP", start_dt + timedelta(days=n_windows)),
+            ]
+        )
 
-    # 儲存「最適合的離床列」與「最適合的臥床列」
-    active_row = None
-    bed_row = None
+        return list(run_bq_query(query, job_config, "toc_slots").result())
+
+    def monthly_daily_aggregates(self, resident_id: int, start_date: date, end_date: date):
+        query = f"""
+        WITH daily AS (
+          SELECT
+            DATE(created_at) AS d,
+            SAFE_CAST(night_on_bed AS FLOAT64) AS night_on_bed,
+            SAFE_CAST(night_sleep AS FLOAT64) AS night_sleep,
+            SAFE_CAST(sleep_respiration AS FLOAT64) AS sleep_respiration,
+            SAFE_CAST(day_on_bed AS FLOAT64) AS day_on_bed,
+            SAFE_CAST(asleep_leave AS FLOAT64) AS asleep_leave,
+            SAFE_CAST(asleep_leave_minute AS FLOAT64) AS asleep_leave_minute,
+            asleep_start
+          FROM {DAILY_TABLE}
+          WHERE
+            resident_id = @resident_id
+            AND DATE(created_at) BETWEEN @start_date AND @end_date
+        ),
+        valid AS (
+          SELECT *
+          FROM daily
+          WHERE
+            COALESCE(night_on_bed != 0, TRUE)
+            AND COALESCE(night_sleep != 0, TRUE)
+            AND COALESCE(sleep_respiration != 0, TRUE)
+            AND COALESCE(night_on_bed >= 2, TRUE)
+        )
+        SELECT
+          EXTRACT(YEAR FROM d) AS y,
+          EXTRACT(MONTH FROM d) AS m,
+          AVG(night_on_bed) AS avg_night_on_bed,
+          AVG(night_sleep) AS avg_night_sleep,
+          SUM(night_on_bed) AS sum_night_on_bed,
+          SUM(night_sleep) AS sum_night_sleep,
+          AVG(sleep_respiration) AS avg_sleep_resp,
+          AVG(day_on_bed) AS avg_day_on_bed,
+          AVG(asleep_leave) AS avg_asleep_leave,
+          AVG(asleep_leave_minute) AS avg_asleep_leave_min,
+          AVG(GREATEST(24 - day_on_bed - night_on_bed, 0)) AS avg_day_leave_total,
+          AVG(night_on_bed + day_on_bed) AS avg_onbed_total,
+          ARRAY_AGG(STRUCT(d, asleep_start, night_sleep) ORDER BY d) AS days
+        FROM valid
+        GROUP BY y, m
+        ORDER BY y, m
+        """
+
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ScalarQueryParameter("resident_id", "INT64", resident_id),
+                bigquery.ScalarQueryParameter("start_date", "DATE", start_date),
+                bigquery.ScalarQueryParameter("end_date", "DATE", end_date),
+            ]
+        )
 
-    month_candidates = []
+        return list(run_bq_query(query, job_config, "monthly_aggregates").result())
 
-    for row_vals in values[1:]:
-        row = {headers[i]: (row_vals[i] if i < len(row_vals) else "") for i in range(len(headers))}
-        y, mth = parse_month_cell(row.get("月份"))
-        if y != year or mth != month:
-            continue
+    def sheet_values(self, spreadsheet_id: str, gid: int):
+        return _read_google_sheet_values(spreadsheet_id, gid)
 
-        sheet_serial_raw = row.get("serial_id")
-        sheet_agency_raw = row.get("agency_id")
 
-        sheet_serial_norm = _norm_text(sheet_serial_raw)
-        sheet_agency_norm = _norm_digits(sheet_agency_raw)
+class RowSourceBackend(DataBackend):
+    """
+    把本機的資料列來源（LocalReplica / fake_data.SyntheticDataset）包成 DataBackend；
+    來源沒有 sheet_values 的話評語表改讀 Google Sheet
+    """
 
-        month_candidates.append((row.get("月份"), sheet_serial_raw, sheet_agency_raw,
-                                 sheet_serial_norm, sheet_agency_norm))
+    def __init__(self, name: str, source):
+        self.name = name
+        self.source = source
 
-        # serial 必須相等（正規化後）
-        if sheet_serial_norm != target_serial_norm:
-            continue
+    def _query(self, method: str, *args):
+        """呼叫來源的查詢方法，時間記成 Server-Timing 的 <name> 與 data_query_duration_seconds"""
+        with metrics.timed(self.name, DATA_QUERY_SECONDS, source=self.name, query=method):
+            return getattr(self.source, method)(*args)
 
-        # agency 規則：
-        #   - 試算表該欄空白 -> 視為通配（任何 agency 都可命中）
-        #   - 否則用純數字比對
-        if sheet_agency_norm and (sheet_agency_norm != target_agency_norm):
-            continue
+    def get_resident_by_login(self, serial_id: str, agency_id: int):
+        return self._query("get_resident_by_login", serial_id, agency_id)
 
-        # 走到這裡，代表「這一列是同一個人、同一個機構、同一個月」
-        # 檢查這列有沒有填離床欄位 / 臥床欄位
-        has_active = any(
-            (row.get(col) or "").strip()
-            for col in [
-                "本月總結_離床",
-                "月呼吸率紀錄_離床",
-                "每日休息時段_離床",
-                "每日上床休息時間_離床",
-                "夜間休息離床次數_離床",
-                "每月趨勢狀態_離床",
-                "月趨勢狀態總結_離床",
-            ]
-            if col in headers
-        )
+    def list_active_residents(self, agency_id=None):
+        return self._query("list_active_residents", agency_id)
 
-        has_bed = any(
-            (row.get(col) or "").strip()
-            for col in [
-                "本月總結_臥床",
-                "月呼吸率紀錄_臥床",
-                "夜間最床臥床時段_臥床",
-                "日間離床總時長_臥床",
-                "日夜翻身間隔_臥床",
-                "每月趨勢狀態_臥床",
-                "月趨勢狀態總結_臥床",
-            ]
-            if col in headers
-        )
+    def latest_created_dates(self, resident_ids):
+        return self._query("latest_created_dates", resident_ids)
 
-        if has_active and active_row is None:
-            active_row = row
-        if has_bed and bed_row is None:
-            bed_row = row
+    def daily_rows(self, resident_ids, start_date: date, end_date: date, columns=None):
+        # 本機來源本來就在記憶體 / 本機檔案裡，不需要另外挑欄位
+        return self._query("daily_rows", resident_ids, start_date, end_date)
 
-    print("[DEBUG] 當月候選列（前 5 筆）：")
-    for item in month_candidates[:5]:
-        print("  月份/serial/agency/raw_norm =", item)
+    def bed_turn_rows(self, resident_ids, start_date: date, end_date: date):
+        return self._query("bed_turn_rows", resident_ids, start_date, end_date)
 
-    if active_row is None and bed_row is None:
-        print("[WARN] 仍未命中評語列（請檢查上面 raw_norm 值是否與 Target 一致）")
-        return result
+    def toc_slot_priorities(self, resident_id: int, start_dt: datetime, n_windows: int):
+        return self._query("toc_slot_priorities", resident_id, start_dt, n_windows)
 
-    # 如果只有其中一種有，另一種就 fallback
-    if active_row is None:
-        active_row = bed_row
-    if bed_row is None:
-        bed_row = active_row
+    def sheet_values(self, spreadsheet_id: str, gid: int):
+        if hasattr(self.source, "sheet_values"):
+            return self.source.sheet_values(spreadsheet_id, gid)
+        return _read_google_sheet_values(spreadsheet_id, gid)
 
-    mapping = {
-        "active_summary": "本月總結_離床",
-        "active_resp": "月呼吸率紀錄_離床",
-        "active_sleep_range": "每日休息時段_離床",
-        "active_asleep_start": "每日上床休息時間_離床",
-        "active_night_leave": "夜間休息離床次數_離床",
-        "active_trend": "每月趨勢狀態_離床",
-        "active_trend_summary": "月趨勢狀態總結_離床",
-        "bed_summary": "本月總結_臥床",
-        "bed_resp": "月呼吸率紀錄_臥床",
-        "bed_night_bed": ["夜間最床臥床時段_臥床", "夜間最長臥床時長_臥床"],
-        "bed_leave_total": ["全日離床總時長_臥床", "日間離床總時長_臥床"],
-        "bed_turn": "日夜翻身間隔_臥床",
-        "bed_trend": "每月趨勢狀態_臥床",
-        "bed_trend_summary": "月趨勢狀態總結_臥床",
-    }
 
-    for key, col in mapping.items():
-        # active_* 用 active_row，bed_* 用 bed_row
-        src_row = active_row if key.startswith("active_") else bed_row
-        if src_row is None:
-            continue
+def create_data_backend(name: str) -> DataBackend:
+    if name == "bigquery":
+        return BigQueryBackend()
+    if name == "replica":
+        return RowSourceBackend("replica", LocalReplica(LOCAL_REPLICA_DB))
+    if name == "fake":
+        import fake_data
+        return RowSourceBackend("fake", fake_data.SyntheticDataset.from_env())
+    raise ValueError(f"未知的 DATA_SOURCE：{name}")
 
-        if isinstance(col, list):
-            for c in col:
-                if c not in headers:
-                    continue
-                val = (src_row.get(c) or "").strip()
-                if val:
-                    result[key] = val
-                    break
-        else:
-            if col not in headers:
-                continue
-            result[key] = (src_row.get(col) or "").strip()
 
-    print("[DEBUG] 命中評語鍵：", [k for k, v in result.items() if v])
-    return result
+_data_backend = None
+_data_backend_lock = threading.Lock()
 
-# ================== 4. Routes ==================
 
+def data_backend() -> DataBackend:
+    """目前使用的資料來源（依 DATA_SOURCE 建立一次）"""
+    global _data_backend
+    if _data_backend is None:
+        with _data_backend_lock:
+            if _data_backend is None:
+                _data_backend = create_data_backend(DATA_SOURCE)
+    return _data_backend
 
-@app.route("/")
-def index():
-    # 已登入就先到報表選擇頁，否則去 login
-    if "serial_id" in session:
-        return redirect(url_for("report_menu"))
-    return redirect(url_for("login"))
 
+def set_data_backend(backend: DataBackend):
+    """換掉資料來源（壓測 / 量測用），同時清掉評語表、住民與最新資料日快取"""
+    global _data_backend
+    with _data_backend_lock:
+        _data_backend = backend
+    invalidate_sheet_comment_cache()
+    invalidate_resident_caches()
 
-@app.route("/login", methods=["GET", "POST"])
-def login():
-    if request.method == "GET":
-        session.clear()
+
+# ---------- 查詢輔助函式（都經過 data_backend()） ----------
+
+# 共用快取裡：
+#   login:<serial_id>:<agency_id> → 住民 dict（找不到的不快取，新開的帳號馬上可以登入）
+#   latest:<resident_id>          → 最後一筆 daily 的日期，沒有資料存 None
+_CACHE_MISS = object()
+
+
+def get_resident_by_login(serial_id: str, agency_id: int):
     """
-    登入頁面：
-      帳號：serial_id（設備序號）
-      密碼：agency_id（客戶編號）
-    只有 note='C' 且 serial_id 不為空的住民可以登入
+    用 SERIAL_ID + AGENCY_ID 當帳密，從 resdient_agency_device 找住民：
+      - note 必須為 'C'
+      - serial_id 不得為空
+    找到就回傳 dict，找不到回傳 None；找到的結果快取 RESIDENT_CACHE_TTL 秒
     """
-    error = None
+    key = cache_key("login", serial_id, agency_id)
+    resident = app_cache().get(key)
+    if resident is None:
+        resident = data_backend().get_resident_by_login(serial_id, agency_id)
+        if resident is None:
+            return None
+        app_cache().set(key, resident, RESIDENT_CACHE_TTL)
+    return dict(resident)
 
-    if request.method == "POST":
-        serial_id = request.form.get("serial_id", "").strip()
-        agency_id_str = request.form.get("agency_id", "").strip()
 
-        if not serial_id or not agency_id_str:
-            error = "請輸入設備序號與客戶編號。"
+def list_active_residents(agency_id=None):
+    """
+    列出可登入的住民（note='C' 且 serial_id 不為空），
+    有給 agency_id 就只列該機構；回傳 list of dict
+    """
+    return data_backend().list_active_residents(agency_id)
+
+
+def _cached_latest_dates(resident_ids):
+    """{resident_id: date 或 None（沒有資料）}；快取裡沒有的住民一次查完再存進快取"""
+    cache = app_cache()
+    result, missing = {}, []
+    for rid in resident_ids:
+        value = cache.get(cache_key("latest", rid), _CACHE_MISS)
+        if value is _CACHE_MISS:
+            missing.append(rid)
         else:
-            try:
-                agency_id = int(agency_id_str)
-            except ValueError:
-                error = "客戶編號（AGENCY_ID）必須是數字。"
-            else:
-                resident = get_resident_by_login(serial_id, agency_id)
-                if resident is None:
-                    error = "帳號或密碼錯誤，或該帳號未開啟（note 不是 C / serial_id 為空）。"
-                else:
-                    # 登入成功，把必要資訊寫進 session
-                    session["serial_id"] = resident["serial_id"]
-                    session["agency_id"] = resident["agency_id"]
-                    session["resident_id"] = resident["resident_id"]
-                    session["resident_name"] = resident.get("resident_name") or ""
-                    session["agency_name"] = resident.get("agency_name") or ""
-                    session["codename"] = resident.get("codename") or ""
-                    session["bed_number"] = resident.get("bed_number") or ""
-                    return redirect(url_for("report_menu"))
+            result[rid] = value
+    if missing:
+        latest = data_backend().latest_created_dates(missing)
+        for rid in missing:
+            result[rid] = latest.get(rid)
+            cache.set(cache_key("latest", rid), result[rid], LATEST_DATE_CACHE_TTL)
+    return result
 
-    return render_template("login.html", error=error)
 
+def get_latest_created_date(resident_id: int) -> date:
+    """
+    回傳這個 resident 在 DAILY_TABLE 中最後一筆 created_at 的「日期」。
+    若沒有任何資料，回傳今天。
+    結果快取 LATEST_DATE_CACHE_TTL 秒：登入者自己的先看 session（不管落在哪個 worker 都不用查），
+    再看共用快取
+    """
+    in_session = (
+        has_request_context() and not _in_fetch_task.get() and session.get("resident_id") == resident_id
+    )
+    if in_session:
+        entry = session.get("latest_date")  # [ISO 日期或 None, 到期時間（epoch 秒）]
+        if entry and entry[1] > time_mod.time():
+            return date.fromisoformat(entry[0]) if entry[0] else date.today()
 
-@app.route("/logout")
-@login_required
-def logout():
-    session.clear()
-    return redirect(url_for("login"))
+    latest = _cached_latest_dates([resident_id])[resident_id]
+    if in_session:
+        session["latest_date"] = [latest.isoformat() if latest else None, time_mod.time() + LATEST_DATE_CACHE_TTL]
+    return latest or date.today()
 
 
-@app.route("/report_menu")
-@login_required
-def report_menu():
+def get_latest_created_dates(resident_ids):
     """
-    報表選單頁：
-      - 顯示住民資訊
-      - 提供選擇年份 / 月份
-      - 可以連到 月報 / 30日作息
+    一次查多位住民在 DAILY_TABLE 最後一筆 created_at 的日期，
+    回傳 {resident_id: date}；沒有資料的住民用今天（快取同 get_latest_created_date）
     """
-    resident_id = session["resident_id"]
+    if not resident_ids:
+        return {}
+    latest = _cached_latest_dates(resident_ids)
+    return {rid: latest[rid] or date.today() for rid in resident_ids}
 
-    resident_info = {
-        "resident_id": resident_id,
-        "resident_name": session.get("resident_name", ""),
-        "serial_id": session.get("serial_id", ""),
-        "agency_id": session.get("agency_id", ""),
-        "agency_name": session.get("agency_name", ""),
-        "codename": session.get("codename", ""),
-        "bed_number": session.get("bed_number", ""),
-    }
 
-    last_date = get_latest_created_date(resident_id)
-    default_year = last_date.year
-    default_month = last_date.month
+def invalidate_resident_caches(resident_id=None):
+    """
+    清掉登入查詢與最新資料日快取（資料有更新、想馬上生效時呼叫）；
+    給 resident_id 只清該住民的最新資料日。目前 request 的 session 也一起清
+    """
+    if resident_id is None:
+        app_cache().clear(cache_key("login", ""))
+        app_cache().clear(cache_key("latest", ""))
+    else:
+        app_cache().delete(cache_key("latest", resident_id))
+    if has_request_context() and (resident_id is None or session.get("resident_id") == resident_id):
+        session.pop("latest_date", None)
 
-    return render_template(
-        "report_menu.html",
-        resident=resident_info,
-        default_year=default_year,
-        default_month=default_month,
-    )
 
+def arrow_fetch_enabled() -> bool:
+    return BQ_ARROW_FETCH and pa is not None
 
-@app.route("/daily")
-@login_required
-def daily():
+
+def _fetch_arrow_table(job):
     """
-    已登入使用者的頁面：
-      1. 上方可以輸入 年份 + 月份，切換該月份資料
-      2. 若沒給 year/month，就自動抓「這位住民最後一筆 created_at 的年月」
-      3. 顯示 resdient_agency_device 的基本資料
-      4. 顯示該月份在 DAILY_TABLE 的資料（列表）
-      5. 顯示 Google Sheet「本月評語摘要」列表
+    把 query job 的結果整批取成 Arrow Table
+    （有裝 google-cloud-bigquery-storage 就走 Storage Read API，否則仍是 REST 但不建 Row 物件）；
+    沒開 / 沒裝 pyarrow / 取數失敗都回傳 None，呼叫端改走逐列讀取
     """
+    if not arrow_fetch_enabled():
+        return None
+    try:
+        return job.result().to_arrow(create_bqstorage_client=True)
+    except Exception as e:
+        logger.warning("Arrow fetch failed, fallback to row iteration: %s", e)
+        return None
 
-    resident_id = session["resident_id"]
 
-    # 讀取 query string 的 year / month，例如 /daily?year=2025&month=10
-    arg_year = request.args.get("year", type=int)
-    arg_month = request.args.get("month", type=int)
+def get_daily_for_resident_by_range(resident_id: int, start_date: date, end_date: date):
+    """
+    撈某個 resident 在指定日期區間的所有紀錄（全部欄位）
+    提供 /daily 列表用；報表計算請用 get_daily_columns_for_resident_by_range
+    """
+    return data_backend().daily_rows([resident_id], start_date, end_date)
 
-    if arg_year and arg_month and 1 <= arg_month <= 12:
-        year, month = arg_year, arg_month
-    else:
-        # 沒指定或有誤 → 用這個 resident 的最新一筆 created_at 當預設年月
-        last_date = get_latest_created_date(resident_id)
-        year, month = last_date.year, last_date.month
 
-    # 該月份的起訖日期
-    start_date = date(year, month, 1)
-    if month == 12:
-        end_date = date(year + 1, 1, 1) - timedelta(days=1)
-    else:
-        end_date = date(year, month + 1, 1) - timedelta(days=1)
+def cached_range_query(kind: str, resident_id: int, start_date: date, end_date: date, fetch,
+                       latest_date=None):
+    """
+    單一住民區間查詢：結果放進共用快取，所有 worker 共用。
+    key 帶資料版本（用區間結束那個月的快照資料版本，見 snapshot_data_version），
+    有新的 daily 進來就換 key，不會拿到舊資料；拿到的結果不要修改
+    latest_date：最新資料日；沒給就查（會用到 session），在 submit_fetch 的 task 裡呼叫時要先查好傳進來
+    """
+    if latest_date is None:
+        latest_date = get_latest_created_date(resident_id)
+    version = snapshot_data_version(end_date.year, end_date.month, latest_date)
+    key = cache_key("range", kind, resident_id, start_date, end_date, version)
+    return app_cache().get_or_set(key, fetch, QUERY_CACHE_TTL)
+
+
+def get_daily_columns_for_resident_by_range(resident_id: int, start_date: date, end_date: date,
+                                            latest_date=None):
+    """撈某個 resident 在指定日期區間、報表需要的欄位（DAILY_REPORT_COLUMNS），回傳 DailyColumns"""
+    return cached_range_query(
+        "daily", resident_id, start_date, end_date,
+        lambda: data_backend().daily_columns([resident_id], start_date, end_date)[resident_id],
+        latest_date,
+    )
 
-    resident_info = {
-        "resident_id": resident_id,
-        "resident_name": session.get("resident_name", ""),
-        "serial_id": session.get("serial_id", ""),
-        "agency_id": session.get("agency_id", ""),
-        "agency_name": session.get("agency_name", ""),
-        "codename": session.get("codename", ""),
-        "bed_number": session.get("bed_number", ""),
-    }
 
-    daily_list = get_daily_for_resident_by_range(resident_id, start_date, end_date)
+def get_daily_for_residents_by_range(resident_ids, start_date: date, end_date: date):
+    """
+    一次撈多位住民在指定日期區間、報表需要的 daily 欄位（只掃一次 DAILY_TABLE），
+    回傳 {resident_id: DailyColumns}
+    """
+    if not resident_ids:
+        return {}
+    return data_backend().daily_columns(resident_ids, start_date, end_date)
 
-    print(f"[DEBUG] /daily resident_id={resident_id} range={start_date}~{end_date} rows={len(daily_list)}")
 
-    # ---------- 組 HTML ----------
+def get_30min_slots_for_range(resident_id: int, first_date: date, last_date: date, latest_date=None):
+    """
+    從 N_bq_toC_fig 一次撈出 first_date ~ last_date 每一天的作息資料（只跑一個 query）：
+      - 第 i 條的時間範圍：(first_date + i 天) 12:00 ~ (first_date + i + 1 天) 12:00
+      - 每條切成 30 分鐘一格，共 48 格
+      - 同一格若有多筆，優先順序：08 > 07 > 00
+      - 回傳 (天數) x 48 的 list，每格可能是 '08' / '07' / '00' / 'none'
+    """
+    n_windows = (last_date - first_date).days + 1
+    if n_windows <= 0:
+        return []
+
+    start_dt = datetime.combine(first_date, time(12, 0, 0))
+    # 最後一條畫到 last_date 隔天 12:00，資料版本以隔天判斷
+    rows = cached_range_query(
+        "toc", resident_id, first_date, last_date + timedelta(days=1),
+        lambda: data_backend().toc_slot_priorities(resident_id, start_dt, n_windows),
+        latest_date,
+    )
 
-    html = []
+    # 預設每條 48 格都沒有資料
+    matrix = [["none"] * 48 for _ in range(n_windows)]
+    priority_to_value = {3: "08", 2: "07", 1: "00"}
 
-    # 月份選擇表單
-    html.append("<h2>月份選擇</h2>")
-    html.append('<form method="get" action="/daily">')
-    html.append(
-        '年份：<input type="number" name="year" value="{}" style="width:80px;">'.format(
-            year
-        )
-    )
-    html.append(
-        '　月份：<input type="number" name="month" min="1" max="12" value="{}" style="width:60px;">'.format(
-            month
-        )
-    )
-    html.append('　<button type="submit">切換月份</button>')
-    html.append("</form>")
+    for r in rows:
+        w = r["window_index"]
+        idx = r["slot_index"]
+        val = priority_to_value.get(r["max_p"])
+        if val is None:
+            continue
+        if 0 <= w < n_windows and 0 <= idx < 48:
+            matrix[w][idx] = val
 
-    # 同月份月報連結
-    report_url = url_for("report", year=year, month=month)
-    html.append(f'<p><a href="{report_url}">查看 {year}-{month:02d} 月月報</a></p>')
+    return matrix
 
-    # 住民基本資料
-    html.append("<h2>住民基本資料</h2>")
-    html.append('<table border="1" cellspacing="0" cellpadding="4">')
-    html.append("<tr><th>欄位</th><th>值</th></tr>")
-    for k, v in resident_info.items():
-        cell = "" if v is None else str(v)
-        html.append(f"<tr><td>{k}</td><td>{cell}</td></tr>")
-    html.append("</table>")
 
-    # ======= 讀取當月評語（來自 Google Sheet），直接列為摘要清單 =======
-    month_comments = get_month_comments_from_sheet(
-        serial_id=session["serial_id"],
-        agency_id=session["agency_id"],
-        year=year,
-        month=month
+def get_30min_slots_for_date(resident_id: int, day_date: date):
+    """
+    從 N_bq_toC_fig 撈出某一天的作息資料：
+      - 時間範圍：day_date 12:00 ~ (day_date + 1 天) 12:00
+      - 切成 30 分鐘一格，共 48 格
+      - 同一格若有多筆，優先順序：08 > 07 > 00
+      - 回傳長度 48 的 list，每格可能是 '08' / '07' / '00' / 'none'
+    要一次看很多天請改用 get_30min_slots_for_range（只跑一個 query）
+    """
+    return get_30min_slots_for_range(resident_id, day_date, day_date)[0]
+
+
+def get_bed_turn_rows_by_range(resident_id: int, start_date: date, end_date: date, latest_date=None):
+    """
+    從 N_bq_Duration24 撈某個 resident 在指定日期區間 bed_state='09' 的段落：
+      - duration > 15 小時的段落不列入（跟翻身 / 最長臥床的規則一致）
+      - 回傳 [{"d": date, "time_start": ..., "duration_sec": float|None}, ...]
+    「每天 duration 最大值」與「翻身時間」都從這一份資料算，只跑一個 query
+    """
+    return cached_range_query(
+        "turns", resident_id, start_date, end_date,
+        lambda: get_bed_turn_rows_for_residents_by_range([resident_id], start_date, end_date)[resident_id],
+        latest_date,
     )
 
-    # 顯示評語（為了易讀，做個中文標題對照）
-    label_map = [
-        ("active_summary",       "（離床）本月總結"),
-        ("active_resp",          "（離床）月呼吸率紀錄"),
-        ("active_sleep_range",   "（離床）每日休息時段"),
-        ("active_asleep_start",  "（離床）每日上床休息時間"),
-        ("active_night_leave",   "（離床）夜間休息離床次數"),
-        ("active_trend",         "（離床）每月趨勢狀態"),
-        ("active_trend_summary", "（離床）月趨勢狀態總結"),
-        ("bed_summary",          "（臥床）本月總結"),
-        ("bed_resp",             "（臥床）月呼吸率紀錄"),
-        ("bed_night_bed",        "（臥床）夜間最長臥床時長"),
-        ("bed_leave_total",      "（臥床）日間離床總時長"),
-        ("bed_turn",             "（臥床）日夜翻身間隔"),
-        ("bed_trend",            "（臥床）每月趨勢狀態"),
-        ("bed_trend_summary",    "（臥床）月趨勢狀態總結"),
-    ]
-
-    html.append("<h2>本月評語摘要</h2>")
-    any_comment = False
-    html.append('<ul style="line-height:1.6">')
-    for key, title in label_map:
-        text = (month_comments.get(key) or "").strip()
-        if text:
-            any_comment = True
-            text_html = text.replace("\n", "<br>")
-            html.append(f"<li><b>{title}</b>：{text_html}</li>")
-    html.append("</ul>")
-    if not any_comment:
-        html.append("<p>（本月無對應評語或 Google Sheet 未填寫。）</p>")
-
-    # 該月份 daily
-    html.append(f"<h2>{year}-{month:02d} DAILY 資料（{start_date} ~ {end_date}）</h2>")
-
-    if not daily_list:
-        html.append("<p>這個月份沒有任何紀錄。（DEBUG: rows=0）</p>")
-    else:
-        fields = list(daily_list[0].keys())
-        html.append('<table border="1" cellspacing="0" cellpadding="4">')
-        html.append("<tr>")
-        for name in fields:
-            html.append(f"<th>{name}</th>")
-        html.append("</tr>")
-        for row in daily_list:
-            html.append("<tr>")
-            for name in fields:
-                value = row.get(name)
-                cell = "" if value is None else str(value)
-                html.append(f"<td>{cell}</td>")
-            html.append("</tr>")
-        html.append("</table>")
-
-    html.append('<p><a href="/logout">登出</a></p>')
 
-    return "".join(html)
+def get_bed_turn_rows_for_residents_by_range(resident_ids, start_date: date, end_date: date):
+    """
+    get_bed_turn_rows_by_range 的多住民版（只掃一次 N_bq_Duration24），
+    回傳 {resident_id: [{"d", "time_start", "duration_sec"}, ...]}
+    """
+    result = {rid: [] for rid in resident_ids}
+    if not resident_ids:
+        return result
+    for r in data_backend().bed_turn_rows(resident_ids, start_date, end_date):
+        result.setdefault(r.pop("resident_id"), []).append(r)
+    return result
 
 
-@app.route("/report")
-@login_required
-def report():
+def build_duration_max_map(turn_rows, start_date: date, end_date: date):
     """
-    月報頁：
-      - 依照 query string year/month 顯示該月份資料
-      - 若沒給 year/month，就用這個 resident 最新一筆 created_at 的年月
-      - 判斷本月是「臥床報表」或「離床報表」
-      - 只使用「有效天」計算平均與畫圖
-        (night_on_bed / night_sleep / sleep_respiration 任何一個為 0 的天會被排除)
-      - 夜間最長臥床時長：從 N_bq_Duration24 找出 bed_state='09'、
-        每天 duration 最大值（秒），並轉成「小時」
-      - 全日離床總時長：24 - day_on_bed - night_on_bed
-      - 日夜平均翻身間隔：從 N_bq_Duration24 的翻身時間（time_start）計算
-      - 評語：從 Google Sheet 讀取
+    每天 bed_state='09' duration 最大值（秒→小時），
+    回傳 {'YYYY-MM-DD': hours}；該天的 duration 全部是 NULL 時值為 None
     """
+    duration_map = {}
+    for r in turn_rows:
+        d_val = r["d"]
+        if isinstance(d_val, datetime):
+            d_val = d_val.date()
+        if d_val < start_date or d_val > end_date:
+            continue
+        key = d_val.strftime("%Y-%m-%d")
+        try:
+            sec = float(r["duration_sec"]) if r["duration_sec"] is not None else None
+        except (TypeError, ValueError):
+            sec = None
+        hours = sec / 3600.0 if sec is not None else None
+        prev = duration_map.get(key)
+        if key not in duration_map or (hours is not None and (prev is None or hours > prev)):
+            duration_map[key] = hours
+    return duration_map
 
-    resident_id = session["resident_id"]
-    serial_id = session.get("serial_id", "")
-    agency_id = session.get("agency_id", None)
 
-    arg_year = request.args.get("year", type=int)
-    arg_month = request.args.get("month", type=int)
+# 時間字串可能的格式（BigQuery 回傳字串、本機副本存文字時）；
+# 翻身時間（time_start）只接受「時:分[:秒]」，上床時間（asleep_start）也可能帶日期
+TIME_FORMATS = ("%H:%M:%S", "%H:%M")
+DATETIME_TIME_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S") + TIME_FORMATS
 
-    if arg_year and arg_month and 1 <= arg_month <= 12:
-        report_year, report_month = arg_year, arg_month
-    else:
-        last_date = get_latest_created_date(resident_id)
-        report_year, report_month = last_date.year, last_date.month
 
-    # 查詢範圍：該月份 1 號 ~ 最後一天
-    start_date = date(report_year, report_month, 1)
-    if report_month == 12:
-        end_date = date(report_year + 1, 1, 1) - timedelta(days=1)
+def _fixed_width_time(s: str):
+    """HH:MM:SS / HH:MM（補 0 的固定寬度）直接切字串轉成 time；不是這兩種格式或數值不合法回傳 None"""
+    n = len(s)
+    if not s.isascii():
+        return None
+    if n == 8 and s[2] == ":" and s[5] == ":" and s[:2].isdigit() and s[3:5].isdigit() and s[6:].isdigit():
+        h, m, sec = int(s[:2]), int(s[3:5]), int(s[6:])
+    elif n == 5 and s[2] == ":" and s[:2].isdigit() and s[3:].isdigit():
+        h, m, sec = int(s[:2]), int(s[3:]), 0
     else:
-        end_date = date(report_year, report_month + 1, 1) - timedelta(days=1)
-    end_date_plus1 = end_date + timedelta(days=1)
-
-    # 住民資訊（直接從 session 拿）
-    resident_info = {
-        "resident_id": resident_id,
-        "resident_name": session.get("resident_name", ""),
-        "serial_id": serial_id,
-        "agency_id": agency_id,
-        "agency_name": session.get("agency_name", ""),
-        "codename": session.get("codename", ""),
-        "bed_number": session.get("bed_number", ""),
-    }
-
-    # ========== 讀 Google Sheet 評語 ==========
-    month_comments = get_month_comments_from_sheet(serial_id, agency_id, report_year, report_month)
+        return None
+    if h < 24 and m < 60 and sec < 60:
+        return time(h, m, sec)
+    return None
 
-    # 撈這個住民該月份的 daily 資料
-    query = f"""
-    SELECT
-      d.*
-    FROM {DAILY_TABLE} AS d
-    WHERE
-      d.resident_id = @resident_id
-      AND DATE(d.created_at) BETWEEN @start_date AND @end_date
-    ORDER BY d.created_at
-    """
-
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("resident_id", "INT64", resident_id),
-            bigquery.ScalarQueryParameter("start_date", "DATE", start_date),
-            bigquery.ScalarQueryParameter("end_date", "DATE", end_date),
-        ]
-    )
 
-    rows = list(bq_client.query(query, job_config=job_config).result())
-    daily_list = [dict(r) for r in rows]
+@lru_cache(maxsize=16384)
+def _parse_time_text(s: str, with_date: bool):
+    """
+    parse_time_of_day 的字串版（同一個字串只解析一次，結果記在 lru_cache）：
+      - 先走固定寬度格式 HH:MM:SS / HH:MM / YYYY-MM-DD[ T]HH:MM:SS 的快速路徑
+      - 快速路徑不適用（例如沒補 0）再依序試 strptime，規則跟原本一樣
+    """
+    if with_date and len(s) == 19 and s.isascii() and s[4] == "-" and s[7] == "-" and s[10] in " T":
+        t = _fixed_width_time(s[11:])
+        if t is not None and s[:4].isdigit() and s[5:7].isdigit() and s[8:10].isdigit():
+            try:
+                date(int(s[:4]), int(s[5:7]), int(s[8:10]))
+                return t
+            except ValueError:
+                pass
+    else:
+        t = _fixed_width_time(s)
+        if t is not None:
+            return t
 
-    print(f"[DEBUG] /report resident_id={resident_id} range={start_date}~{end_date} rows={len(daily_list)}")
+    for fmt in (DATETIME_TIME_FORMATS if with_date else TIME_FORMATS):
+        try:
+            return datetime.strptime(s, fmt).time()
+        except ValueError:
+            continue
+    return None
 
-    # ====== 撈 N_bq_Duration24：bed_state='09'，每天 duration 最大值（秒→小時）新增 15 小時上限條件 ======
-    duration_query = f"""
-    SELECT
-      DATE(created_at) AS d,
-      MAX(SAFE_CAST(duration AS FLOAT64)) / 3600.0 AS max_duration_hours
-    FROM {DURATION_TABLE}
-    WHERE
-      resident_id = @resident_id
-      AND bed_state = '09'
-      AND DATE(created_at) BETWEEN @start_date AND @end_date
-      -- ★ 新增：只保留 duration <= 15 小時 的段落
-      AND (
-        SAFE_CAST(duration AS FLOAT64) IS NULL
-        OR SAFE_CAST(duration AS FLOAT64) <= 15 * 3600
-      )
-    GROUP BY d
-    """
-
-    duration_job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("resident_id", "INT64", resident_id),
-            bigquery.ScalarQueryParameter("start_date", "DATE", start_date),
-            bigquery.ScalarQueryParameter("end_date", "DATE", end_date),
-        ]
-    )
 
-    duration_rows = list(bq_client.query(duration_query, job_config=duration_job_config).result())
-    duration_map = {}
-    for r in duration_rows:
-        d_val = r["d"]
-        if isinstance(d_val, datetime):
-            d_val = d_val.date()
-        key = d_val.strftime("%Y-%m-%d")
-        dur = r["max_duration_hours"]
-        try:
-            dur = float(dur) if dur is not None else None
-        except (TypeError, ValueError):
-            dur = None
-        duration_map[key] = dur
+def parse_time_of_day(value, with_date: bool = True):
+    """
+    把 asleep_start / time_start 轉成 time；無法解析回傳 None
+      - datetime → 取時間；time → 原值
+      - 字串（或其他型別轉成字串）→ _parse_time_text（有快取）
+      - with_date=False 時字串只接受 HH:MM:SS / HH:MM（翻身時間）
+    """
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.time()
+    if isinstance(value, time):
+        return value
+    return _parse_time_text(str(value), with_date)
 
-    # ====== 撈 N_bq_Duration24：bed_state='09' 的翻身時間，用來算日夜翻身間隔 ======
-    turn_query = f"""
-    SELECT
-      DATE(created_at) AS d,
-      time_start
-    FROM {DURATION_TABLE}
-    WHERE
-      resident_id = @resident_id
-      AND bed_state = '09'
-      AND DATE(created_at) BETWEEN @start_date AND @end_date_plus1
-      -- ★ 新增：duration > 15 小時的段落，不參與任何翻身計算
-      AND (
-        SAFE_CAST(duration AS FLOAT64) IS NULL
-        OR SAFE_CAST(duration AS FLOAT64) <= 15 * 3600
-      )
-    ORDER BY d, time_start
-    """
-
-    turn_job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("resident_id", "INT64", resident_id),
-            bigquery.ScalarQueryParameter("start_date", "DATE", start_date),
-            bigquery.ScalarQueryParameter("end_date_plus1", "DATE", end_date_plus1),
-        ]
-    )
 
-    turn_rows = list(bq_client.query(turn_query, job_config=turn_job_config).result())
+def build_flip_datetimes(turn_rows):
+    """把 N_bq_Duration24 的 (d, time_start) 轉成翻身時間 datetime list（依原順序）"""
     flip_datetimes = []
     for r in turn_rows:
         d_val = r["d"]
         if isinstance(d_val, datetime):
             d_val = d_val.date()
-        date_part = d_val
-        t_val = r["time_start"]
-
-        # 轉成 time
-        if isinstance(t_val, datetime):
-            t_obj = t_val.time()
-        elif isinstance(t_val, time):
-            t_obj = t_val
-        else:
-            s = str(t_val)
-            t_obj = None
-            for fmt in ("%H:%M:%S", "%H:%M"):
-                try:
-                    t_obj = datetime.strptime(s, fmt).time()
-                    break
-                except ValueError:
-                    continue
-            if t_obj is None:
-                continue
+        t_obj = parse_time_of_day(r["time_start"], with_date=False)
+        if t_obj is None:
+            continue
 
-        flip_dt = datetime.combine(date_part, t_obj)
-        flip_datetimes.append(flip_dt)
+        flip_datetimes.append(datetime.combine(d_val, t_obj))
+    return flip_datetimes
+
+
+# 報表計算會用到的 DAILY_TABLE 欄位（其他欄位只有 /daily 原始資料表會顯示）
+DAILY_REPORT_COLUMNS = (
+    "created_at",
+    "night_on_bed",
+    "night_sleep",
+    "sleep_respiration",
+    "day_on_bed",
+    "day_leave",
+    "asleep_leave",
+    "asleep_leave_minute",
+    "asleep_start",
+    "respiration_analy",
+)
 
-    # ====== 把 daily 資料先對齊到「這個月的每一天」 ======
-    date_to_row = {}
-    for row in daily_list:
-        key = get_date_key(row.get("created_at"))
-        if key:
-            date_to_row[key] = row  # 假設一天最多一筆
 
-    # 準備圖表用 array
-    labels              = []
-    resp_rate           = []  # 每日呼吸紀錄
-    night_sleep_range   = []  # 每日夜間休息時段 [start_hour, end_hour]
-    asleep_start_hours  = []  # 每日上床時間
-    leave_bed_total     = []  # 全日離床總時長
-    night_turn_interval = []  # 夜間翻身平均間隔（分鐘）
-    day_turn_interval   = []  # 日間翻身平均間隔（分鐘）
-    night_bed_hours     = []  # 夜間最長臥床時長 (from N_bq_Duration24)
-    night_leave_count   = []  # 夜間離床次數（使用 night_leave）
-
-    # 呼吸評分用：每一天的 std_dev
-    rr_std_list         = []
-
-    # 作息品質評分用
-    night_sleep_for_score = []  # 每天的 night_sleep（有效天）
-    night_leave_for_score = []  # 每天的 night_leave（有效天）
-    sleep_eff_for_score   = []  # 每天的 night_sleep / night_on_bed（有效天）
-
-    # ====== 用來判斷「臥床 / 離床」的累計 ======
-    sum_day_leave   = 0.0
-    cnt_day_leave   = 0
-    sum_onbed_total = 0.0  # (night_on_bed + day_on_bed)
-    cnt_onbed_total = 0
-
-    # 小工具：安全轉 float
-    def to_float(x):
-        if x is None:
-            return None
-        try:
-            return float(x)
-        except (TypeError, ValueError):
-            return None
+class DailyColumns:
+    """
+    DAILY_TABLE 資料的欄式容器（取代 list of dict）：
+      - 數值欄位各自是一條 array('d')，沒有值 / 無法轉換 → NaN
+      - ordinals：每一筆的日期（date.toordinal()），array('l')
+      - asleep_start 保留原始值（格式很多種，由使用的地方再解析）
+      - respiration_analy 只保留解析出來的 std_dev
+    同一天若有多筆，index_of 回傳最後一筆（跟以前 date_to_row 的做法一樣），
+    iter_positions 則會走過每一筆
+    """
 
-    # 逐日處理
-    d = start_date
-    while d <= end_date:
-        key = d.strftime("%Y-%m-%d")
-        labels.append(key)
-        row = date_to_row.get(key)
-
-        if row is None:
-            # 完全沒 daily 資料的日子 → 全部 None
-            resp_rate.append(None)
-            night_sleep_range.append(None)
-            asleep_start_hours.append(None)
-            leave_bed_total.append(None)
-            night_turn_interval.append(None)
-            day_turn_interval.append(None)
-            night_bed_hours.append(None)
-            night_leave_count.append(None)
-            d += timedelta(days=1)
-            continue
+    NUMERIC_COLUMNS = (
+        "night_on_bed",
+        "night_sleep",
+        "sleep_respiration",
+        "day_on_bed",
+        "day_leave",
+        "asleep_leave",
+        "asleep_leave_minute",
+        "std_dev",
+    )
 
-        # 先拿出會影響「有效 / 無效」判斷的欄位
-        v_night_on_bed = to_float(row.get("night_on_bed"))
-        v_night_sleep  = to_float(row.get("night_sleep"))
-        v_resp         = to_float(row.get("sleep_respiration"))
-        v_day_on_bed   = to_float(row.get("day_on_bed"))
-
-        # 判斷這天是不是要整天丟掉
-        invalid_day = False
-
-        # 規則 1：night_on_bed / night_sleep / resp 任一為 0 → 不列入
-        for v in (v_night_on_bed, v_night_sleep, v_resp):
-            if v is not None and v == 0:
-                invalid_day = True
-                break
-
-        # 規則 2：night_on_bed < 2 小時 → 也不列入
-        if not invalid_day and v_night_on_bed is not None and v_night_on_bed < 2:
-            invalid_day = True
-
-        if invalid_day:
-            # 這一天不要顯示也不算平均
-            resp_rate.append(None)
-            night_sleep_range.append(None)
-            asleep_start_hours.append(None)
-            leave_bed_total.append(None)
-            night_turn_interval.append(None)
-            day_turn_interval.append(None)
-            night_bed_hours.append(None)
-            night_leave_count.append(None)
-            d += timedelta(days=1)
-            continue
+    __slots__ = ("ordinals", "asleep_start", "_index") + NUMERIC_COLUMNS
+
+    def __init__(self):
+        self.ordinals = array("l")
+        self.asleep_start = []
+        self._index = {}
+        for name in self.NUMERIC_COLUMNS:
+            setattr(self, name, array("d"))
+
+    @classmethod
+    def from_rows(cls, rows):
+        """從 BigQuery Row 或 dict 的 iterable 建立（created_at 無法解析的列會略過）"""
+        cols = cls()
+        for row in rows:
+            cols.append(row)
+        return cols
+
+    @classmethod
+    def from_arrow(cls, table):
+        """
+        從 Arrow Table（欄位同 DAILY_REPORT_COLUMNS）建立：
+        數值欄位直接從 Arrow 的 float64 buffer 複製，不產生逐列的 Python 物件；
+        只有 asleep_start（保留原值）與 respiration_analy（解析 std_dev）需要逐筆處理
+        """
+        cols = cls()
+        table = table.filter(pc.is_valid(table.column("created_at")))
+        if table.num_rows == 0:
+            return cols
+
+        cols.ordinals = _arrow_date_ordinals(table.column("created_at"))
+        for pos, ordinal in enumerate(cols.ordinals):
+            cols._index[ordinal] = pos
+
+        for name in cls.NUMERIC_COLUMNS:
+            if name == "std_dev":
+                values = (parse_std_dev(v) for v in table.column("respiration_analy").to_pylist())
+                cols.std_dev = array("d", (report_scoring.NAN if v is None else v for v in values))
+            else:
+                setattr(cols, name, _arrow_float_column(table.column(name)))
+        cols.asleep_start = table.column("asleep_start").to_pylist()
+        return cols
+
+    @classmethod
+    def split_arrow_by_resident(cls, table):
+        """
+        多住民的 Arrow Table（依 resident_id 排序）→ {resident_id: DailyColumns}；
+        每位住民用 table.slice 切出來，不複製資料
+        """
+        result = {}
+        rids = array("q")
+        for chunk in pc.cast(table.column("resident_id"), pa.int64()).chunks:
+            rids.frombytes(_arrow_value_bytes(chunk, 8))
+
+        start = 0
+        for i in range(1, len(rids) + 1):
+            if i == len(rids) or rids[i] != rids[start]:
+                result[rids[start]] = cls.from_arrow(table.slice(start, i - start))
+                start = i
+        return result
 
-        # -------- 這裡開始是「有效天」 --------
+    def append(self, row):
+        d_val = get_row_date(row)
+        if d_val is None:
+            return
+        pos = len(self.ordinals)
+        ordinal = d_val.toordinal()
+        self.ordinals.append(ordinal)
+        self._index[ordinal] = pos
+
+        for name in self.NUMERIC_COLUMNS:
+            if name == "std_dev":
+                v = parse_std_dev(row.get("respiration_analy"))
+            else:
+                v = to_float_or_none(row.get(name))
+            getattr(self, name).append(report_scoring.NAN if v is None else v)
+        self.asleep_start.append(row.get("asleep_start"))
 
-        # 作息品質評分用：夜間休息時間
-        if v_night_sleep is not None:
-            night_sleep_for_score.append(v_night_sleep)
+    def __len__(self):
+        return len(self.ordinals)
 
-        # 0. 解析呼吸變異 std_dev（respiration_analy JSON 欄位）
-        std_val = None
-        try:
-            resp_analy_raw = row.get("respiration_analy")
-            if resp_analy_raw:
-                if isinstance(resp_analy_raw, str):
-                    analy_obj = json.loads(resp_analy_raw)
-                else:
-                    analy_obj = resp_analy_raw  # BigQuery STRUCT 可能直接是 dict-like
-                std_val = analy_obj.get("std_dev")
-                if std_val is not None:
-                    std_val = float(std_val)
-        except Exception:
-            std_val = None
-        if std_val is not None:
-            rr_std_list.append(std_val)
+    def date_at(self, pos: int) -> date:
+        return date.fromordinal(self.ordinals[pos])
 
-        # 1. 每日呼吸紀錄
-        resp_rate.append(v_resp if v_resp is not None else None)
+    def index_of(self, d_val: date):
+        """某一天在容器裡的位置；沒有資料回傳 None"""
+        return self._index.get(d_val.toordinal())
 
-        # 2. 上床時間（轉成 20~32 小時）
-        start_h = convert_asleep_start_to_hour(row.get("asleep_start"))
-        asleep_start_hours.append(start_h)
+    def iter_positions(self):
+        return range(len(self.ordinals))
 
-        # 2b. 夜間休息時段（起點 = asleep_start, 終點 = asleep_start + night_sleep）
-        if start_h is None or v_night_sleep is None:
-            night_sleep_range.append(None)
-        else:
-            night_sleep_range.append([start_h, start_h + v_night_sleep])
+    def value(self, name: str, pos: int):
+        """取出某一格數值；NaN 轉回 None"""
+        v = getattr(self, name)[pos]
+        return None if v != v else v
 
-        # 3. 全日離床總時長 = 24 - day_on_bed - night_on_bed
-        if v_day_on_bed is not None and v_night_on_bed is not None:
-            total_on_bed = v_day_on_bed + v_night_on_bed
-            total_leave = 24.0 - total_on_bed
-            if total_leave < 0:
-                total_leave = 0.0
-            leave_bed_total.append(total_leave)
-        else:
-            leave_bed_total.append(None)
 
-        # 作息品質評分用：休息效率 night_sleep / night_on_bed
-        if (
-            v_night_sleep is not None
-            and v_night_on_bed is not None
-            and v_night_on_bed > 0
-        ):
-            sleep_eff_for_score.append(v_night_sleep / v_night_on_bed)
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
 
-        # 4. 日夜翻身平均間隔（分鐘）──來自 N_bq_Duration24
-        night_start_dt, night_end_dt = build_night_interval_for_day(
-            d, row.get("asleep_start"), v_night_sleep
-        )
-        night_avg_min, day_avg_min = compute_day_night_avg_intervals(
-            d, night_start_dt, night_end_dt, flip_datetimes
-        )
 
-        # ★ 新增：若夜間 / 日間翻身平均間隔 > 720 分鐘，視為異常，不列入顯示與評分
-        if night_avg_min is not None and night_avg_min > 720:
-            night_avg_min = None
-        if day_avg_min is not None and day_avg_min > 720:
-            day_avg_min = None
+def _arrow_value_bytes(chunk, width: int):
+    """Arrow 定長欄位（沒有 null）這個 chunk 的 values buffer"""
+    buf = memoryview(chunk.buffers()[1])
+    return buf[chunk.offset * width:(chunk.offset + len(chunk)) * width]
 
-        night_turn_interval.append(night_avg_min)
-        day_turn_interval.append(day_avg_min)
 
-        # 5. 夜間最長臥床時長 (from N_bq_Duration24 每天 duration 最大值，小時)
-        v_dur = duration_map.get(key)
-        night_bed_hours.append(v_dur if v_dur is not None else 0)
+def _arrow_float_column(column) -> array:
+    """Arrow 欄位 → array('d')，null 轉成 NaN；字串欄位無法整欄轉型時才逐筆轉換"""
+    try:
+        column = pc.cast(column, pa.float64())
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        values = (to_float_or_none(v) for v in column.to_pylist())
+        return array("d", (report_scoring.NAN if v is None else v for v in values))
 
-        # 6. 夜間離床次數：改用 asleep_leave（睡眠期間離床次數）
-        v_asleep_leave = to_float(row.get("asleep_leave"))
-        if v_asleep_leave is not None:
-            # 這個 list 會同時用在：
-            # 1) 判斷 report_type（bed / active）
-            # 2) Sleep Score 的「夜離狀況」評分
-            night_leave_for_score.append(v_asleep_leave)
-        night_leave_count.append(v_asleep_leave if v_asleep_leave is not None else 0)
-
-        # ===== 累計用於判斷「臥床 / 離床」 =====
-
-        # day_leave 平均
-        v_day_leave = to_float(row.get("day_leave"))
-        if v_day_leave is not None:
-            sum_day_leave += v_day_leave
-            cnt_day_leave += 1
-
-        # night_on_bed + day_on_bed 平均
-        if v_night_on_bed is not None and v_day_on_bed is not None:
-            sum_onbed_total += (v_night_on_bed + v_day_on_bed)
-            cnt_onbed_total += 1
-
-        d += timedelta(days=1)
-
-        # ===== 月平均計算 =====
-    avg_day_leave = (sum_day_leave / cnt_day_leave) if cnt_day_leave > 0 else 0.0
-    avg_onbed_total = (sum_onbed_total / cnt_onbed_total) if cnt_onbed_total > 0 else 0.0
-
-    # ===== 供報表類型判斷用的 night_leave 平均 =====
-    # night_leave_for_score 是前面逐日累積的「有效天 night_leave」
-    if night_leave_for_score:
-        avg_night_leave_for_mode = sum(night_leave_for_score) / len(night_leave_for_score)
-    else:
-        avg_night_leave_for_mode = None
-
-    # ===== 先計算系統自動判斷的 report_type =====
-    if (
-        avg_onbed_total is not None
-        and avg_onbed_total >= 10
-        and avg_night_leave_for_mode is not None
-        and avg_night_leave_for_mode <= 1
-    ):
-        auto_report_type = "bed"
-    else:
-        auto_report_type = "active"
+    out = array("d")
+    for chunk in pc.fill_null(column, report_scoring.NAN).chunks:
+        out.frombytes(_arrow_value_bytes(chunk, 8))
+    return out
 
-    # ===== 再看 URL 是否有強制指定 mode =====
-    force_mode = request.args.get("mode")
-    print("[DEBUG] /report force_mode =", force_mode)
 
-    if force_mode in ("bed", "active"):
-        report_type = force_mode
-    else:
-        report_type = auto_report_type
-
-    print(
-        f"[DEBUG] report_type={report_type}, "
-        f"avg_day_leave={avg_day_leave:.2f}, "
-        f"avg_onbed_total={avg_onbed_total:.2f}, "
-        f"avg_night_leave_for_mode={avg_night_leave_for_mode}, "
-        f"codename={resident_info.get('codename')}"
-    )
+def _arrow_date_ordinals(column) -> array:
+    """created_at（TIMESTAMP / DATETIME / DATE / 字串）→ date.toordinal() 的 array('l')"""
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        column = pc.utf8_slice_codeunits(column, 0, 10)
+    column = pc.cast(column, pa.date32())
 
-    # ===== 呼吸狀況評分（RR Score） =====
-    # 1. sleep_respiration 平均值
-    valid_rr_values = [v for v in resp_rate if v is not None]
-    avg_rr = sum(valid_rr_values) / len(valid_rr_values) if valid_rr_values else None
-    if avg_rr is None:
-        score1 = 2  # 無資料時給中間分
-    else:
-        # 規則：
-        #   12–26 → 3 分
-        #   9–12 或 26–30 → 2 分
-        #   其餘 (<9 或 >30) → 1 分
-        if 12 <= avg_rr <= 26:
-            score1 = 3
-        elif (9 <= avg_rr < 12) or (26 < avg_rr <= 30):
-            score1 = 2
-        else:
-            score1 = 1
+    out = array("l")
+    for chunk in column.chunks:
+        days = array("i")
+        days.frombytes(_arrow_value_bytes(chunk, 4))
+        out.extend(d + _EPOCH_ORDINAL for d in days)
+    return out
 
-    # 2. respiration_analy.std_dev 平均值
-    avg_std = sum(rr_std_list) / len(rr_std_list) if rr_std_list else None
-    if avg_std is None:
-        score2 = 2  # 無資料時給中間分
-    else:
-        # 規則：
-        #   0–4 → 3 分
-        #   4–5 → 2 分
-        #   5–6 → 1 分
-        #   >6 → 1 分
-        if avg_std <= 4:
-            score2 = 3
-        elif avg_std <= 5:
-            score2 = 2
-        elif avg_std <= 6:
-            score2 = 1
-        else:
-            score2 = 1
-
-    # 3. sleep_respiration 趨勢斜率（線性回歸，取絕對值）
-    xy = [(i, v) for i, v in enumerate(resp_rate) if v is not None]
-    if len(xy) >= 2:
-        xs = [p[0] for p in xy]
-        ys = [p[1] for p in xy]
-        mean_x = sum(xs) / len(xs)
-        mean_y = sum(ys) / len(ys)
-        num = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
-        den = sum((x - mean_x) ** 2 for x in xs)
-        slope = (num / den) if den != 0 else 0.0
-    else:
-        slope = 0.0  # 資料太少就當作趨勢平緩
-
-    slope_abs = abs(slope)
-    # 規則：
-    #   0–0.02 → 3 分
-    #   0.02–0.05 → 2 分
-    #   >0.05 → 1 分
-    if slope_abs <= 0.05:
-        score3 = 3
-    elif slope_abs <= 0.1:
-        score3 = 2
-    else:
-        score3 = 1
 
-    rr_score = min(score1, score2, score3)
+class ResidentRangeData:
+    """
+    某個 resident 在 start_date ~ end_date 的報表原始資料：
+      - daily：DAILY_TABLE 每日資料（DailyColumns，只含報表需要的欄位）
+      - duration_max_map：每天 bed_state='09' duration 最大值（小時）
+      - flip_datetimes：翻身時間（多抓一天，給跨夜的翻身間隔用）
+      - flip_index：flip_datetimes 建好的 FlipIndex
+    每一種資料第一次用到才查詢，之後都直接用記住的結果
+    查詢快取的資料版本用 latest_date（最新資料日）；沒給就在呼叫端的 thread 查一次，
+    背景查詢 task 不會自己去查（不碰 session）
+    """
 
-    print(
-        f"[DEBUG] RR scoring: avg_rr={avg_rr}, avg_std={avg_std}, "
-        f"slope={slope}, score1={score1}, score2={score2}, "
-        f"score3={score3}, rr_score={rr_score}"
-    )
+    def __init__(self, resident_id: int, start_date: date, end_date: date,
+                 daily=None, turn_rows=None, latest_date=None):
+        # daily / turn_rows 有給就直接用（例如機構批次查詢已經撈好），不再查詢
+        self.resident_id = resident_id
+        self.start_date = start_date
+        self.end_date = end_date
+        self.latest_date = latest_date
+        self._daily = daily
+        self._turn_rows = turn_rows
+        self._duration_max_map = None
+        self._flip_datetimes = None
+        self._flip_index = None
+
+    def _latest_date(self):
+        if self.latest_date is None:
+            self.latest_date = get_latest_created_date(self.resident_id)
+        return self.latest_date
+
+    def prefetch(self, daily: bool = True, turns: bool = True):
+        """daily 與 N_bq_Duration24 兩個查詢同時送出（已經有結果的就不再查），回傳 self"""
+        futures = {}
+        if daily and self._daily is None:
+            futures["daily"] = submit_fetch(
+                get_daily_columns_for_resident_by_range,
+                self.resident_id, self.start_date, self.end_date, self._latest_date(),
+            )
+        if turns and self._turn_rows is None:
+            futures["turn"] = submit_fetch(
+                get_bed_turn_rows_by_range,
+                self.resident_id, self.start_date, self.end_date + timedelta(days=1), self._latest_date(),
+            )
+        if "daily" in futures:
+            self._daily = wait_fetch(futures["daily"], "daily rows")
+        if "turn" in futures:
+            self._turn_rows = wait_fetch(futures["turn"], "bed turn rows")
+        return self
+
+    @property
+    def daily(self):
+        if self._daily is None:
+            self._daily = get_daily_columns_for_resident_by_range(
+                self.resident_id, self.start_date, self.end_date, self._latest_date()
+            )
+        return self._daily
+
+    @property
+    def turn_rows(self):
+        if self._turn_rows is None:
+            self._turn_rows = get_bed_turn_rows_by_range(
+                self.resident_id, self.start_date, self.end_date + timedelta(days=1), self._latest_date()
+            )
+        return self._turn_rows
+
+    @property
+    def duration_max_map(self):
+        if self._duration_max_map is None:
+            self._duration_max_map = build_duration_max_map(
+                self.turn_rows, self.start_date, self.end_date
+            )
+        return self._duration_max_map
+
+    @property
+    def flip_datetimes(self):
+        if self._flip_datetimes is None:
+            self._flip_datetimes = build_flip_datetimes(self.turn_rows)
+        return self._flip_datetimes
+
+    @property
+    def flip_index(self):
+        if self._flip_index is None:
+            self._flip_index = FlipIndex(self.flip_datetimes)
+        return self._flip_index
+
+
+def load_resident_range(resident_id: int, start_date: date, end_date: date,
+                        latest_date=None) -> ResidentRangeData:
+    """
+    取得 ResidentRangeData；同一個 request 內相同 (resident, 區間) 只建立一次
+    （存在 flask.g，request 結束就丟掉）
+    """
+    key = (resident_id, start_date, end_date)
+    if not has_app_context():
+        return ResidentRangeData(resident_id, start_date, end_date, latest_date=latest_date)
+    cache = g.setdefault("resident_range_cache", {})
+    if key not in cache:
+        cache[key] = ResidentRangeData(resident_id, start_date, end_date, latest_date=latest_date)
+    return cache[key]
+
+
+def get_row_date(row):
+    """從 daily row 的 created_at 取出 date；無法解析回傳 None"""
+    v = row.get("created_at")
+    if isinstance(v, datetime):
+        return v.date()
+    if isinstance(v, date):
+        return v
+    key = get_date_key(v)
+    try:
+        return datetime.strptime(key, "%Y-%m-%d").date()
+    except ValueError:
+        return None
 
-    # ===== 作息狀況 / 臥床照顧 評分（Daily Score） =====
-    # A. 離床（active）：上床/起床時間規則
-    # B. 臥床（bed）：翻身 + 日間離床規則
 
-    # ---------- A. 離床：作息狀況評分（上床 / 起床時間） ----------
+def convert_asleep_start_to_hour(value):
+    """
+    將 asleep_start 轉成「數值小時」，方便畫圖：
+      - 先取時間 (HH:MM)
+      - 如果時間 < 12:00，視為「隔天凌晨」=> +24
+      - 這樣 y 軸大約是 20 ~ 32 (晚上8點~隔天早上8點)
+    """
+    t = parse_time_of_day(value)
+    if t is None:
+        return None
 
-    # 使用前面已經算好的：
-    #   - asleep_start_hours：每一天的上床時間（convert_asleep_start_to_hour 後，無效日為 None）
-    #   - night_sleep_range：每一天的 [start_h, end_h]，無效日為 None
-    asleep_start_valid = [h for h in asleep_start_hours if h is not None]
+    h = t.hour + t.minute / 60.0 + t.second / 3600.0
 
-    asleep_end_valid = []
-    for rng in night_sleep_range:
-        if (
-            isinstance(rng, list)
-            and len(rng) == 2
-            and rng[0] is not None
-            and rng[1] is not None
-        ):
-            # rng[1] 就是 asleep_end（= asleep_start + night_sleep）
-            asleep_end_valid.append(float(rng[1]))
-
-    # 方便 debug
-    avg_start = None
-    avg_start_mod = None
-    diff_start = None
-    diff_end = None
-
-    # ---- 1. 上床平均時間 ----
-    # asleep_start 的平均上床時間：
-    #   20:00~01:00 → 3 分
-    #   17:00~20:00 或 01:00~02:00 → 2 分
-    #   早於 17:00 或 晚於 02:00 → 1 分
-    if asleep_start_valid:
-        avg_start = sum(asleep_start_valid) / len(asleep_start_valid)
-        # convert_asleep_start_to_hour 會把凌晨加 24，所以用 mod 24 回到 0~24 小時
-        avg_start_mod = avg_start % 24
-
-        # 20:00~24:00 或 00:00~01:00
-        if (20 <= avg_start_mod < 24) or (0 <= avg_start_mod < 1):
-            active_s1 = 3
-        # 17:00~20:00 或 01:00~02:00
-        elif (17 <= avg_start_mod < 20) or (1 <= avg_start_mod < 2):
-            active_s1 = 2
-        else:
-            active_s1 = 1
-    else:
-        # 沒資料給中間分
-        active_s1 = 2
-
-    # ---- 2. 上床時間差 ----
-    # 最晚上床時間與最早上床時間的差：
-    #   差 ≤ 3 小時 → 3 分
-    #   差 3~4 小時 → 2 分
-    #   差 > 4 小時 → 1 分
-    if len(asleep_start_valid) >= 2:
-        min_start = min(asleep_start_valid)
-        max_start = max(asleep_start_valid)
-        diff_start = max_start - min_start
-        if diff_start <= 3:
-            active_s2 = 3
-        elif diff_start <= 4:
-            active_s2 = 2
-        else:
-            active_s2 = 1
-    else:
-        active_s2 = 2
-
-    # ---- 3. 起床時間差 ----
-    # asleep_end 最晚起床時間與最早起床時間的差：
-    #   差 ≤ 3 小時 → 3 分
-    #   差 3~4 小時 → 2 分
-    #   差 > 4 小時 → 1 分
-    if len(asleep_end_valid) >= 2:
-        min_end = min(asleep_end_valid)
-        max_end = max(asleep_end_valid)
-        diff_end = max_end - min_end
-        if diff_end <= 3:
-            active_s3 = 3
-        elif diff_end <= 4:
-            active_s3 = 2
-        else:
-            active_s3 = 1
-    else:
-        active_s3 = 2
+    # 凌晨 (例如 01:30) 視為「隔日」，加 24 小時
+    if h < 12:
+        h += 24.0
 
-    active_daily_score = min(active_s1, active_s2, active_s3)
+    return h
 
-    print(
-        f"[DEBUG] Active daily scoring: "
-        f"avg_start={avg_start}, avg_start_mod={avg_start_mod}, "
-        f"diff_start={diff_start}, diff_end={diff_end}, "
-        f"s1={active_s1}, s2={active_s2}, s3={active_s3}, "
-        f"active_daily_score={active_daily_score}"
-    )
 
-    # ---------- B. 臥床：臥床照顧評分（翻身 + 日間離床） ----------
+def build_night_interval_for_day(day_date, asleep_value, night_sleep_hours):
+    """
+    建立某天 d 的「夜間區間」：
+      night_start = d + asleep_start
+      night_end   = night_start + night_sleep_hours(小時)
+    可能跨日（例如 21:00 ~ 翌日 08:00）
+    """
+    if asleep_value is None or night_sleep_hours is None:
+        return None, None
 
-    # night_turn_interval / day_turn_interval 單位：分鐘（已過濾 >720 的異常值）
-    night_turn_valid = [v for v in night_turn_interval if v is not None]
-    day_turn_valid   = [v for v in day_turn_interval if v is not None]
+    # 把 asleep_value 轉成 time
+    t = parse_time_of_day(asleep_value)
+    if t is None:
+        return None, None
 
-    avg_night_turn = (
-        sum(night_turn_valid) / len(night_turn_valid) if night_turn_valid else None
-    )
-    avg_day_turn = (
-        sum(day_turn_valid) / len(day_turn_valid) if day_turn_valid else None
-    )
+    try:
+        nh = float(night_sleep_hours)
+    except (TypeError, ValueError):
+        return None, None
 
-    # 日間離床總時長：使用前面算好的 avg_day_leave（來源是 daily.day_leave）
-    avg_day_leave_for_score = avg_day_leave if cnt_day_leave > 0 else None
+    night_start = datetime.combine(day_date, t)
+    night_end = night_start + timedelta(hours=nh)
+    return night_start, night_end
 
-    # 1. 夜間翻身平均時間
-    #   平均 < 370 分鐘 → 3 分
-    #   平均 370~430 分鐘 → 2 分
-    #   平均 > 430 分鐘 → 1 分
-    if avg_night_turn is None:
-        bed_s1 = 2
-    else:
-        if avg_night_turn < 370:
-            bed_s1 = 3
-        elif avg_night_turn <= 430:
-            bed_s1 = 2
-        else:
-            bed_s1 = 1
-
-    # 2. 日間翻身平均時間
-    #   平均 < 190 分鐘 → 3 分
-    #   平均 190~250 分鐘 → 2 分
-    #   平均 > 250 分鐘 → 1 分
-    if avg_day_turn is None:
-        bed_s2 = 2
-    else:
-        if avg_day_turn < 190:
-            bed_s2 = 3
-        elif avg_day_turn <= 250:
-            bed_s2 = 2
-        else:
-            bed_s2 = 1
-
-    # 3. 日間離床總時長（平均）
-    #   平均 > 4 小時 → 3 分
-    #   平均 2~4 小時 → 2 分
-    #   平均 < 2 小時 → 1 分
-    if avg_day_leave_for_score is None:
-        bed_s3 = 2
-    else:
-        if avg_day_leave_for_score > 4:
-            bed_s3 = 3
-        elif avg_day_leave_for_score >= 2:
-            bed_s3 = 2
-        else:
-            bed_s3 = 1
 
-    bed_daily_score = min(bed_s1, bed_s2, bed_s3)
+# 日 / 夜翻身平均間隔超過這個分鐘數視為異常，不列入顯示與評分
+TURN_INTERVAL_MAX_MIN = 720
 
-    print(
-        f"[DEBUG] Bed-care scoring: "
-        f"avg_night_turn={avg_night_turn}, avg_day_turn={avg_day_turn}, "
-        f"avg_day_leave={avg_day_leave_for_score}, "
-        f"s1={bed_s1}, s2={bed_s2}, s3={bed_s3}, "
-        f"bed_daily_score={bed_daily_score}"
-    )
+_FLIP_EPOCH = datetime(1970, 1, 1)
 
-    # ---------- C. 根據 report_type 選擇要顯示的 daily_score ----------
-    if report_type == "bed":
-        daily_score = bed_daily_score
-    else:
-        daily_score = active_daily_score
-
-    print(f"[DEBUG] Daily score final: report_type={report_type}, daily_score={daily_score}")
-
-    # ===== 作息品質評分（Sleep Score） =====
-    # 1. 平均休息時間 night_sleep
-    if night_sleep_for_score:
-        avg_night_sleep = sum(night_sleep_for_score) / len(night_sleep_for_score)
-        # 規則：
-        #   night_sleep 平均 6~10 → 3 分
-        #   4~6 或 10~12 → 2 分
-        #   <4 或 >12 → 1 分
-        if 6 <= avg_night_sleep <= 10:
-            sleep_s1 = 3
-        elif (4 <= avg_night_sleep < 6) or (10 < avg_night_sleep <= 12):
-            sleep_s1 = 2
-        else:
-            sleep_s1 = 1
-    else:
-        avg_night_sleep = None
-        sleep_s1 = 2  # 沒資料給中間分
-
-    # 2. 夜離狀況 night_leave
-    if night_leave_for_score:
-        avg_night_leave = sum(night_leave_for_score) / len(night_leave_for_score)
-        # 規則：
-        #   night_leave 平均 0~5 → 3 分
-        #   5~15 → 2 分
-        #   >15 → 1 分
-        if avg_night_leave <= 5:
-            sleep_s2 = 3
-        elif avg_night_leave <= 15:
-            sleep_s2 = 2
-        else:
-            sleep_s2 = 1
-    else:
-        avg_night_leave = None
-        sleep_s2 = 2  # 沒資料給中間分
-
-    # 3. 休息效率 night_sleep / night_on_bed
-    if sleep_eff_for_score:
-        avg_eff = sum(sleep_eff_for_score) / len(sleep_eff_for_score)
-        # 規則：
-        #   平均 >0.8 → 3 分
-        #   0.8~0.6 → 2 分
-        #   <0.6 → 1 分
-        if avg_eff > 0.8:
-            sleep_s3 = 3
-        elif avg_eff >= 0.6:
-            sleep_s3 = 2
-        else:
-            sleep_s3 = 1
-    else:
-        avg_eff = None
-        sleep_s3 = 2  # 沒資料給中間分
-
-    # 三個指標取最小值當作「作息品質」評分
-    sleep_score = min(sleep_s1, sleep_s2, sleep_s3)
-
-    print(
-        f"[DEBUG] Sleep scoring: "
-        f"avg_night_sleep={avg_night_sleep}, "
-        f"avg_night_leave={avg_night_leave}, "
-        f"avg_eff={avg_eff}, "
-        f"s1={sleep_s1}, s2={sleep_s2}, s3={sleep_s3}, "
-        f"sleep_score={sleep_score}"
-    )
 
-    # 根據 report_type 選擇要使用的模板
-    if report_type == "bed":
-        template_name = "month_bed.html"
-    else:
-        template_name = "month_active.html"
+class FlipIndex:
+    """
+    翻身時間索引：
+      - 翻身時間排序後存成「微秒整數」
+      - 另外存「到第 k 筆為止，和前一筆時間不同的筆數」的累計
+    某一天的日 / 夜翻身就是排序後陣列的幾段連續區間（用 bisect 找），
+    每段的「相鄰正間隔」總和 = 最後 - 最前，個數 = 累計差，
+    所以每一天 O(log flips) 就算完，不用再掃整個翻身清單
+    """
 
-    return render_template(
-        template_name,
-        resident=resident_info,
-        report_year=report_year,
-        report_month=report_month,
-        start_date=start_date,
-        end_date=end_date,
-        labels=labels,
-        resp_rate=resp_rate,
-        night_sleep_range=night_sleep_range,
-        asleep_start_hours=asleep_start_hours,
-        leave_bed_total=leave_bed_total,
-        night_turn_interval=night_turn_interval,
-        day_turn_interval=day_turn_interval,
-        night_bed_hours=night_bed_hours,
-        night_leave_count=night_leave_count,
-        report_type=report_type,
-        avg_day_leave=avg_day_leave,
-        avg_onbed_total=avg_onbed_total,
-        month_comments=month_comments,
-        rr_score=rr_score,
-        daily_score=daily_score,
-        sleep_score=sleep_score,
-    )
+    def __init__(self, flip_datetimes):
+        one_us = timedelta(microseconds=1)
+        self._t = sorted((dt - _FLIP_EPOCH) // one_us for dt in flip_datetimes)
+        self._distinct = []
+        count = 0
+        prev = None
+        for t in self._t:
+            if prev is not None and t > prev:
+                count += 1
+            self._distinct.append(count)
+            prev = t
+
+    def __len__(self):
+        return len(self._t)
+
+    def _pos(self, dt):
+        return bisect_left(self._t, (dt - _FLIP_EPOCH) // timedelta(microseconds=1))
+
+    def _span(self, lo, hi):
+        """區間 [lo, hi) 的 (相鄰正間隔總和 微秒, 個數)"""
+        if hi - lo < 2:
+            return 0, 0
+        return self._t[hi - 1] - self._t[lo], self._distinct[hi - 1] - self._distinct[lo]
+
+    @staticmethod
+    def _avg_min(total_us, count):
+        if count == 0:
+            return None
+        return total_us / 60_000_000 / count
+
+    def day_night_avg_intervals(self, day_date, night_start_dt, night_end_dt, max_minutes=None):
+        """
+        跟 compute_day_night_avg_intervals 相同規則：
+          - 只考慮日期在 { day_date, day_date+1 } 的翻身
+          - night_start_dt <= flip < night_end_dt → 夜間；其他 → 日間
+        max_minutes 有給時，平均間隔超過它就回傳 None
+        """
+        lo = self._pos(datetime.combine(day_date, time(0, 0)))
+        hi = self._pos(datetime.combine(day_date + timedelta(days=2), time(0, 0)))
+
+        if night_start_dt is not None and night_end_dt is not None:
+            a = min(max(self._pos(night_start_dt), lo), hi)
+            b = min(max(self._pos(night_end_dt), a), hi)
+        else:
+            a = b = hi
+
+        night_total, night_cnt = self._span(a, b)
+
+        # 日間 = [lo, a) + [b, hi)，兩段接起來的地方（跨過夜間）也算一個間隔
+        left_total, left_cnt = self._span(lo, a)
+        right_total, right_cnt = self._span(b, hi)
+        day_total = left_total + right_total
+        day_cnt = left_cnt + right_cnt
+        if lo < a and b < hi:
+            gap = self._t[b] - self._t[a - 1]
+            if gap > 0:
+                day_total += gap
+                day_cnt += 1
+
+        night_avg = self._avg_min(night_total, night_cnt)
+        day_avg = self._avg_min(day_total, day_cnt)
+        if max_minutes is not None:
+            if night_avg is not None and night_avg > max_minutes:
+                night_avg = None
+            if day_avg is not None and day_avg > max_minutes:
+                day_avg = None
+        return night_avg, day_avg
 
-@app.route("/half_report", methods=["GET"])
-@login_required
-def half_report():
+
+def compute_day_night_avg_intervals(day_date, night_start_dt, night_end_dt, flip_datetimes):
+    """
+    計算某天 day_date 的：
+      - 夜間翻身平均間隔（分鐘）
+      - 日間翻身平均間隔（分鐘）
+
+    規則：
+      - 只考慮 flip_dt.date() 在 { day_date, day_date+1 } 的翻身
+      - 若 night_start_dt <= flip_dt < night_end_dt → 夜間翻身
+        其他 → 日間翻身
+    要算很多天請先建一個 FlipIndex 重複使用
+    """
+    if not isinstance(flip_datetimes, FlipIndex):
+        flip_datetimes = FlipIndex(flip_datetimes)
+    return flip_datetimes.day_night_avg_intervals(day_date, night_start_dt, night_end_dt)
+
+
+def get_date_key(v) -> str:
+    """把 created_at 轉成 'YYYY-MM-DD' 字串，方便跟月份每一天對齊。"""
+    if v is None:
+        return ""
+    if hasattr(v, "strftime"):
+        try:
+            if isinstance(v, datetime):
+                return v.date().strftime("%Y-%m-%d")
+            return v.strftime("%Y-%m-%d")
+        except Exception:
+            pass
+    s = str(v)
+    return s[:10]  # '2025-10-03 00:00:00' -> '2025-10-03'
+
+
+def parse_month_cell(text):
+    """
+    從「月份」欄位文字裡抓出 (year, month)，例如：
+      2025/10、2025-10、2025年10月 -> (2025, 10)
+    找不到就回傳 (None, None)
+    """
+    s = str(text or "").strip()
+    m = re.search(r"(\d{4}).*?(\d{1,2})", s)
+    if not m:
+        return None, None
+    try:
+        y = int(m.group(1))
+        mth = int(m.group(2))
+        return y, mth
+    except ValueError:
+        return None, None
+
+
+def to_int_or_none(x):
+    if x is None or x == "":
+        return None
+    try:
+        return int(float(x))
+    except (TypeError, ValueError):
+        return None
+
+
+def to_float_or_none(x):
+    """安全轉 float；None / 空字串 / 無法轉換 → None"""
+    if x is None or x == "":
+        return None
+    try:
+        return float(x)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_std_dev(resp_analy_raw):
+    """從 respiration_analy（JSON 字串或 BigQuery STRUCT）取出 std_dev；沒有就回傳 None"""
+    try:
+        if not resp_analy_raw:
+            return None
+        if isinstance(resp_analy_raw, str):
+            analy_obj = json.loads(resp_analy_raw)
+        else:
+            analy_obj = resp_analy_raw  # BigQuery STRUCT 可能直接是 dict-like
+        std_val = analy_obj.get("std_dev")
+        return float(std_val) if std_val is not None else None
+    except Exception:
+        return None
+
+
+# ---------- 評語比對用的輔助函式 ----------
+
+def _norm_text(s):
+    """
+    將文字標準化：
+      - None -> ""
+      - 轉成 str
+      - 移除全形空白、所有空白
+      - 轉小寫
+    """
+    if s is None:
+        return ""
+    s = str(s).replace("\u3000", " ")
+    s = re.sub(r"\s+", "", s)
+    return s.lower()
+
+
+def _norm_digits(x):
+    """
+    只保留數字，例如：
+      '  001-23 ' -> '00123'
+      112 -> '112'
+    """
+    if x is None:
+        return ""
+    s = str(x)
+    digits = re.findall(r"\d+", s)
+    return "".join(digits)
+
+
+# 判斷某一列「有填離床欄位 / 臥床欄位」用的欄名
+ACTIVE_COMMENT_COLUMNS = [
+    "本月總結_離床",
+    "月呼吸率紀錄_離床",
+    "每日休息時段_離床",
+    "每日上床休息時間_離床",
+    "夜間休息離床次數_離床",
+    "每月趨勢狀態_離床",
+    "月趨勢狀態總結_離床",
+]
+BED_COMMENT_COLUMNS = [
+    "本月總結_臥床",
+    "月呼吸率紀錄_臥床",
+    "夜間最床臥床時段_臥床",
+    "日間離床總時長_臥床",
+    "日夜翻身間隔_臥床",
+    "每月趨勢狀態_臥床",
+    "月趨勢狀態總結_臥床",
+]
+
+# 評語 key -> Sheet 欄名（list 表示依序找第一個有填的欄位）
+COMMENT_COLUMN_MAP = {
+    "active_summary": "本月總結_離床",
+    "active_resp": "月呼吸率紀錄_離床",
+    "active_sleep_range": "每日休息時段_離床",
+    "active_asleep_start": "每日上床休息時間_離床",
+    "active_night_leave": "夜間休息離床次數_離床",
+    "active_trend": "每月趨勢狀態_離床",
+    "active_trend_summary": "月趨勢狀態總結_離床",
+    "bed_summary": "本月總結_臥床",
+    "bed_resp": "月呼吸率紀錄_臥床",
+    "bed_night_bed": ["夜間最床臥床時段_臥床", "夜間最長臥床時長_臥床"],
+    "bed_leave_total": ["全日離床總時長_臥床", "日間離床總時長_臥床"],
+    "bed_turn": "日夜翻身間隔_臥床",
+    "bed_trend": "每月趨勢狀態_臥床",
+    "bed_trend_summary": "月趨勢狀態總結_臥床",
+}
+
+
+def _load_sheet_comment_index(spreadsheet_id: str, gid: int):
+    """
+    下載整張評語表並建立索引：
+      {"headers": [...],
+       "index": {(serial_norm, agency_norm, year, month): [(row_no, row, has_active, has_bed), ...]}}
+    讀取失敗回傳 None
+    """
+    try:
+        with metrics.timed("sheets", SHEETS_SECONDS):
+            values = data_backend().sheet_values(spreadsheet_id, gid)
+    except Exception as e:
+        logger.warning("讀取試算表失敗：%r", e, exc_info=True)
+        return None
+
+    # 內容 hash 當作評語表的版本（JSON API 的 ETag 用）
+    version = hashlib.sha1(json.dumps(values, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+
+    if not values or len(values) < 2:
+        logger.warning("試算表沒有資料/只有表頭")
+        return {"headers": [], "index": {}, "version": version}
+
+    # 表頭正規化
+    raw_headers = values[0]
+    headers, seen = [], set()
+    for i, h in enumerate(raw_headers):
+        name = (h or "").strip().replace("\u3000", " ")
+        if not name:
+            name = f"__col{i}__"
+        if name in seen:
+            name = f"{name}_{i}"
+        seen.add(name)
+        headers.append(name)
+    logger.debug("Headers: %s", headers)
+
+    active_cols = [c for c in ACTIVE_COMMENT_COLUMNS if c in headers]
+    bed_cols = [c for c in BED_COMMENT_COLUMNS if c in headers]
+
+    index = {}
+    for row_no, row_vals in enumerate(values[1:]):
+        row = {headers[i]: (row_vals[i] if i < len(row_vals) else "") for i in range(len(headers))}
+        y, mth = parse_month_cell(row.get("月份"))
+        if y is None or mth is None:
+            continue
+
+        has_active = any((row.get(col) or "").strip() for col in active_cols)
+        has_bed = any((row.get(col) or "").strip() for col in bed_cols)
+
+        key = (_norm_text(row.get("serial_id")), _norm_digits(row.get("agency_id")), y, mth)
+        index.setdefault(key, []).append((row_no, row, has_active, has_bed))
+
+    return {"headers": headers, "index": index, "version": version}
+
+
+def get_sheet_comment_index(spreadsheet_id: str = SHEET_SPREADSHEET_ID, gid: int = SHEET_GID):
+    """
+    取得評語表索引；解析好的索引存在共用快取（key = sheet:<spreadsheet_id>:<gid>），
+    SHEET_CACHE_TTL 秒內所有 worker 重複呼叫都不會再打 Sheets API。
+    讀取失敗不快取（下一次 request 會重試），回傳 None
+    """
+    return app_cache().get_or_set(
+        cache_key("sheet", spreadsheet_id, gid),
+        lambda: _load_sheet_comment_index(spreadsheet_id, gid),
+        SHEET_CACHE_TTL,
+    )
+
+
+def get_sheet_version() -> str:
+    """評語表目前的版本（內容 hash，跟著快取的索引一起更新）；讀不到時回傳 'unavailable'"""
+    sheet = get_sheet_comment_index()
+    if sheet is None:
+        return "unavailable"
+    return sheet.get("version", "")
+
+
+def invalidate_sheet_comment_cache():
+    """Sheet 內容有改、想馬上生效時呼叫"""
+    app_cache().clear(cache_key("sheet", ""))
+
+
+def empty_month_comments():
+    """沒有評語時的預設值（每個 key 都是空字串）"""
+    return {key: "" for key in COMMENT_COLUMN_MAP}
+
+
+def get_month_comments_from_sheet(serial_id: str, agency_id: int, year: int, month: int):
+    """
+    讀取 Google Sheet 評語；對 serial/agency 進行強力正規化比對。
+    支援：
+      - 同一個住民 / 月份，可以用「一列填離床」、「另一列填臥床」。
+    工作表透過 get_sheet_comment_index 快取，查詢只是 dict lookup。
+    """
+    result = empty_month_comments()
+
+    sheet = get_sheet_comment_index()
+    if sheet is None:
+        return result
+    headers = sheet["headers"]
+    index = sheet["index"]
+
+    # 目標（正規化）
+    target_serial_norm = _norm_text(serial_id)
+    target_agency_norm = _norm_digits(agency_id)
+
+    # agency 規則：
+    #   - 試算表該欄空白 -> 視為通配（任何 agency 都可命中）
+    #   - 否則用純數字比對
+    candidates = list(index.get((target_serial_norm, target_agency_norm, year, month), []))
+    if target_agency_norm:
+        candidates += index.get((target_serial_norm, "", year, month), [])
+        candidates.sort(key=lambda item: item[0])  # 維持 Sheet 上的列順序
+
+    # 儲存「最適合的離床列」與「最適合的臥床列」
+    active_row = None
+    bed_row = None
+    for _row_no, row, has_active, has_bed in candidates:
+        if has_active and active_row is None:
+            active_row = row
+        if has_bed and bed_row is None:
+            bed_row = row
+
+    if active_row is None and bed_row is None:
+        logger.warning(
+            "未命中評語列：serial='%s', agency='%s', ym=%s-%02d",
+            target_serial_norm, target_agency_norm, year, month,
+        )
+        return result
+
+    # 如果只有其中一種有，另一種就 fallback
+    if active_row is None:
+        active_row = bed_row
+    if bed_row is None:
+        bed_row = active_row
+
+    for key, col in COMMENT_COLUMN_MAP.items():
+        # active_* 用 active_row，bed_* 用 bed_row
+        src_row = active_row if key.startswith("active_") else bed_row
+        if src_row is None:
+            continue
+
+        if isinstance(col, list):
+            for c in col:
+                if c not in headers:
+                    continue
+                val = (src_row.get(c) or "").strip()
+                if val:
+                    result[key] = val
+                    break
+        else:
+            if col not in headers:
+                continue
+            result[key] = (src_row.get(col) or "").strip()
+
+    if debug_enabled():
+        logger.debug("命中評語鍵：%s", [k for k, v in result.items() if v])
+    return result
+
+# ================== 4. 報表計算 ==================
+
+
+def month_date_range(year: int, month: int):
+    """回傳該月份的 (1 號, 最後一天)"""
+    return date(year, month, 1), date(year, month, monthrange(year, month)[1])
+
+
+def _snapshot_json_default(v):
+    if isinstance(v, datetime):
+        return {"__datetime__": v.isoformat()}
+    if isinstance(v, date):
+        return {"__date__": v.isoformat()}
+    raise TypeError(f"無法存成快照的型別：{type(v)!r}")
+
+
+def _snapshot_json_hook(obj):
+    if "__date__" in obj:
+        return date.fromisoformat(obj["__date__"])
+    if "__datetime__" in obj:
+        return datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+
+_snapshot_init_lock = threading.Lock()
+_snapshot_db_ready = False
+
+
+# 快照格式版本：報表計算（評分規則、build_*_context）或 context 欄位有改時加一，
+# 已存的快照（包含 closed 的月份）版本對不上就會重建。實際存的 data_version 是
+# 「CACHE_KEY_VERSION.SNAPSHOT_SCHEMA_VERSION/資料版本」，改 CACHE_KEY_VERSION 也會一起失效
+SNAPSHOT_SCHEMA_VERSION = 2
+
+
+def _snapshot_version_tag(data_version: str) -> str:
+    return f"{CACHE_KEY_VERSION}.{SNAPSHOT_SCHEMA_VERSION}/{data_version}"
+
+
+def report_cache_key(namespace: str, *parts) -> str:
+    """報表計算結果（ctx / days / chart）的共用快取 key，帶 SNAPSHOT_SCHEMA_VERSION，跟快照一起失效"""
+    return cache_key(namespace, f"s{SNAPSHOT_SCHEMA_VERSION}", *parts)
+
+
+def _snapshot_connect():
+    """開啟快照 DB；第一次會建立資料夾與資料表。停用時回傳 None"""
+    global _snapshot_db_ready
+    if not REPORT_SNAPSHOT_DB:
+        return None
+    if not _snapshot_db_ready:
+        os.makedirs(os.path.dirname(os.path.abspath(REPORT_SNAPSHOT_DB)), exist_ok=True)
+    conn = sqlite3.connect(REPORT_SNAPSHOT_DB, timeout=10)
+    if not _snapshot_db_ready:
+        with _snapshot_init_lock:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS report_snapshots (
+                  resident_id  INTEGER NOT NULL,
+                  year         INTEGER NOT NULL,
+                  month        INTEGER NOT NULL,
+                  kind         TEXT    NOT NULL,
+                  mode         TEXT    NOT NULL,
+                  data_version TEXT    NOT NULL,
+                  built_at     TEXT    NOT NULL,
+                  context      TEXT    NOT NULL,
+                  PRIMARY KEY (resident_id, year, month, kind, mode)
+                )
+                """
+            )
+            conn.commit()
+            _snapshot_db_ready = True
+    return conn
+
+
+def load_report_snapshot(resident_id: int, year: int, month: int, kind: str, mode: str):
+    """
+    讀快照，回傳 (data_version, context)；沒有、讀取失敗或快照格式版本不同
+    （SNAPSHOT_SCHEMA_VERSION / CACHE_KEY_VERSION 改過）回傳 (None, None)
+    """
+    try:
+        conn = _snapshot_connect()
+        if conn is None:
+            return None, None
+        with conn:
+            row = conn.execute(
+                "SELECT data_version, context FROM report_snapshots "
+                "WHERE resident_id = ? AND year = ? AND month = ? AND kind = ? AND mode = ?",
+                (resident_id, year, month, kind, mode),
+            ).fetchone()
+        conn.close()
+    except (sqlite3.Error, OSError) as e:
+        logger.warning("讀取報表快照失敗：%s", e)
+        return None, None
+    if row is None:
+        return None, None
+    prefix = _snapshot_version_tag("")
+    if not row[0].startswith(prefix):
+        return None, None
+    return row[0][len(prefix):], json.loads(row[1], object_hook=_snapshot_json_hook)
+
+
+def save_report_snapshot(resident_id: int, year: int, month: int, kind: str, mode: str,
+                         data_version: str, context: dict):
+    """寫入 / 覆蓋快照；寫入失敗只印警告，不影響頁面"""
+    try:
+        payload = json.dumps(context, default=_snapshot_json_default, ensure_ascii=False)
+        conn = _snapshot_connect()
+        if conn is None:
+            return
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO report_snapshots "
+                "(resident_id, year, month, kind, mode, data_version, built_at, context) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (resident_id, year, month, kind, mode, _snapshot_version_tag(data_version),
+                 datetime.now().isoformat(timespec="seconds"), payload),
+            )
+        conn.close()
+    except (sqlite3.Error, OSError, TypeError, ValueError) as e:
+        logger.warning("寫入報表快照失敗：%s", e)
+
+
+def snapshot_data_version(year: int, month: int, latest_date: date) -> str:
+    """
+    快照的資料版本：
+      - 最新資料日已經超過「月底 + SNAPSHOT_CLOSE_GRACE_DAYS 天」→ 這個月的資料（含月底跨到
+        下個月 1 號的翻身資料）都到齊、不會再變 → 'closed'
+      - 其他（當月、剛換月）→ 最新 created_at 的日期；有新資料進來版本就會變，快照會重建
+    """
+    month_end = month_date_range(year, month)[1]
+    if latest_date > month_end + timedelta(days=SNAPSHOT_CLOSE_GRACE_DAYS):
+        return "closed"
+    return latest_date.isoformat()
+
+
+def report_mode(force_mode) -> str:
+    """URL 的 mode → 'bed' / 'active'；沒指定（依資料自動判斷）為 'auto'"""
+    return force_mode if force_mode in ("bed", "active") else "auto"
+
+
+def get_or_build_report_snapshot(kind: str, resident_id: int, year: int, month: int,
+                                 force_mode, builder, latest_date=None):
+    """
+    取得報表計算結果：
+      - 共用快取有同一個資料版本的結果 → 直接回傳（不用讀快照檔）
+      - 快照版本與目前資料版本相同 → 回傳快照
+      - 否則呼叫 builder() 重新計算並存成快照
+    拿到的結果也會放進共用快取（REPORT_CONTEXT_CACHE_TTL 秒）
+    kind：'month'（月報）/ 'half'（半年報）；mode：'bed' / 'active' / 'auto'
+    """
+    mode = report_mode(force_mode)
+    if latest_date is None:
+        latest_date = get_latest_created_date(resident_id)
+    version = snapshot_data_version(year, month, latest_date)
+
+    key = report_cache_key("ctx", kind, resident_id, year, month, mode, version)
+    ctx = app_cache().get(key)
+    if ctx is not None:
+        return ctx
+
+    with metrics.timed("snapshot", STAGE_SECONDS, stage="snapshot_load"):
+        stored_version, ctx = load_report_snapshot(resident_id, year, month, kind, mode)
+    if ctx is None or stored_version != version:
+        ctx = builder()
+        with metrics.timed("snapshot", STAGE_SECONDS, stage="snapshot_save"):
+            save_report_snapshot(resident_id, year, month, kind, mode, version, ctx)
+
+    app_cache().set(key, ctx, REPORT_CONTEXT_CACHE_TTL)
+    return ctx
+
+
+def get_report_charts(kind: str, resident_id: int, year: int, month: int, force_mode, latest_date, ctx) -> dict:
+    """
+    報表的圖（伺服器端畫好的 SVG）：{"chart1": "<svg ...>", ...}
+      - 跟報表計算結果同一個資料版本，存在共用快取；同一位住民同一個月只畫一次
+      - kind：'month' / 'half'；ctx 是 get_or_build_report_snapshot 的結果
+    """
+    mode = report_mode(force_mode)
+    version = snapshot_data_version(year, month, latest_date)
+    draw = report_charts.month_charts if kind == "month" else report_charts.half_charts
+
+    def build():
+        with metrics.timed("charts", STAGE_SECONDS, stage="charts"):
+            return draw(ctx)
+
+    key = report_cache_key("chart", kind, resident_id, year, month, mode, version)
+    return app_cache().get_or_set(key, build, REPORT_CONTEXT_CACHE_TTL)
+
+
+def half_summary_text(month_comments: dict, report_type: str) -> str:
+    """半年摘要：依模板選擇對應的評語欄位，沒填就用預設文字"""
+    if report_type == "bed":
+        half_summary = month_comments.get("bed_trend_summary", "")
+    else:
+        half_summary = month_comments.get("active_trend_summary", "")
+    return half_summary or "半年追蹤摘要尚未設定，之後可依照需求由後端帶入文字。"
+
+
+def build_report_pdf(kind: str, resident: dict, year: int, month: int, force_mode=None, latest_date=None) -> bytes:
+    """
+    月報 / 半年報 PDF（伺服器端產生，內容同頁面）：
+      - 報表數值跟頁面共用快照 / 共用快取，評語同樣讀 Google Sheet
+      - resident：住民資訊（resident_id / serial_id / agency_id / resident_name / bed_number / agency_name）
+      - kind：'month' / 'half'
+    """
+    resident_id = resident["resident_id"]
+    comments_future = submit_fetch(
+        get_month_comments_from_sheet, resident.get("serial_id", ""), resident.get("agency_id"), year, month
+    )
+    if latest_date is None:
+        latest_date = get_latest_created_date(resident_id)
+    builder = build_month_report_context if kind == "month" else build_half_report_context
+    ctx = get_or_build_report_snapshot(
+        kind, resident_id, year, month, force_mode,
+        lambda: builder(resident_id, year, month, force_mode),
+        latest_date=latest_date,
+    )
+    month_comments = wait_fetch(comments_future, "sheet comments", default=empty_month_comments())
+
+    with metrics.timed("pdf", STAGE_SECONDS, stage="pdf"):
+        if kind == "month":
+            return report_pdf.month_report_pdf(ctx, resident, month_comments)
+        return report_pdf.half_report_pdf(
+            ctx, resident, month_comments, half_summary_text(month_comments, ctx["report_type"])
+        )
+
+
+def report_pdf_filename(kind: str, resident: dict, year: int, month: int) -> str:
+    """例如 month_5_SN123_2025-10.pdf（只留英數字，避免檔名 / header 出問題）"""
+    serial = re.sub(r"[^A-Za-z0-9_-]", "", str(resident.get("serial_id", ""))) or str(resident["resident_id"])
+    return f"{kind}_{resident.get('agency_id', '')}_{serial}_{year}-{month:02d}.pdf"
+
+
+def derive_day_records(range_data, start_date: date, end_date: date):
+    """
+    從 ResidentRangeData 算出 start_date ~ end_date 每一筆 daily 的逐日結果（day record），
+    依 daily 原本的順序回傳 list；每筆是 dict：
+      - d、valid：日期與是否為有效天（無效天只有這兩個欄位）
+      - 有效天另外有：night_on_bed / night_sleep / resp / day_on_bed / day_leave / asleep_leave /
+        asleep_leave_min / std_dev 原始值、asleep_hour（上床時間 20~32）、
+        leave_total（全日離床總時長）、night_turn / day_turn（日夜翻身平均間隔，分鐘）、
+        night_interval（夜間區間是否建得起來）、duration_max（夜間最長臥床時長，小時）
+    每一天的結果只跟當天 daily 與 d ~ d+1 的翻身資料有關，跟查詢區間無關，可以分月快取
+    """
+    with metrics.timed("compute", STAGE_SECONDS, stage="day_records"):
+        daily = range_data.daily
+        duration_map = range_data.duration_max_map
+        flip_index = range_data.flip_index
+
+        records = []
+        for pos in daily.iter_positions():
+            d = daily.date_at(pos)
+            if d < start_date or d > end_date:
+                continue
+
+            v_night_on_bed = daily.value("night_on_bed", pos)
+            v_night_sleep  = daily.value("night_sleep", pos)
+            v_resp         = daily.value("sleep_respiration", pos)
+            v_day_on_bed   = daily.value("day_on_bed", pos)
+
+            if not report_scoring.is_valid_day(v_night_on_bed, v_night_sleep, v_resp):
+                records.append({"d": d, "valid": False})
+                continue
+
+            # asleep_start 只解析一次，上床時間與夜間區間共用
+            v_asleep_start = parse_time_of_day(daily.asleep_start[pos])
+
+            leave_total = None
+            if v_day_on_bed is not None and v_night_on_bed is not None:
+                leave_total = max(24.0 - (v_day_on_bed + v_night_on_bed), 0.0)
+
+            # ★ 若夜間 / 日間翻身平均間隔 > 720 分鐘，視為異常，不列入顯示與評分
+            night_start_dt, night_end_dt = build_night_interval_for_day(d, v_asleep_start, v_night_sleep)
+            night_turn, day_turn = flip_index.day_night_avg_intervals(
+                d, night_start_dt, night_end_dt, max_minutes=TURN_INTERVAL_MAX_MIN
+            )
+
+            records.append({
+                "d": d,
+                "valid": True,
+                "night_on_bed": v_night_on_bed,
+                "night_sleep": v_night_sleep,
+                "resp": v_resp,
+                "day_on_bed": v_day_on_bed,
+                "day_leave": daily.value("day_leave", pos),
+                "asleep_leave": daily.value("asleep_leave", pos),
+                "asleep_leave_min": daily.value("asleep_leave_minute", pos),
+                "std_dev": daily.value("std_dev", pos),
+                "asleep_hour": convert_asleep_start_to_hour(v_asleep_start),
+                "leave_total": leave_total,
+                "night_turn": night_turn,
+                "day_turn": day_turn,
+                "night_interval": night_start_dt is not None and night_end_dt is not None,
+                "duration_max": duration_map.get(d.strftime("%Y-%m-%d")),
+            })
+        return records
+
+
+def get_day_records_for_months(resident_id: int, month_keys, latest_date=None, cached_only: bool = False):
+    """
+    取得多個月份的 day records：{(year, month): [record, ...]}
+      - 共用快取裡有的月份直接用（key 帶資料版本，規則同報表快照：已結束的月份為 closed）
+      - 缺的月份合併成一個區間一次撈原始資料、算完再分月存回快取
+      - cached_only=True 時只回傳快取裡有的月份，缺的月份不計算（呼叫端用別的方式補）
+    DAY_RECORD_CACHE=0 時不讀也不存快取，全部重新計算
+    拿到的 list 不要修改（可能是快取裡的物件）
+    """
+    if latest_date is None:
+        latest_date = get_latest_created_date(resident_id)
+
+    def records_key(y, m):
+        # 月底那天的翻身間隔用到下個月 1 號的翻身資料，版本規則跟快照一樣（1 號過完才 closed）
+        return report_cache_key("days", resident_id, y, m, snapshot_data_version(y, m, latest_date))
+
+    cache = app_cache()
+    result = {}
+    missing = []
+    for y, m in month_keys:
+        records = cache.get(records_key(y, m)) if DAY_RECORD_CACHE else None
+        if records is None:
+            missing.append((y, m))
+        else:
+            result[(y, m)] = records
+
+    if missing and not cached_only:
+        start_date = month_date_range(*min(missing))[0]
+        end_date = month_date_range(*max(missing))[1]
+        logger.debug("day records resident_id=%s cached=%d missing=%s", resident_id, len(result), missing)
+        range_data = load_resident_range(resident_id, start_date, end_date, latest_date).prefetch()
+        by_month = {key: [] for key in missing}
+        for rec in derive_day_records(range_data, start_date, end_date):
+            bucket = by_month.get((rec["d"].year, rec["d"].month))
+            if bucket is not None:
+                bucket.append(rec)
+        for (y, m), records in by_month.items():
+            if DAY_RECORD_CACHE:
+                cache.set(records_key(y, m), records, REPORT_CONTEXT_CACHE_TTL)
+            result[(y, m)] = records
+    return result
+
+
+def build_month_report_context(resident_id: int, report_year: int, report_month: int, force_mode=None,
+                               range_data=None):
+    """
+    計算月報需要的所有數值（不含住民資訊與 Sheet 評語）：
+      - 只使用「有效天」計算平均與畫圖
+        (night_on_bed / night_sleep / sleep_respiration 任何一個為 0 的天會被排除)
+      - 夜間最長臥床時長：從 N_bq_Duration24 找出 bed_state='09'、
+        每天 duration 最大值（秒），並轉成「小時」
+      - 全日離床總時長：24 - day_on_bed - night_on_bed
+      - 日夜平均翻身間隔：從 N_bq_Duration24 的翻身時間（time_start）計算
+      - force_mode 為 'bed' / 'active' 時強制使用該報表類型
+      - range_data：已經撈好的 ResidentRangeData（批次計算用），直接從它計算；
+        沒給就用 day records（get_day_records_for_months，快取裡有就不用再撈資料）
+    回傳的 dict 可以直接當 render_template 的參數，也可以存成快照
+    """
+    # 查詢範圍：該月份 1 號 ~ 最後一天
+    start_date, end_date = month_date_range(report_year, report_month)
+
+    # 逐日結果（有效天、上床時間、翻身間隔…）
+    if range_data is not None:
+        records = derive_day_records(range_data.prefetch(), start_date, end_date)
+    else:
+        records = get_day_records_for_months(resident_id, [(report_year, report_month)])[(report_year, report_month)]
+    # 以下是純計算（逐日結果都已到齊），時間記成 compute
+    compute_started = time_mod.perf_counter()
+
+    logger.debug("/report resident_id=%s range=%s~%s rows=%d", resident_id, start_date, end_date, len(records))
+
+    # 一天有多筆 daily 時以最後一筆為準
+    day_records = {rec["d"]: rec for rec in records}
+
+    n_days = (end_date - start_date).days + 1
+
+    # 準備圖表用 array（無資料 / 無效天為 None）
+    labels              = []
+    resp_rate           = [None] * n_days  # 每日呼吸紀錄
+    night_sleep_range   = [None] * n_days  # 每日夜間休息時段 [start_hour, end_hour]
+    asleep_start_hours  = [None] * n_days  # 每日上床時間
+    leave_bed_total     = [None] * n_days  # 全日離床總時長
+    night_turn_interval = [None] * n_days  # 夜間翻身平均間隔（分鐘）
+    day_turn_interval   = [None] * n_days  # 日間翻身平均間隔（分鐘）
+    night_bed_hours     = [None] * n_days  # 夜間最長臥床時長 (from N_bq_Duration24)
+    night_leave_count   = [None] * n_days  # 夜間離床次數（使用 asleep_leave）
+
+    # 評分用的每日欄位（report_scoring 會再套一次有效天規則）
+    cols = report_scoring.empty_columns(n_days)
+
+    # 逐日處理（對齊到「這個月的每一天」）
+    for i in range(n_days):
+        d = start_date + timedelta(days=i)
+        labels.append(d.strftime("%Y-%m-%d"))
+        rec = day_records.get(d)
+
+        # 完全沒 daily 資料的日子、無效天 → 全部 None，不顯示也不算平均
+        if rec is None or not rec["valid"]:
+            continue
+
+        # -------- 這裡開始是「有效天」 --------
+
+        # 1. 每日呼吸紀錄
+        resp_rate[i] = rec["resp"]
+
+        # 2. 上床時間（轉成 20~32 小時）
+        start_h = rec["asleep_hour"]
+        asleep_start_hours[i] = start_h
+
+        # 2b. 夜間休息時段（起點 = asleep_start, 終點 = asleep_start + night_sleep）
+        if start_h is not None and rec["night_sleep"] is not None:
+            night_sleep_range[i] = [start_h, start_h + rec["night_sleep"]]
+
+        # 3. 全日離床總時長 = 24 - day_on_bed - night_on_bed
+        leave_bed_total[i] = rec["leave_total"]
+
+        # 4. 日夜翻身平均間隔（分鐘）──來自 N_bq_Duration24（> 720 分鐘已排除）
+        night_turn_interval[i] = rec["night_turn"]
+        day_turn_interval[i] = rec["day_turn"]
+
+        # 5. 夜間最長臥床時長 (from N_bq_Duration24 每天 duration 最大值，小時)
+        night_bed_hours[i] = rec["duration_max"] if rec["duration_max"] is not None else 0
+
+        # 6. 夜間離床次數：改用 asleep_leave（睡眠期間離床次數）
+        night_leave_count[i] = rec["asleep_leave"] if rec["asleep_leave"] is not None else 0
+
+        # 評分用欄位
+        for name, v in (
+            ("night_on_bed", rec["night_on_bed"]),
+            ("night_sleep", rec["night_sleep"]),
+            ("sleep_respiration", rec["resp"]),
+            ("day_on_bed", rec["day_on_bed"]),
+            ("day_leave", rec["day_leave"]),
+            ("asleep_leave", rec["asleep_leave"]),
+            ("std_dev", rec["std_dev"]),
+            ("asleep_start_hour", start_h),
+            ("night_turn", rec["night_turn"]),
+            ("day_turn", rec["day_turn"]),
+        ):
+            if v is not None:
+                cols[name][i] = v
+
+    # ===== 評分與報表類型（report_scoring 一次算完） =====
+    scores = report_scoring.score_month(cols, force_mode)
+
+    # 沒有資料時，月平均以 0 表示（跟頁面上原本的顯示一致）
+    avg_day_leave = scores["avg_day_leave"] if scores["avg_day_leave"] is not None else 0.0
+    avg_onbed_total = scores["avg_onbed_total"] if scores["avg_onbed_total"] is not None else 0.0
+    report_type = scores["report_type"]
+
+    logger.debug(
+        "report_type=%s (force_mode=%s), avg_day_leave=%.2f, avg_onbed_total=%.2f, "
+        "avg_night_leave_for_mode=%s, resident_id=%s",
+        report_type, force_mode, avg_day_leave, avg_onbed_total, scores["avg_night_leave"], resident_id,
+    )
+    logger.debug(
+        "scores: rr=%s (avg_rr=%s, avg_std=%s, slope=%s), active_daily=%s, bed_daily=%s, sleep=%s",
+        scores["rr_score"], scores["avg_rr"], scores["avg_std"], scores["slope"],
+        scores["active_daily_score"], scores["bed_daily_score"], scores["sleep_score"],
+    )
+
+    rr_score = scores["rr_score"]
+    daily_score = scores["daily_score"]
+    sleep_score = scores["sleep_score"]
+
+    metrics.record("compute", time_mod.perf_counter() - compute_started, STAGE_SECONDS, stage="month_compute")
+    return {
+        "report_year": report_year,
+        "report_month": report_month,
+        "start_date": start_date,
+        "end_date": end_date,
+        "labels": labels,
+        "resp_rate": resp_rate,
+        "night_sleep_range": night_sleep_range,
+        "asleep_start_hours": asleep_start_hours,
+        "leave_bed_total": leave_bed_total,
+        "night_turn_interval": night_turn_interval,
+        "day_turn_interval": day_turn_interval,
+        "night_bed_hours": night_bed_hours,
+        "night_leave_count": night_leave_count,
+        "report_type": report_type,
+        "avg_day_leave": avg_day_leave,
+        "avg_onbed_total": avg_onbed_total,
+        "rr_score": rr_score,
+        "daily_score": daily_score,
+        "sleep_score": sleep_score,
+    }
+
+
+# 半年報每月彙總的數值欄位（BigQuery 與 Python 兩種算法都回傳這些）
+HALF_MONTH_AGG_FIELDS = (
+    "avg_night_on_bed",
+    "avg_night_sleep",
+    "sum_night_on_bed",
+    "sum_night_sleep",
+    "avg_sleep_resp",
+    "avg_day_on_bed",
+    "avg_asleep_leave",
+    "avg_asleep_leave_min",
+    "avg_day_leave_total",
+    "avg_onbed_total",
+)
+
+
+def get_monthly_daily_aggregates(resident_id: int, start_date: date, end_date: date, latest_date=None):
+    """
+    半年報用：在 BigQuery 端套用「有效天」規則並依月份彙總，每個月只回傳一列
+    （SQL 在 BigQueryBackend.monthly_daily_aggregates）：
+      - 有效天：night_on_bed / night_sleep / sleep_respiration 任一為 0 → 排除；
+                night_on_bed < 2 小時 → 排除（NULL 不影響判斷，跟 Python 版一致）
+      - 各欄位月平均、night_on_bed / night_sleep 月總和（算休息效率用）
+      - days：該月有效天的 (d, asleep_start, night_sleep)，給上床時間與翻身間隔用
+    回傳 {(year, month): 彙總 dict}，欄位與 aggregate_day_records_by_month 相同
+    """
+    return cached_range_query(
+        "monthly_agg", resident_id, start_date, end_date,
+        lambda: _fetch_monthly_daily_aggregates(resident_id, start_date, end_date),
+        latest_date,
+    )
+
+
+def _fetch_monthly_daily_aggregates(resident_id: int, start_date: date, end_date: date):
+    result = {}
+    for r in data_backend().monthly_daily_aggregates(resident_id, start_date, end_date):
+        agg = {name: to_float_or_none(r[name]) for name in HALF_MONTH_AGG_FIELDS}
+        agg["days"] = [
+            {"d": day["d"], "asleep_start": day["asleep_start"], "night_sleep": to_float_or_none(day["night_sleep"])}
+            for day in (r["days"] or [])
+        ]
+        result[(int(r["y"]), int(r["m"]))] = agg
+    return result
+
+
+def add_month_turn_averages(month_aggs, flip_index):
+    """
+    BigQuery 的月彙總（get_monthly_daily_aggregates）補上
+    avg_asleep_hour / avg_night_turn / avg_day_turn：用該月每個有效天的 asleep_start、night_sleep，
+    翻身時間來自 N_bq_Duration24（flip_index）；回傳新的 dict，不修改傳進來的（可能是快取裡的物件）
     """
-    半年追蹤報表：
+    def avg_or_none(values):
+        return sum(values) / len(values) if values else None
 
-      - 以 URL year/month 為「當月」，回溯包含當月在內共 6 個月。
-      - 報表類型判斷：
-          * 若 URL 有 ?mode=bed / ?mode=active → 直接沿用
-          * 否則，使用與 /report 相同的規則，
-            以「當月有效天的 (night_on_bed + day_on_bed) 平均」及「asleep_leave 平均」判斷：
-               (night_on_bed + day_on_bed) 平均 >= 10 且 asleep_leave 平均 <= 1 → 臥床模板 (bed)
-               否則 → 離床模板 (active)
-      - 離床模板 (report_type='active')：
-          圖1：每月平均夜間在床 / 休息時長
-      - 臥床模板 (report_type='bed')：
-          圖1：每月平均日夜翻身間隔
+    result = {}
+    for key, agg in month_aggs.items():
+        asleep_hours = []
+        night_turns = []
+        day_turns = []
+        turn_days = {}
+        for day in agg["days"]:
+            t = parse_time_of_day(day["asleep_start"])
+            h = convert_asleep_start_to_hour(t)
+            if h is not None:
+                asleep_hours.append(h)
+            if day["night_sleep"] is not None:
+                turn_days[day["d"]] = (t, day["night_sleep"])
+        for d_val, (t, night_sleep) in turn_days.items():
+            night_start_dt, night_end_dt = build_night_interval_for_day(d_val, t, night_sleep)
+            if night_start_dt is None or night_end_dt is None:
+                continue
+            # 過濾 > 12 小時的異常值（720 分鐘）
+            night_avg_min, day_avg_min = flip_index.day_night_avg_intervals(
+                d_val, night_start_dt, night_end_dt, max_minutes=TURN_INTERVAL_MAX_MIN
+            )
+            if night_avg_min is not None:
+                night_turns.append(night_avg_min)
+            if day_avg_min is not None:
+                day_turns.append(day_avg_min)
+
+        result[key] = dict(
+            agg,
+            avg_asleep_hour=avg_or_none(asleep_hours),
+            avg_night_turn=avg_or_none(night_turns),
+            avg_day_turn=avg_or_none(day_turns),
+        )
+    return result
+
+
+def aggregate_day_records_by_month(records_by_month):
+    """
+    半年報的每月彙總（Python 版）：從 day records 算，
+    欄位與 get_monthly_daily_aggregates + add_month_turn_averages 相同
+    （avg_asleep_hour / avg_night_turn / avg_day_turn 直接從逐日結果平均）；
+    沒有有效天的月份不會出現
+    """
+    def avg_or_none(values):
+        return sum(values) / len(values) if values else None
+
+    result = {}
+    for key, records in records_by_month.items():
+        valid = [rec for rec in records if rec["valid"]]
+        if not valid:
+            continue
+
+        def column(name):
+            return [rec[name] for rec in valid if rec[name] is not None]
+
+        night_on_bed = column("night_on_bed")
+        night_sleep = column("night_sleep")
+        both = [rec for rec in valid if rec["day_on_bed"] is not None and rec["night_on_bed"] is not None]
+
+        # 翻身間隔：一天一筆（同一天有多筆時用最後一筆有 night_sleep 的），夜間區間建不起來的天略過
+        turn_days = {rec["d"]: rec for rec in valid if rec["night_sleep"] is not None}
+        turn_days = [rec for rec in turn_days.values() if rec["night_interval"]]
+
+        result[key] = {
+            "avg_night_on_bed": avg_or_none(night_on_bed),
+            "avg_night_sleep": avg_or_none(night_sleep),
+            "sum_night_on_bed": sum(night_on_bed) if night_on_bed else None,
+            "sum_night_sleep": sum(night_sleep) if night_sleep else None,
+            "avg_sleep_resp": avg_or_none(column("resp")),
+            "avg_day_on_bed": avg_or_none(column("day_on_bed")),
+            "avg_asleep_leave": avg_or_none(column("asleep_leave")),
+            "avg_asleep_leave_min": avg_or_none(column("asleep_leave_min")),
+            "avg_day_leave_total": avg_or_none(
+                [max(24.0 - rec["day_on_bed"] - rec["night_on_bed"], 0.0) for rec in both]
+            ),
+            "avg_onbed_total": avg_or_none([rec["night_on_bed"] + rec["day_on_bed"] for rec in both]),
+            "avg_asleep_hour": avg_or_none(column("asleep_hour")),
+            "avg_night_turn": avg_or_none([rec["night_turn"] for rec in turn_days if rec["night_turn"] is not None]),
+            "avg_day_turn": avg_or_none([rec["day_turn"] for rec in turn_days if rec["day_turn"] is not None]),
+        }
+    return result
+
+
+def build_half_report_context(resident_id: int, report_year: int, report_month: int, force_mode=None,
+                              aggregate_in_bq=None):
+    """
+    計算半年追蹤報表需要的數值（不含住民資訊與 Sheet 評語）：
+      - 以 report_year/report_month 為「當月」，回溯包含當月在內共 6 個月
+      - 有效天規則與 /report 相同
+      - force_mode 為 'bed' / 'active' 時強制使用該報表類型，
+        否則以「當月」資料用與 /report 相同的規則判斷
+      - 共用快取裡已經有 day records 的月份（例如看過的月報、上一次的半年報）直接彙總
+      - 其他月份：aggregate_in_bq 為 True → 在 BigQuery 彙總（每月一列）；
+        False → 算出 day records（也存進快取）再彙總；None → 依 HALF_REPORT_AGGREGATE_IN_BQ
+    """
+    if aggregate_in_bq is None:
+        # 資料來源不是 BigQuery（本機副本 / 假資料）時一律在 Python 彙總
+        aggregate_in_bq = HALF_REPORT_AGGREGATE_IN_BQ and data_backend().supports_monthly_aggregates
+
+    # ===== 半年月份清單（含當月，共 6 個） =====
+    def shift_month(year: int, month: int, offset: int):
+        base = year * 12 + (month - 1) + offset
+        y = base // 12
+        m = base % 12 + 1
+        return y, m
+
+    month_keys = []      # [(y,m), ...]
+    labels_months = []   # ["2025/05", ...]
+    for i in range(-5, 1):  # -5, -4, -3, -2, -1, 0
+        y, m = shift_month(report_year, report_month, i)
+        month_keys.append((y, m))
+        labels_months.append(f"{y}/{m:02d}")
+
+    # ===== 每月彙總（有效天規則跟 /report 一致） =====
+    latest_date = get_latest_created_date(resident_id)
+    records = get_day_records_for_months(resident_id, month_keys, latest_date, cached_only=aggregate_in_bq)
+    month_aggs = aggregate_day_records_by_month(records)
+
+    # 快取裡沒有的月份在 BigQuery 彙總；月彙總與翻身資料兩個查詢同時送出
+    missing = [key for key in month_keys if key not in records]
+    if missing:
+        start_date = month_date_range(*missing[0])[0]
+        end_date = month_date_range(*missing[-1])[1]
+        range_data = load_resident_range(resident_id, start_date, end_date, latest_date)
+        agg_future = submit_fetch(get_monthly_daily_aggregates, resident_id, start_date, end_date, latest_date)
+        range_data.prefetch(daily=False)
+        bq_aggs = wait_fetch(agg_future, "monthly aggregates")
+        bq_aggs = {key: agg for key, agg in bq_aggs.items() if key in missing}
+        month_aggs.update(add_month_turn_averages(bq_aggs, range_data.flip_index))
+    compute_started = time_mod.perf_counter()
+
+    # ===== 依月份計算各圖表需要的數列 =====
+    chart1_night_on_bed = []
+    chart1_night_sleep = []
+    chart1_night_turn = []  # 夜間翻身平均間隔（分鐘）
+    chart1_day_turn = []    # 日間翻身平均間隔（分鐘）
+
+    chart2_eff_percent = []
+    chart2_leave_count = []
+
+    chart3_resp = []
+    chart4_leave_min = []
+    chart4_day_on_bed = []     # ★ 每月平均日間在床
+    chart4_night_on_bed = []   # ★ 每月平均夜間在床
+    chart5_asleep_hour = []
+    chart5_day_leave_hours = []  # 臥床模板用（日間離床小時）
+
+    empty_agg = dict.fromkeys(HALF_MONTH_AGG_FIELDS + ("avg_asleep_hour", "avg_night_turn", "avg_day_turn"))
+    for key in month_keys:
+        agg = month_aggs.get(key) or empty_agg
+
+        # 圖1（離床模板用）：夜間在床 / 夜間休息
+        chart1_night_on_bed.append(agg["avg_night_on_bed"])
+        chart1_night_sleep.append(agg["avg_night_sleep"])
+
+        # 圖1（臥床模板用）：日 / 夜翻身平均間隔
+        chart1_night_turn.append(agg["avg_night_turn"])
+        chart1_day_turn.append(agg["avg_day_turn"])
+
+        # 圖2：夜間休息效率 & 離床次數
+        sum_on_bed = agg["sum_night_on_bed"] or 0.0
+        sum_sleep = agg["sum_night_sleep"] or 0.0
+        if sum_on_bed > 0 and sum_sleep > 0:
+            eff = (sum_sleep / sum_on_bed) * 100.0
+        else:
+            eff = None
+        chart2_eff_percent.append(eff)
+        chart2_leave_count.append(agg["avg_asleep_leave"])
+
+        # 圖3：每月平均呼吸
+        chart3_resp.append(agg["avg_sleep_resp"])
+
+        # 圖4：每月平均夜間離床狀況（分鐘，用 asleep_leave_minute）
+        chart4_leave_min.append(agg["avg_asleep_leave_min"])
+
+        # ★ 圖4（臥床模板用）：每月平均日間 / 夜間在床時間（小時）
+        chart4_day_on_bed.append(agg["avg_day_on_bed"])
+        chart4_night_on_bed.append(agg["avg_night_on_bed"])
+
+        # 圖5：上床時間 / 日間離床
+        chart5_asleep_hour.append(agg["avg_asleep_hour"])
+        chart5_day_leave_hours.append(agg["avg_day_leave_total"])
+
+    chart1_data = {
+        "night_on_bed": chart1_night_on_bed,
+        "night_sleep": chart1_night_sleep,
+        "night_turn": chart1_night_turn,
+        "day_turn": chart1_day_turn,
+    }
+    chart2_data = {
+        "efficiency_percent": chart2_eff_percent,
+        "leave_count": chart2_leave_count,
+    }
+    chart3_data = chart3_resp
+    chart4_data = {
+        "leave_min": chart4_leave_min,
+        "day_on_bed": chart4_day_on_bed,
+        "night_on_bed": chart4_night_on_bed,
+    }
+    chart5_data = {
+        "asleep_start_hour": chart5_asleep_hour,
+        "day_leave_hours": chart5_day_leave_hours,
+    }
+
+    # ===== 根據「當月」資料決定 report_type（若沒強制 mode） =====
+    avg_onbed_total = None
+    avg_night_leave_for_mode = None
+
+    if force_mode not in ("bed", "active"):
+        base_agg = month_aggs.get((report_year, report_month))
+        if base_agg:
+            avg_onbed_total = base_agg["avg_onbed_total"]
+            avg_night_leave_for_mode = base_agg["avg_asleep_leave"]
+
+    report_type = report_scoring.decide_report_type(
+        avg_onbed_total, avg_night_leave_for_mode, force_mode
+    )
+
+    logger.debug(
+        "/half_report type=%s, avg_onbed_total=%s, avg_night_leave_for_mode=%s",
+        report_type, avg_onbed_total, avg_night_leave_for_mode,
+    )
+
+    metrics.record("compute", time_mod.perf_counter() - compute_started, STAGE_SECONDS, stage="half_compute")
+    return {
+        "report_type": report_type,
+        "report_year": report_year,
+        "report_month": report_month,
+        "labels_months": labels_months,
+        "chart1_data": chart1_data,
+        "chart2_data": chart2_data,
+        "chart3_data": chart3_data,
+        "chart4_data": chart4_data,
+        "chart5_data": chart5_data,
+    }
+
+
+def build_30days_context(resident_id: int, year: int, month: int):
+    """
+    30日作息頁的資料：{"year", "month", "windows": [{"date", "label", "slots"}, ...], "hour_labels"}
+      - 第一條從上個月最後一天 12:00 開始，一共（該月天數 + 1）條，每條 48 格
+    """
+    # 該月有幾天
+    days_in_month = monthrange(year, month)[1]
+
+    # 前一個月的年月
+    if month == 1:
+        prev_year = year - 1
+        prev_month = 12
+    else:
+        prev_year = year
+        prev_month = month - 1
+
+    # 前一個月最後一天
+    prev_month_last_day = monthrange(prev_year, prev_month)[1]
+    first_window_date = date(prev_year, prev_month, prev_month_last_day)
+
+    # 要畫的所有「起始日」（每個起始日代表：起始日 12:00 ~ 起始日+1 天 12:00）
+    # 一共 days_in_month + 1 條
+    day_dates = [
+        first_window_date + timedelta(days=i)
+        for i in range(days_in_month + 1)
+    ]
+
+    # 一個 query 撈回所有條的 48 個 30 分鐘 slot
+    slot_matrix = get_30min_slots_for_range(resident_id, day_dates[0], day_dates[-1])
+
+    windows = []
+    for d, slots in zip(day_dates, slot_matrix):
+        start = d
+        end = d + timedelta(days=1)
+        label = f"{start.month}/{start.day} 12:00 - {end.month}/{end.day} 12:00"
+        windows.append({
+            "date": d,
+            "label": label,
+            "slots": slots,
+        })
+
+    # 時間軸標籤：12,13,...,23,00,01,...,11,12（畫在下面）
+    hour_labels = []
+    h = 12
+    for i in range(25):  # 25 個刻度
+        hour_labels.append((h + i) % 24)
+
+    return {
+        "year": year,
+        "month": month,
+        "windows": windows,
+        "hour_labels": hour_labels,
+    }
+
+
+def days30_data_version(resident_id: int, year: int, month: int, latest_date=None) -> str:
+    """30日作息的資料版本：最後一條畫到下個月 1 號 12:00，1 號過完才 closed，規則跟報表快照一樣"""
+    if latest_date is None:
+        latest_date = get_latest_created_date(resident_id)
+    return snapshot_data_version(year, month, latest_date)
+
+
+def build_agency_month_scores(agency_id: int, year: int, month: int):
+    """
+    機構總覽：一次算出某機構所有住民在 (year, month) 的月報評分。
+      - 住民清單、最新資料日、daily、N_bq_Duration24 各只查一次（所有住民一起查）
+      - 共用快取或快照裡已有同版本結果的住民直接用，只有缺的 / 過期的才查資料重算
+      - 計算規則跟 /report 完全相同（build_month_report_context）
+    回傳 list of dict：住民基本資料 + report_type / rr_score / daily_score / sleep_score
+    """
+    residents = list_active_residents(agency_id)
+    resident_ids = [r["resident_id"] for r in residents]
+    latest_dates = get_latest_created_dates(resident_ids)
+
+    cache = app_cache()
+    contexts = {}
+    stale_ids = []
+    for rid in resident_ids:
+        version = snapshot_data_version(year, month, latest_dates[rid])
+        key = report_cache_key("ctx", "month", rid, year, month, "auto", version)
+        ctx = cache.get(key)
+        if ctx is None:
+            stored_version, ctx = load_report_snapshot(rid, year, month, "month", "auto")
+            if ctx is None or stored_version != version:
+                stale_ids.append(rid)
+                continue
+            cache.set(key, ctx, REPORT_CONTEXT_CACHE_TTL)
+        contexts[rid] = ctx
+
+    if stale_ids:
+        start_date, end_date = month_date_range(year, month)
+        daily_future = submit_fetch(get_daily_for_residents_by_range, stale_ids, start_date, end_date)
+        turn_future = submit_fetch(
+            get_bed_turn_rows_for_residents_by_range,
+            stale_ids, start_date, end_date + timedelta(days=1),
+        )
+        daily_by_resident = wait_fetch(daily_future, "agency daily rows")
+        turns_by_resident = wait_fetch(turn_future, "agency bed turn rows")
+
+        for rid in stale_ids:
+            range_data = ResidentRangeData(
+                rid, start_date, end_date,
+                daily=daily_by_resident.get(rid) or DailyColumns(),
+                turn_rows=turns_by_resident.get(rid, []),
+            )
+            ctx = build_month_report_context(rid, year, month, range_data=range_data)
+            version = snapshot_data_version(year, month, latest_dates[rid])
+            save_report_snapshot(rid, year, month, "month", "auto", version, ctx)
+            cache.set(report_cache_key("ctx", "month", rid, year, month, "auto", version), ctx, REPORT_CONTEXT_CACHE_TTL)
+            contexts[rid] = ctx
+
+    results = []
+    for r in residents:
+        ctx = contexts[r["resident_id"]]
+        results.append({
+            "resident_id": r["resident_id"],
+            "resident_name": r.get("resident_name") or "",
+            "agency_name": r.get("agency_name") or "",
+            "codename": r.get("codename") or "",
+            "bed_number": r.get("bed_number") or "",
+            "serial_id": r.get("serial_id") or "",
+            "report_type": ctx["report_type"],
+            "rr_score": ctx["rr_score"],
+            "daily_score": ctx["daily_score"],
+            "sleep_score": ctx["sleep_score"],
+        })
+    return results
+
+
+# ================== 5. Routes ==================
+
+
+def render_page(template_name: str, **context):
+    """render_template，時間記成 Server-Timing 的 render"""
+    with metrics.timed("render", STAGE_SECONDS, stage="render"):
+        return render_template(template_name, **context)
+
+
+def session_resident() -> dict:
+    """目前登入住民的資訊（登入時存在 session）"""
+    return {
+        "resident_id": session["resident_id"],
+        "resident_name": session.get("resident_name", ""),
+        "serial_id": session.get("serial_id", ""),
+        "agency_id": session.get("agency_id", None),
+        "agency_name": session.get("agency_name", ""),
+        "codename": session.get("codename", ""),
+        "bed_number": session.get("bed_number", ""),
+    }
+
+
+def requested_report_month(resident_id: int):
+    """query string 的 year/month；沒給或不合法就用最新資料的年月。回傳 (year, month, 最新資料日)"""
+    arg_year = request.args.get("year", type=int)
+    arg_month = request.args.get("month", type=int)
+    last_date = get_latest_created_date(resident_id)
+    if arg_year and arg_month and 1 <= arg_month <= 12:
+        return arg_year, arg_month, last_date
+    return last_date.year, last_date.month, last_date
+
+
+@app.route("/")
+def index():
+    # 已登入就先到報表選擇頁，否則去 login
+    if "serial_id" in session:
+        return redirect(url_for("report_menu"))
+    return redirect(url_for("login"))
+
+
+@app.route("/login", methods=["GET", "POST"])
+def login():
+    if request.method == "GET":
+        session.clear()
+    """
+    登入頁面：
+      帳號：serial_id（設備序號）
+      密碼：agency_id（客戶編號）
+    只有 note='C' 且 serial_id 不為空的住民可以登入
+    """
+    error = None
+
+    if request.method == "POST":
+        serial_id = request.form.get("serial_id", "").strip()
+        agency_id_str = request.form.get("agency_id", "").strip()
+
+        if not serial_id or not agency_id_str:
+            error = "請輸入設備序號與客戶編號。"
+        else:
+            try:
+                agency_id = int(agency_id_str)
+            except ValueError:
+                error = "客戶編號（AGENCY_ID）必須是數字。"
+            else:
+                resident = get_resident_by_login(serial_id, agency_id)
+                if resident is None:
+                    error = "帳號或密碼錯誤，或該帳號未開啟（note 不是 C / serial_id 為空）。"
+                else:
+                    # 登入成功，把必要資訊寫進 session
+                    session["serial_id"] = resident["serial_id"]
+                    session["agency_id"] = resident["agency_id"]
+                    session["resident_id"] = resident["resident_id"]
+                    session["resident_name"] = resident.get("resident_name") or ""
+                    session["agency_name"] = resident.get("agency_name") or ""
+                    session["codename"] = resident.get("codename") or ""
+                    session["bed_number"] = resident.get("bed_number") or ""
+                    return redirect(url_for("report_menu"))
+
+    return render_template("login.html", error=error)
+
+
+@app.route("/logout")
+@login_required
+def logout():
+    session.clear()
+    return redirect(url_for("login"))
+
+
+@app.route("/report_menu")
+@login_required
+def report_menu():
+    """
+    報表選單頁：
+      - 顯示住民資訊
+      - 提供選擇年份 / 月份
+      - 可以連到 月報 / 30日作息
     """
     resident_id = session["resident_id"]
-    resident = {
+
+    resident_info = {
         "resident_id": resident_id,
         "resident_name": session.get("resident_name", ""),
         "serial_id": session.get("serial_id", ""),
@@ -1630,429 +3019,309 @@ def half_report():
         "bed_number": session.get("bed_number", ""),
     }
 
-    # 取得基準年月：URL > 最新 daily
-    arg_year = request.args.get("year", type=int)
-    arg_month = request.args.get("month", type=int)
-    if arg_year and arg_month and 1 <= arg_month <= 12:
-        report_year, report_month = arg_year, arg_month
-    else:
-        last_date = get_latest_created_date(resident_id)
-        report_year, report_month = last_date.year, last_date.month
-
-    # 先記住 URL 的 mode，實際 report_type 之後再決定
-    force_mode = request.args.get("mode")
+    last_date = get_latest_created_date(resident_id)
+    default_year = last_date.year
+    default_month = last_date.month
 
-    # ===== 半年月份清單（含當月，共 6 個） =====
-    def shift_month(year: int, month: int, offset: int):
-        base = year * 12 + (month - 1) + offset
-        y = base // 12
-        m = base % 12 + 1
-        return y, m
+    return render_template(
+        "report_menu.html",
+        resident=resident_info,
+        default_year=default_year,
+        default_month=default_month,
+    )
 
-    month_keys = []      # [(y,m), ...]
-    labels_months = []   # ["2025/05", ...]
-    for i in range(-5, 1):  # -5, -4, -3, -2, -1, 0
-        y, m = shift_month(report_year, report_month, i)
-        month_keys.append((y, m))
-        labels_months.append(f"{y}/{m:02d}")
 
-    # 查詢範圍：最早月份 1 號 ~ 當月最後一天
-    first_year, first_month = month_keys[0]
-    start_date = date(first_year, first_month, 1)
-    last_year, last_month = month_keys[-1]
-    end_date = date(last_year, last_month, monthrange(last_year, last_month)[1])
-    end_date_plus1 = end_date + timedelta(days=1)
+@app.route("/daily")
+@login_required
+def daily():
+    """
+    已登入使用者的頁面：
+      1. 上方可以輸入 年份 + 月份，切換該月份資料
+      2. 若沒給 year/month，就自動抓「這位住民最後一筆 created_at 的年月」
+      3. 顯示 resdient_agency_device 的基本資料
+      4. 顯示該月份在 DAILY_TABLE 的資料（列表）
+      5. 顯示 Google Sheet「本月評語摘要」列表
+    """
 
-    # ===== 從 DAILY_TABLE 撈出半年內所有 daily 資料 =====
-    query = f"""
-    SELECT
-      DATE(created_at) AS d,
-      night_on_bed,
-      night_sleep,
-      sleep_respiration,
-      day_on_bed,
-      day_leave,
-      night_leave,
-      asleep_leave,
-      asleep_leave_minute,
-      asleep_start
-    FROM {DAILY_TABLE}
-    WHERE
-      resident_id = @resident_id
-      AND DATE(created_at) BETWEEN @start_date AND @end_date
-    ORDER BY d
-    """
-
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("resident_id", "INT64", resident_id),
-            bigquery.ScalarQueryParameter("start_date", "DATE", start_date),
-            bigquery.ScalarQueryParameter("end_date", "DATE", end_date),
-        ]
-    )
+    resident_id = session["resident_id"]
 
-    rows = [dict(r) for r in bq_client.query(query, job_config=job_config).result()]
+    # 讀取 query string 的 year / month，例如 /daily?year=2025&month=10
+    arg_year = request.args.get("year", type=int)
+    arg_month = request.args.get("month", type=int)
 
-    # ===== 逐日分配到對應月份，並套用「有效天」規則（跟 /report 一致） =====
-    def to_float(x):
-        if x is None or x == "":
-            return None
-        try:
-            return float(x)
-        except (TypeError, ValueError):
-            return None
+    if arg_year and arg_month and 1 <= arg_month <= 12:
+        year, month = arg_year, arg_month
+    else:
+        # 沒指定或有誤 → 用這個 resident 的最新一筆 created_at 當預設年月
+        last_date = get_latest_created_date(resident_id)
+        year, month = last_date.year, last_date.month
 
-    # 每月統計：畫圖用
-    month_stats = {
-        key: {
-            "night_on_bed": [],
-            "night_sleep": [],
-            "sleep_resp": [],
-            "day_on_bed": [],  # 新增：紀錄 day_on_bed
-            "day_leave": [],  # 保留原本欄位（若之後還要用）
-            "day_leave_total": [],  # ★ 新增：24 - day_on_bed - night_on_bed
-            "night_leave": [],
-            "asleep_leave_min": [],
-            "asleep_start_hour": [],
-        }
-        for key in month_keys
-    }
+    # 該月份的起訖日期
+    start_date = date(year, month, 1)
+    if month == 12:
+        end_date = date(year + 1, 1, 1) - timedelta(days=1)
+    else:
+        end_date = date(year, month + 1, 1) - timedelta(days=1)
 
-    # 每月統計：臥床 / 離床 判斷用
-    month_mode_stats = {
-        key: {
-            "sum_onbed_total": 0.0,
-            "cnt_onbed_total": 0,
-            "sum_asleep_leave": 0.0,
-            "cnt_asleep_leave": 0,
-        }
-        for key in month_keys
+    resident_info = {
+        "resident_id": resident_id,
+        "resident_name": session.get("resident_name", ""),
+        "serial_id": session.get("serial_id", ""),
+        "agency_id": session.get("agency_id", ""),
+        "agency_name": session.get("agency_name", ""),
+        "codename": session.get("codename", ""),
+        "bed_number": session.get("bed_number", ""),
     }
 
-    # 給「翻身間隔」用：記錄「有效天」的 night_sleep / asleep_start
-    daily_for_turn = {}
+    # 評語與 daily 資料同時查詢
+    comments_future = submit_fetch(
+        get_month_comments_from_sheet, session["serial_id"], session["agency_id"], year, month
+    )
+    daily_list = get_daily_for_resident_by_range(resident_id, start_date, end_date)
 
-    for row in rows:
-        d_val = row.get("d")
-        if isinstance(d_val, datetime):
-            d_val = d_val.date()
-        if not isinstance(d_val, date):
-            continue
+    logger.debug("/daily resident_id=%s range=%s~%s rows=%d", resident_id, start_date, end_date, len(daily_list))
 
-        key = (d_val.year, d_val.month)
-        if key not in month_stats:
-            continue
+    # ---------- 組 HTML ----------
 
-        v_night_on_bed = to_float(row.get("night_on_bed"))
-        v_night_sleep   = to_float(row.get("night_sleep"))
-        v_resp          = to_float(row.get("sleep_respiration"))
-        v_day_on_bed    = to_float(row.get("day_on_bed"))
-        v_asleep_leave  = to_float(row.get("asleep_leave"))
-
-        # 「有效天」判斷：night_on_bed / night_sleep / resp 有 0 或 night_on_bed < 2 小時 → 略過
-        invalid = False
-        for v in (v_night_on_bed, v_night_sleep, v_resp):
-            if v is not None and v == 0:
-                invalid = True
-                break
-        if (not invalid) and v_night_on_bed is not None and v_night_on_bed < 2:
-            invalid = True
-        if invalid:
-            continue
+    html = []
 
-        ms = month_stats[key]
-
-        if v_night_on_bed is not None:
-            ms["night_on_bed"].append(v_night_on_bed)
-        if v_night_sleep is not None:
-            ms["night_sleep"].append(v_night_sleep)
-        if v_resp is not None:
-            ms["sleep_resp"].append(v_resp)
-
-        # 讀 day_on_bed
-        v_day_on_bed = to_float(row.get("day_on_bed"))
-        if v_day_on_bed is not None:
-            ms["day_on_bed"].append(v_day_on_bed)
-
-        # 原本的 day_leave 欄位照存
-        v_day_leave = to_float(row.get("day_leave"))
-        if v_day_leave is not None:
-            ms["day_leave"].append(v_day_leave)
-
-        # ★ 新增：用 day_on_bed + night_on_bed 算「全日離床時長」
-        if (v_day_on_bed is not None) and (v_night_on_bed is not None):
-            leave_total = 24.0 - v_day_on_bed - v_night_on_bed
-            if leave_total < 0:
-                leave_total = 0.0
-            ms["day_leave_total"].append(leave_total)
-
-        # 夜間休息離床次數：一律改用 asleep_leave（睡眠期間離床次數）
-        v_asleep_leave = to_float(row.get("asleep_leave"))
-        if v_asleep_leave is not None:
-            # 為了不改前端變數名稱，仍然塞到 night_leave 陣列，但內容其實是 asleep_leave
-            ms["night_leave"].append(v_asleep_leave)
-
-        v_asleep_leave_min = to_float(row.get("asleep_leave_minute"))
-        if v_asleep_leave_min is not None:
-            ms["asleep_leave_min"].append(v_asleep_leave_min)
-
-        # 給「臥床 / 離床」判斷用的累計（跟 /report 規則一致）
-        mode_ms = month_mode_stats[key]
-        if (v_night_on_bed is not None) and (v_day_on_bed is not None):
-            mode_ms["sum_onbed_total"] += (v_night_on_bed + v_day_on_bed)
-            mode_ms["cnt_onbed_total"] += 1
-        if v_asleep_leave is not None:
-            mode_ms["sum_asleep_leave"] += v_asleep_leave
-            mode_ms["cnt_asleep_leave"] += 1
-
-        # 上床時間...
-        h = convert_asleep_start_to_hour(row.get("asleep_start"))
-        if h is not None:
-            ms["asleep_start_hour"].append(h)
-
-        # 給「翻身間隔」用：記錄這個有效天的 night_sleep / asleep_start
-        if v_night_sleep is not None:
-            daily_for_turn[d_val] = {
-                "night_sleep": v_night_sleep,
-                "asleep_start": row.get("asleep_start"),
-            }
+    # 月份選擇表單
+    html.append("<h2>月份選擇</h2>")
+    html.append('<form method="get" action="/daily">')
+    html.append(
+        '年份：<input type="number" name="year" value="{}" style="width:80px;">'.format(
+            year
+        )
+    )
+    html.append(
+        '　月份：<input type="number" name="month" min="1" max="12" value="{}" style="width:60px;">'.format(
+            month
+        )
+    )
+    html.append('　<button type="submit">切換月份</button>')
+    html.append("</form>")
 
-    def avg_or_none(values):
-        return sum(values) / len(values) if values else None
+    # 同月份月報連結
+    report_url = url_for("report", year=year, month=month)
+    html.append(f'<p><a href="{report_url}">查看 {year}-{month:02d} 月月報</a></p>')
 
-    # ===== 日夜翻身間隔（半年度）：來自 N_bq_Duration24 =====
-    turn_query = f"""
-    SELECT
-      DATE(created_at) AS d,
-      time_start
-    FROM {DURATION_TABLE}
-    WHERE
-      resident_id = @resident_id
-      AND bed_state = '09'
-      AND DATE(created_at) BETWEEN @start_date AND @end_date_plus1
-      -- ★ 新增：半年翻身圖一樣忽略 duration > 15 小時的段
-      AND (
-        SAFE_CAST(duration AS FLOAT64) IS NULL
-        OR SAFE_CAST(duration AS FLOAT64) <= 15 * 3600
-      )
-    ORDER BY d, time_start
-    """
-
-    turn_job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("resident_id", "INT64", resident_id),
-            bigquery.ScalarQueryParameter("start_date", "DATE", start_date),
-            bigquery.ScalarQueryParameter("end_date_plus1", "DATE", end_date_plus1),
-        ]
-    )
+    # 住民基本資料
+    html.append("<h2>住民基本資料</h2>")
+    html.append('<table border="1" cellspacing="0" cellpadding="4">')
+    html.append("<tr><th>欄位</th><th>值</th></tr>")
+    for k, v in resident_info.items():
+        cell = "" if v is None else str(v)
+        html.append(f"<tr><td>{k}</td><td>{cell}</td></tr>")
+    html.append("</table>")
 
-    turn_rows = list(bq_client.query(turn_query, job_config=turn_job_config).result())
-    flip_datetimes = []
-    for r in turn_rows:
-        d_val = r["d"]
-        if isinstance(d_val, datetime):
-            d_val = d_val.date()
-        date_part = d_val
+    # ======= 讀取當月評語（來自 Google Sheet），直接列為摘要清單 =======
+    month_comments = wait_fetch(comments_future, "sheet comments", default=empty_month_comments())
 
-        t_val = r["time_start"]
-        if isinstance(t_val, datetime):
-            t_obj = t_val.time()
-        elif isinstance(t_val, time):
-            t_obj = t_val
-        else:
-            s = str(t_val)
-            t_obj = None
-            for fmt in ("%H:%M:%S", "%H:%M"):
-                try:
-                    t_obj = datetime.strptime(s, fmt).time()
-                    break
-                except ValueError:
-                    continue
-            if t_obj is None:
-                continue
+    # 顯示評語（為了易讀，做個中文標題對照）
+    label_map = [
+        ("active_summary",       "（離床）本月總結"),
+        ("active_resp",          "（離床）月呼吸率紀錄"),
+        ("active_sleep_range",   "（離床）每日休息時段"),
+        ("active_asleep_start",  "（離床）每日上床休息時間"),
+        ("active_night_leave",   "（離床）夜間休息離床次數"),
+        ("active_trend",         "（離床）每月趨勢狀態"),
+        ("active_trend_summary", "（離床）月趨勢狀態總結"),
+        ("bed_summary",          "（臥床）本月總結"),
+        ("bed_resp",             "（臥床）月呼吸率紀錄"),
+        ("bed_night_bed",        "（臥床）夜間最長臥床時長"),
+        ("bed_leave_total",      "（臥床）日間離床總時長"),
+        ("bed_turn",             "（臥床）日夜翻身間隔"),
+        ("bed_trend",            "（臥床）每月趨勢狀態"),
+        ("bed_trend_summary",    "（臥床）月趨勢狀態總結"),
+    ]
 
-        flip_datetimes.append(datetime.combine(date_part, t_obj))
+    html.append("<h2>本月評語摘要</h2>")
+    any_comment = False
+    html.append('<ul style="line-height:1.6">')
+    for key, title in label_map:
+        text = (month_comments.get(key) or "").strip()
+        if text:
+            any_comment = True
+            text_html = text.replace("\n", "<br>")
+            html.append(f"<li><b>{title}</b>：{text_html}</li>")
+    html.append("</ul>")
+    if not any_comment:
+        html.append("<p>（本月無對應評語或 Google Sheet 未填寫。）</p>")
 
-    # 依「每天」計算日 / 夜翻身平均間隔，然後再依月份取平均
-    month_turn_stats = {
-        key: {"night": [], "day": []}
-        for key in month_keys
-    }
+    # 該月份 daily
+    html.append(f"<h2>{year}-{month:02d} DAILY 資料（{start_date} ~ {end_date}）</h2>")
 
-    for d_val, info in daily_for_turn.items():
-        night_sleep_hours = info["night_sleep"]
-        asleep_start_val = info["asleep_start"]
+    if not daily_list:
+        html.append("<p>這個月份沒有任何紀錄。（DEBUG: rows=0）</p>")
+    else:
+        fields = list(daily_list[0].keys())
+        html.append('<table border="1" cellspacing="0" cellpadding="4">')
+        html.append("<tr>")
+        for name in fields:
+            html.append(f"<th>{name}</th>")
+        html.append("</tr>")
+        for row in daily_list:
+            html.append("<tr>")
+            for name in fields:
+                value = row.get(name)
+                cell = "" if value is None else str(value)
+                html.append(f"<td>{cell}</td>")
+            html.append("</tr>")
+        html.append("</table>")
 
-        night_start_dt, night_end_dt = build_night_interval_for_day(
-            d_val, asleep_start_val, night_sleep_hours
-        )
-        if night_start_dt is None or night_end_dt is None:
-            continue
+    html.append('<p><a href="/logout">登出</a></p>')
 
-        night_avg_min, day_avg_min = compute_day_night_avg_intervals(
-            d_val, night_start_dt, night_end_dt, flip_datetimes
-        )
+    return "".join(html)
 
-        # 過濾 > 12 小時的異常值（720 分鐘）
-        if night_avg_min is not None and night_avg_min > 720:
-            night_avg_min = None
-        if day_avg_min is not None and day_avg_min > 720:
-            day_avg_min = None
 
-        key = (d_val.year, d_val.month)
-        if key not in month_turn_stats:
-            continue
-        if night_avg_min is not None:
-            month_turn_stats[key]["night"].append(night_avg_min)
-        if day_avg_min is not None:
-            month_turn_stats[key]["day"].append(day_avg_min)
+@app.route("/report")
+@login_required
+def report():
+    """
+    月報頁：
+      - 依照 query string year/month 顯示該月份資料
+      - 若沒給 year/month，就用這個 resident 最新一筆 created_at 的年月
+      - 判斷本月是「臥床報表」或「離床報表」
+      - 只使用「有效天」計算平均與畫圖
+        (night_on_bed / night_sleep / sleep_respiration 任何一個為 0 的天會被排除)
+      - 夜間最長臥床時長：從 N_bq_Duration24 找出 bed_state='09'、
+        每天 duration 最大值（秒），並轉成「小時」
+      - 全日離床總時長：24 - day_on_bed - night_on_bed
+      - 日夜平均翻身間隔：從 N_bq_Duration24 的翻身時間（time_start）計算
+      - 評語：從 Google Sheet 讀取
+      - 計算結果存成快照，已結束的月份之後直接讀快照（見 get_or_build_report_snapshot）
+    """
 
-    # ===== 依月份計算各圖表需要的數列 =====
-    chart1_night_on_bed = []
-    chart1_night_sleep = []
-    chart1_night_turn = []  # 夜間翻身平均間隔（分鐘）
-    chart1_day_turn = []    # 日間翻身平均間隔（分鐘）
+    resident_id = session["resident_id"]
+    serial_id = session.get("serial_id", "")
+    agency_id = session.get("agency_id", None)
 
-    chart2_eff_percent = []
-    chart2_leave_count = []
+    arg_year = request.args.get("year", type=int)
+    arg_month = request.args.get("month", type=int)
 
-    chart3_resp = []
-    chart4_leave_min = []
-    chart4_day_on_bed = []     # ★ 每月平均日間在床
-    chart4_night_on_bed = []   # ★ 每月平均夜間在床
-    chart5_asleep_hour = []
-    chart5_day_leave_hours = []  # 臥床模板用（日間離床小時）
+    # 最新資料日：沒給年月時當預設，也用來判斷快照是否過期
+    last_date = get_latest_created_date(resident_id)
+    if arg_year and arg_month and 1 <= arg_month <= 12:
+        report_year, report_month = arg_year, arg_month
+    else:
+        report_year, report_month = last_date.year, last_date.month
 
-    for key in month_keys:
-        ms = month_stats[key]
+    # 住民資訊（直接從 session 拿）
+    resident_info = {
+        "resident_id": resident_id,
+        "resident_name": session.get("resident_name", ""),
+        "serial_id": serial_id,
+        "agency_id": agency_id,
+        "agency_name": session.get("agency_name", ""),
+        "codename": session.get("codename", ""),
+        "bed_number": session.get("bed_number", ""),
+    }
 
-        # 圖1（離床模板用）：夜間在床 / 夜間休息
-        avg_on_bed = avg_or_none(ms["night_on_bed"])
-        avg_sleep = avg_or_none(ms["night_sleep"])
-        chart1_night_on_bed.append(avg_on_bed)
-        chart1_night_sleep.append(avg_sleep)
+    # ========== 讀 Google Sheet 評語（背景執行，跟月報計算同時進行） ==========
+    comments_future = submit_fetch(
+        get_month_comments_from_sheet, serial_id, agency_id, report_year, report_month
+    )
 
-        # 圖1（臥床模板用）：日 / 夜翻身平均間隔
-        mts = month_turn_stats.get(key, {"night": [], "day": []})
-        chart1_night_turn.append(avg_or_none(mts["night"]))
-        chart1_day_turn.append(avg_or_none(mts["day"]))
+    # ========== 月報數值：已結束的月份直接用快照 ==========
+    force_mode = request.args.get("mode")
+    ctx = get_or_build_report_snapshot(
+        "month", resident_id, report_year, report_month, force_mode,
+        lambda: build_month_report_context(resident_id, report_year, report_month, force_mode),
+        latest_date=last_date,
+    )
 
-        # 圖2：夜間休息效率 & 離床次數
-        sum_on_bed = sum(ms["night_on_bed"]) if ms["night_on_bed"] else 0.0
-        sum_sleep = sum(ms["night_sleep"]) if ms["night_sleep"] else 0.0
-        if sum_on_bed > 0 and sum_sleep > 0:
-            eff = (sum_sleep / sum_on_bed) * 100.0
-        else:
-            eff = None
-        chart2_eff_percent.append(eff)
-        chart2_leave_count.append(avg_or_none(ms["night_leave"]))
+    month_comments = wait_fetch(comments_future, "sheet comments", default=empty_month_comments())
 
-        # 圖3：每月平均呼吸
-        chart3_resp.append(avg_or_none(ms["sleep_resp"]))
+    # 根據 report_type 選擇要使用的模板
+    if ctx["report_type"] == "bed":
+        template_name = "month_bed.html"
+    else:
+        template_name = "month_active.html"
 
-        # 圖4：每月平均夜間離床狀況（分鐘，用 asleep_leave_minute）
-        chart4_leave_min.append(avg_or_none(ms["asleep_leave_min"]))
+    # 伺服器端畫好的圖；SERVER_CHARTS=0 時 charts 為 None，頁面改用 Chart.js
+    charts = None
+    if SERVER_CHARTS:
+        charts = get_report_charts("month", resident_id, report_year, report_month, force_mode, last_date, ctx)
 
-        # ★ 圖4（臥床模板用）：每月平均日間 / 夜間在床時間（小時）
-        chart4_day_on_bed.append(avg_or_none(ms["day_on_bed"]))
-        chart4_night_on_bed.append(avg_or_none(ms["night_on_bed"]))
+    return render_page(
+        template_name,
+        resident=resident_info,
+        month_comments=month_comments,
+        charts=charts,
+        **ctx,
+    )
 
-        # 圖5：上床時間 / 日間離床
-        chart5_asleep_hour.append(avg_or_none(ms["asleep_start_hour"]))
 
-        avg_day_leave_total_m = avg_or_none(ms["day_leave_total"])
-        chart5_day_leave_hours.append(
-            avg_day_leave_total_m if avg_day_leave_total_m is not None else None
-        )
+@app.route("/half_report", methods=["GET"])
+@login_required
+def half_report():
+    """
+    半年追蹤報表：
 
-    chart1_data = {
-        "night_on_bed": chart1_night_on_bed,
-        "night_sleep": chart1_night_sleep,
-        "night_turn": chart1_night_turn,
-        "day_turn": chart1_day_turn,
-    }
-    chart2_data = {
-        "efficiency_percent": chart2_eff_percent,
-        "leave_count": chart2_leave_count,
-    }
-    chart3_data = chart3_resp
-    chart4_data = {
-        "leave_min": chart4_leave_min,
-        "day_on_bed": chart4_day_on_bed,
-        "night_on_bed": chart4_night_on_bed,
-    }
-    chart5_data = {
-        "asleep_start_hour": chart5_asleep_hour,
-        "day_leave_hours": chart5_day_leave_hours,
+      - 以 URL year/month 為「當月」，回溯包含當月在內共 6 個月。
+      - 報表類型判斷：
+          * 若 URL 有 ?mode=bed / ?mode=active → 直接沿用
+          * 否則，使用與 /report 相同的規則，
+            以「當月有效天的 (night_on_bed + day_on_bed) 平均」及「asleep_leave 平均」判斷：
+               (night_on_bed + day_on_bed) 平均 >= 10 且 asleep_leave 平均 <= 1 → 臥床模板 (bed)
+               否則 → 離床模板 (active)
+      - 離床模板 (report_type='active')：
+          圖1：每月平均夜間在床 / 休息時長
+      - 臥床模板 (report_type='bed')：
+          圖1：每月平均日夜翻身間隔
+    """
+    resident_id = session["resident_id"]
+    resident = {
+        "resident_id": resident_id,
+        "resident_name": session.get("resident_name", ""),
+        "serial_id": session.get("serial_id", ""),
+        "agency_id": session.get("agency_id", ""),
+        "agency_name": session.get("agency_name", ""),
+        "codename": session.get("codename", ""),
+        "bed_number": session.get("bed_number", ""),
     }
 
-    # ===== 根據「當月」資料決定 report_type（若沒強制 mode） =====
-    avg_onbed_total = None
-    avg_night_leave_for_mode = None
-
-    if force_mode in ("bed", "active"):
-        report_type = force_mode
+    # 取得基準年月：URL > 最新 daily
+    arg_year = request.args.get("year", type=int)
+    arg_month = request.args.get("month", type=int)
+    last_date = get_latest_created_date(resident_id)
+    if arg_year and arg_month and 1 <= arg_month <= 12:
+        report_year, report_month = arg_year, arg_month
     else:
-        base_key = (report_year, report_month)
-        ms_mode = month_mode_stats.get(base_key)
-
-        if ms_mode:
-            if ms_mode["cnt_onbed_total"] > 0:
-                avg_onbed_total = (
-                    ms_mode["sum_onbed_total"] / ms_mode["cnt_onbed_total"]
-                )
-            if ms_mode["cnt_asleep_leave"] > 0:
-                avg_night_leave_for_mode = (
-                    ms_mode["sum_asleep_leave"] / ms_mode["cnt_asleep_leave"]
-                )
+        report_year, report_month = last_date.year, last_date.month
 
-        if (
-            avg_onbed_total is not None
-            and avg_onbed_total >= 10
-            and avg_night_leave_for_mode is not None
-            and avg_night_leave_for_mode <= 1
-        ):
-            report_type = "bed"
-        else:
-            report_type = "active"
+    # 先記住 URL 的 mode，實際 report_type 在計算時決定
+    force_mode = request.args.get("mode")
 
-    print(
-        f"[DEBUG] /half_report type={report_type}, "
-        f"avg_onbed_total={avg_onbed_total}, "
-        f"avg_night_leave_for_mode={avg_night_leave_for_mode}"
+    # Google Sheet 評語：讀取「當月」的評語（背景執行，跟半年計算同時進行）
+    comments_future = submit_fetch(
+        get_month_comments_from_sheet,
+        resident["serial_id"], resident["agency_id"], report_year, report_month,
     )
 
-    # Google Sheet 評語：讀取「當月」的評語（例如 2025/10）
-    month_comments = get_month_comments_from_sheet(
-        serial_id=resident["serial_id"],
-        agency_id=resident["agency_id"],
-        year=report_year,
-        month=report_month,
+    # ===== 半年數值：已結束的月份直接用快照 =====
+    ctx = get_or_build_report_snapshot(
+        "half", resident_id, report_year, report_month, force_mode,
+        lambda: build_half_report_context(resident_id, report_year, report_month, force_mode),
+        latest_date=last_date,
     )
+    report_type = ctx["report_type"]
 
-    # 半年摘要：依模板選擇對應欄位
-    if report_type == "bed":
-        half_summary = month_comments.get("bed_trend_summary", "")
-    else:
-        half_summary = month_comments.get("active_trend_summary", "")
+    month_comments = wait_fetch(comments_future, "sheet comments", default=empty_month_comments())
 
-    if not half_summary:
-        half_summary = "半年追蹤摘要尚未設定，之後可依照需求由後端帶入文字。"
+    half_summary = half_summary_text(month_comments, report_type)
 
-    return render_template(
+    charts = None
+    if SERVER_CHARTS:
+        charts = get_report_charts("half", resident_id, report_year, report_month, force_mode, last_date, ctx)
+
+    return render_page(
         "halfreport_report.html",
         resident=resident,
-        report_type=report_type,
-        report_year=report_year,
-        report_month=report_month,
-        labels_months=labels_months,
-        chart1_data=chart1_data,
-        chart2_data=chart2_data,
-        chart3_data=chart3_data,
-        chart4_data=chart4_data,
-        chart5_data=chart5_data,
         month_comments=month_comments,
         half_summary=half_summary,
+        charts=charts,
+        **ctx,
     )
 
 @app.route("/report_30days")
@@ -2095,58 +3364,311 @@ def report_30days():
         last_date = get_latest_created_date(resident_id)
         year, month = last_date.year, last_date.month
 
-    # 該月有幾天
-    days_in_month = monthrange(year, month)[1]
+    return render_page(
+        "30days_report.html",
+        resident=resident_info,
+        **build_30days_context(resident_id, year, month),
+    )
 
-    # 前一個月的年月
-    if month == 1:
-        prev_year = year - 1
-        prev_month = 12
+
+# ---------- JSON API（月報 / 半年報 / 30日作息的數值，支援 ETag 條件式 GET） ----------
+
+# 回傳格式有變就加 1，讓舊的 ETag 全部失效
+JSON_API_VERSION = 1
+
+
+def _json_ready(value):
+    """date → ISO 字串、NaN → null、tuple → list（jsonify 預設會把 date 轉成 HTTP 日期格式）"""
+    if isinstance(value, dict):
+        return {k: _json_ready(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_ready(v) for v in value]
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+def report_etag(*parts) -> str:
+    """
+    強 ETag：由報表種類、住民、年月、mode、資料版本（見 snapshot_data_version：最新 created_at 的日期，
+    下個月 1 號的資料也到齊才是 closed）、評語表版本等組成；任何一個變了 ETag 就跟著變
+    """
+    raw = "|".join(str(p) for p in (CACHE_KEY_VERSION, SNAPSHOT_SCHEMA_VERSION, JSON_API_VERSION) + parts)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:32]
+
+
+def conditional_json(etag: str, build):
+    """
+    If-None-Match 跟目前 ETag 相同 → 直接回 304，不做任何計算；
+    否則呼叫 build() 產生 JSON。瀏覽器每次都要重新驗證（no-cache），沒變就只拿到 304
+    """
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
     else:
-        prev_year = year
-        prev_month = month - 1
+        resp = jsonify(_json_ready(build()))
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
 
-    # 前一個月最後一天
-    prev_month_last_day = monthrange(prev_year, prev_month)[1]
-    first_window_date = date(prev_year, prev_month, prev_month_last_day)
 
-    # 要畫的所有「起始日」（每個起始日代表：起始日 12:00 ~ 起始日+1 天 12:00）
-    # 一共 days_in_month + 1 條
-    day_dates = [
-        first_window_date + timedelta(days=i)
-        for i in range(days_in_month + 1)
-    ]
+@app.route("/api/report")
+@login_required
+def api_report():
+    """月報數值（同 /report 頁面的內容）＋評語；參數同 /report"""
+    resident = session_resident()
+    resident_id = resident["resident_id"]
+    year, month, last_date = requested_report_month(resident_id)
+    force_mode = request.args.get("mode")
 
-    # 對每一條去撈 48 個 30 分鐘 slot
-    windows = []
-    for d in day_dates:
-        slots = get_30min_slots_for_date(resident_id, d)
-        start = d
-        end = d + timedelta(days=1)
-        label = f"{start.month}/{start.day} 12:00 - {end.month}/{end.day} 12:00"
-        windows.append({
-            "date": d,
-            "label": label,
-            "slots": slots,
-        })
+    etag = report_etag(
+        "month", json.dumps(resident, sort_keys=True, default=str), year, month, report_mode(force_mode),
+        snapshot_data_version(year, month, last_date), get_sheet_version(),
+    )
 
-    # 時間軸標籤：12,13,...,23,00,01,...,11,12（畫在下面）
-    hour_labels = []
-    h = 12
-    for i in range(25):  # 25 個刻度
-        hour_labels.append((h + i) % 24)
+    def build():
+        ctx = get_or_build_report_snapshot(
+            "month", resident_id, year, month, force_mode,
+            lambda: build_month_report_context(resident_id, year, month, force_mode),
+            latest_date=last_date,
+        )
+        month_comments = get_month_comments_from_sheet(resident["serial_id"], resident["agency_id"], year, month)
+        return {"resident": resident, "month_comments": month_comments, **ctx}
 
-    return render_template(
-        "30days_report.html",
-        resident=resident_info,
-        year=year,
-        month=month,
-        windows=windows,
-        hour_labels=hour_labels,
+    return conditional_json(etag, build)
+
+
+@app.route("/api/half_report")
+@login_required
+def api_half_report():
+    """半年報數值＋評語（含半年摘要）；參數同 /half_report"""
+    resident = session_resident()
+    resident_id = resident["resident_id"]
+    year, month, last_date = requested_report_month(resident_id)
+    force_mode = request.args.get("mode")
+
+    etag = report_etag(
+        "half", json.dumps(resident, sort_keys=True, default=str), year, month, report_mode(force_mode),
+        snapshot_data_version(year, month, last_date), get_sheet_version(),
+    )
+
+    def build():
+        ctx = get_or_build_report_snapshot(
+            "half", resident_id, year, month, force_mode,
+            lambda: build_half_report_context(resident_id, year, month, force_mode),
+            latest_date=last_date,
+        )
+        month_comments = get_month_comments_from_sheet(resident["serial_id"], resident["agency_id"], year, month)
+        return {
+            "resident": resident,
+            "month_comments": month_comments,
+            "half_summary": half_summary_text(month_comments, ctx["report_type"]),
+            **ctx,
+        }
+
+    return conditional_json(etag, build)
+
+
+@app.route("/api/report_30days")
+@login_required
+def api_report_30days():
+    """30日作息（每天 12:00 ~ 隔天 12:00，48 格）；參數同 /report_30days（沒有評語，ETag 不含評語表版本）"""
+    resident = session_resident()
+    resident_id = resident["resident_id"]
+    year, month, last_date = requested_report_month(resident_id)
+
+    etag = report_etag(
+        "30days", json.dumps(resident, sort_keys=True, default=str), year, month,
+        days30_data_version(resident_id, year, month, last_date),
+    )
+    return conditional_json(etag, lambda: {"resident": resident, **build_30days_context(resident_id, year, month)})
+
+
+def check_staff_login(username: str, password: str):
+    """照護人員帳號密碼檢查（STAFF_ACCOUNTS）；成功回傳帳號設定，失敗回傳 None"""
+    account = STAFF_ACCOUNTS.get(username)
+    if not account or not account.get("password_hash") or account.get("agency_id") is None:
+        return None
+    if not check_password_hash(account["password_hash"], password):
+        return None
+    return account
+
+
+@app.route("/staff_login", methods=["GET", "POST"])
+def staff_login():
+    """
+    照護人員登入（帳號設定在 STAFF_ACCOUNTS），登入後只能看自己機構的機構總覽；
+    跟家屬登入是不同的 session，登入時會清掉原本的 session
+    """
+    error = ""
+    if request.method == "POST":
+        username = request.form.get("username", "").strip()
+        account = check_staff_login(username, request.form.get("password", ""))
+        if account is None:
+            error = "帳號或密碼錯誤。"
+        else:
+            session.clear()
+            session["staff_user"] = username
+            session["staff_agency_id"] = int(account["agency_id"])
+            return redirect(url_for("agency_dashboard"))
+
+    html = ["<h2>照護人員登入</h2>"]
+    if error:
+        html.append(f'<p style="color:red;">{escape(error)}</p>')
+    html.append('<form method="post" action="/staff_login">')
+    html.append('帳號：<input type="text" name="username">')
+    html.append('　密碼：<input type="password" name="password">')
+    html.append('　<button type="submit">登入</button>')
+    html.append("</form>")
+    return "".join(html)
+
+
+@app.route("/staff_logout")
+def staff_logout():
+    session.clear()
+    return redirect(url_for("staff_login"))
+
+
+@app.route("/agency_dashboard")
+@staff_required
+def agency_dashboard():
+    """
+    機構總覽頁（給照護人員，需要 /staff_login 登入；家屬登入回 403）：
+      - 顯示照護人員帳號所屬機構（STAFF_ACCOUNTS 的 agency_id）所有住民某月份的評分
+      - 依照 query string year/month，沒給就用上個月
+      - ?format=json 回傳 JSON
+    """
+    agency_id = session["staff_agency_id"]
+
+    arg_year = request.args.get("year", type=int)
+    arg_month = request.args.get("month", type=int)
+    if arg_year and arg_month and 1 <= arg_month <= 12:
+        year, month = arg_year, arg_month
+    else:
+        year, month = previous_month()
+
+    rows = build_agency_month_scores(agency_id, year, month)
+
+    if request.args.get("format") == "json":
+        return jsonify({"agency_id": agency_id, "year": year, "month": month, "residents": rows})
+
+    type_label = {"bed": "臥床", "active": "離床"}
+
+    html = []
+    agency_name = next((r["agency_name"] for r in rows if r["agency_name"]), f"機構 {agency_id}")
+    html.append(f"<h2>{escape(agency_name)} {year}-{month:02d} 住民評分總覽</h2>")
+    html.append('<form method="get" action="/agency_dashboard">')
+    html.append(f'年份：<input type="number" name="year" value="{year}" style="width:80px;">')
+    html.append(
+        f'　月份：<input type="number" name="month" min="1" max="12" value="{month}" style="width:60px;">'
+    )
+    html.append('　<button type="submit">切換月份</button>')
+    html.append("</form>")
+
+    if not rows:
+        html.append("<p>這個機構沒有可顯示的住民。</p>")
+    else:
+        html.append('<table border="1" cellspacing="0" cellpadding="4">')
+        html.append(
+            "<tr><th>床號</th><th>住民</th><th>代號</th><th>報表類型</th>"
+            "<th>呼吸狀況</th><th>作息 / 臥床照顧</th><th>作息品質</th></tr>"
+        )
+        for r in rows:
+            html.append(
+                f"<tr><td>{escape(str(r['bed_number']))}</td>"
+                f"<td>{escape(str(r['resident_name']))}</td>"
+                f"<td>{escape(str(r['codename']))}</td>"
+                f"<td>{type_label.get(r['report_type'], r['report_type'])}</td>"
+                f"<td>{r['rr_score']}</td><td>{r['daily_score']}</td><td>{r['sleep_score']}</td></tr>"
+            )
+        html.append("</table>")
+
+    html.append('<p><a href="/staff_logout">登出</a></p>')
+    return "".join(html)
+
+
+def _report_pdf_response(kind: str):
+    resident = session_resident()
+    report_year, report_month, last_date = requested_report_month(resident["resident_id"])
+    pdf = build_report_pdf(kind, resident, report_year, report_month,
+                           force_mode=request.args.get("mode"), latest_date=last_date)
+    filename = report_pdf_filename(kind, resident, report_year, report_month)
+    disposition = "attachment" if request.args.get("download") else "inline"
+    return pdf, 200, {
+        "Content-Type": "application/pdf",
+        "Content-Disposition": f'{disposition}; filename="{filename}"',
+        "Cache-Control": "private, max-age=600",
+    }
+
+
+@app.route("/report.pdf")
+@login_required
+def report_pdf_download():
+    """月報 PDF（伺服器端產生）；參數同 /report（year / month / mode），加 download=1 直接下載"""
+    return _report_pdf_response("month")
+
+
+@app.route("/half_report.pdf")
+@login_required
+def half_report_pdf_download():
+    """半年報 PDF（伺服器端產生）；參數同 /half_report"""
+    return _report_pdf_response("half")
+
+
+@app.route("/report_chart/<kind>/<name>.<fmt>")
+@login_required
+def report_chart(kind, name, fmt):
+    """
+    單張報表圖：/report_chart/month/chart1.svg?year=2025&month=10&mode=bed
+      - kind：month（月報）/ half（半年報）；fmt：svg / png（png 需要 cairosvg）
+      - 跟頁面嵌入的圖同一份快取
+    """
+    if kind not in ("month", "half") or fmt not in ("svg", "png"):
+        return "not found", 404
+
+    resident_id = session["resident_id"]
+    report_year, report_month, last_date = requested_report_month(resident_id)
+    force_mode = request.args.get("mode")
+
+    builder = build_month_report_context if kind == "month" else build_half_report_context
+    ctx = get_or_build_report_snapshot(
+        kind, resident_id, report_year, report_month, force_mode,
+        lambda: builder(resident_id, report_year, report_month, force_mode),
+        latest_date=last_date,
     )
+    charts = get_report_charts(kind, resident_id, report_year, report_month, force_mode, last_date, ctx)
+    svg = charts.get(name)
+    if svg is None:
+        return "not found", 404
+
+    headers = {"Cache-Control": "private, max-age=600"}
+    if fmt == "svg":
+        headers["Content-Type"] = "image/svg+xml; charset=utf-8"
+        return svg, 200, headers
+
+    mode = report_mode(force_mode)
+    version = snapshot_data_version(report_year, report_month, last_date)
+    key = cache_key("chart_png", kind, resident_id, report_year, report_month, mode, version, name)
+    png = app_cache().get_or_set(key, lambda: report_charts.svg_to_png(svg), REPORT_CONTEXT_CACHE_TTL)
+    if png is None:
+        return "PNG 輸出需要安裝 cairosvg", 501
+    headers["Content-Type"] = "image/png"
+    return png, 200, headers
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    """
+    Prometheus 抓取用：各 route 回應時間、BigQuery job（時間 / bytes / slot 毫秒 / 快取命中）、
+    Sheets 讀取與報表各階段的統計（本 process 啟動以來）
+    """
+    if not METRICS_ENABLED:
+        return "metrics disabled", 404
+    return metrics.render_prometheus(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
 
 
-# ================== 5. Debug：resident_id=112 的簡易列表 ==================
+# ================== 6. Debug：resident_id=112 的簡易列表 ==================
 
 @app.route("/debug_res112_oct")
 def debug_res112_oct():
@@ -2158,25 +3680,7 @@ def debug_res112_oct():
     start_date = date(2025, 10, 1)
     end_date = date(2025, 10, 31)
 
-    query = f"""
-    SELECT
-      d.*
-    FROM {DAILY_TABLE} AS d
-    WHERE
-      d.resident_id = @resident_id
-      AND DATE(d.created_at) BETWEEN @start_date AND @end_date
-    ORDER BY d.created_at
-    """
-
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("resident_id", "INT64", resident_id),
-            bigquery.ScalarQueryParameter("start_date", "DATE", start_date),
-            bigquery.ScalarQueryParameter("end_date", "DATE", end_date),
-        ]
-    )
-
-    rows = [dict(r) for r in bq_client.query(query, job_config=job_config).result()]
+    rows = get_daily_for_resident_by_range(resident_id, start_date, end_date)
 
     html = []
     html.append("<h2>Debug：resident_id = 112 的 2025/10 DAILY 資料</h2>")
@@ -2206,7 +3710,282 @@ def debug_res112_oct():
     return "".join(html)
 
 
-if __name__ == "__main__":
+# ================== 7. 月初預熱 / 本機副本同步（CLI / 排程） ==================
+
+
+def previous_month(today=None):
+    """回傳上個月的 (year, month)"""
+    today = today or date.today()
+    last_day = today.replace(day=1) - timedelta(days=1)
+    return last_day.year, last_day.month
+
+
+def prewarm_reports(year=None, month=None, workers=None, agency_id=None, closed_only=False):
+    """
+    預先計算所有住民在 (year, month) 的月報與半年報，存進報表快照；
+    之後家屬第一次打開頁面就直接讀快照。
+      - 沒給年月 → 上個月
+      - workers：同時計算幾位住民（BigQuery 查詢是 I/O，用 thread 即可）
+      - closed_only：只預熱這個月已經 closed（見 snapshot_data_version，月底之後的翻身資料也到齊）
+        的住民，其他住民算 pending，不計算（排程用，見 PREWARM_WAIT_DAYS）
+    已經預熱過、資料版本沒變的住民直接命中快取，重跑很便宜
+    回傳 {"ok": 成功筆數, "failed": 失敗筆數, "pending": 略過筆數}
+    """
+    if year is None or month is None:
+        year, month = previous_month()
+    workers = workers or PREWARM_WORKERS
+
+    residents = list_active_residents(agency_id)
+    latest_dates = get_latest_created_dates([r["resident_id"] for r in residents])
+    resident_ids = [
+        r["resident_id"] for r in residents
+        if not closed_only or snapshot_data_version(year, month, latest_dates[r["resident_id"]]) == "closed"
+    ]
+    pending = len(residents) - len(resident_ids)
+    logger.info("prewarm %s-%02d: %d 位住民（pending %d），workers=%s",
+                year, month, len(resident_ids), pending, workers)
+
+    def warm_one(resident_id):
+        latest = latest_dates[resident_id]
+        get_or_build_report_snapshot(
+            "month", resident_id, year, month, None,
+            lambda: build_month_report_context(resident_id, year, month),
+            latest_date=latest,
+        )
+        get_or_build_report_snapshot(
+            "half", resident_id, year, month, None,
+            lambda: build_half_report_context(resident_id, year, month),
+            latest_date=latest,
+        )
+
+    ok = failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(warm_one, rid): rid for rid in resident_ids}
+        for fut in as_completed(futures):
+            try:
+                fut.result()
+                ok += 1
+            except Exception as e:
+                failed += 1
+                logger.warning("prewarm resident_id=%s 失敗：%r", futures[fut], e)
+
+    logger.info("prewarm %s-%02d 完成：ok=%d, failed=%d, pending=%d", year, month, ok, failed, pending)
+    return {"ok": ok, "failed": failed, "pending": pending}
+
+
+def _prewarm_scheduler_loop(interval_sec: int = 3600):
+    """
+    每 interval_sec 檢查一次，預熱上個月：
+      - 前 SNAPSHOT_CLOSE_GRACE_DAYS 天（1 號）上個月還不可能 closed，不預熱
+      - 之後 PREWARM_WAIT_DAYS 天只預熱已經 closed 的住民，再之後剩下的全部預熱
+      - 全部住民都成功（沒有 failed、沒有 pending）才算這個月做完，否則下一輪再試
+    """
+    done_for = None
+    while True:
+        target = previous_month()
+        day = date.today().day
+        if target != done_for and day > SNAPSHOT_CLOSE_GRACE_DAYS:
+            closed_only = day <= 1 + SNAPSHOT_CLOSE_GRACE_DAYS + PREWARM_WAIT_DAYS
+            try:
+                result = prewarm_reports(*target, closed_only=closed_only)
+                if result["failed"] == 0 and result["pending"] == 0:
+                    done_for = target
+            except Exception as e:
+                logger.warning("prewarm 排程失敗：%r", e)
+        time_mod.sleep(interval_sec)
+
+
+def start_prewarm_scheduler():
+    """
+    在背景 daemon thread 啟動預熱排程；只由明確的入口呼叫（main()），import 本模組不會啟動，
+    gunicorn 多 worker 時請另外跑一個 python daily_report.py prewarm --schedule
+    """
+    t = threading.Thread(target=_prewarm_scheduler_loop, name="prewarm-scheduler", daemon=True)
+    t.start()
+    return t
+
+
+# ---------- 批次輸出 PDF ----------
+
+def _export_resident_pdfs(resident: dict, year: int, month: int, kinds, out_dir: str):
+    """一位住民的 PDF（在 worker process 裡執行），回傳寫出的檔案路徑"""
+    latest = get_latest_created_date(resident["resident_id"])
+    paths = []
+    for kind in kinds:
+        pdf = build_report_pdf(kind, resident, year, month, latest_date=latest)
+        path = os.path.join(out_dir, report_pdf_filename(kind, resident, year, month))
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(pdf)
+        os.replace(tmp_path, path)
+        paths.append(path)
+    return paths
+
+
+def export_report_pdfs(agency_id=None, year=None, month=None, kinds=("month", "half"),
+                       out_dir=None, workers=None):
+    """
+    批次輸出機構內所有住民的月報 / 半年報 PDF 到 out_dir：
+      - 沒給年月 → 上個月；agency_id 為 None → 所有機構
+      - workers 個 process 同時產生（畫圖 / 組 PDF 吃 CPU，用 process 才不會卡在 GIL）
+      - 報表數值沿用快照 / 共用快取，先跑過 prewarm 會更快
+    回傳 {"ok": 成功人數, "failed": 失敗人數, "files": [路徑, ...]}
+    """
+    if year is None or month is None:
+        year, month = previous_month()
+    out_dir = out_dir or PDF_EXPORT_DIR
+    workers = workers or PDF_EXPORT_WORKERS
+    os.makedirs(out_dir, exist_ok=True)
+
+    residents = list_active_residents(agency_id)
+    logger.info("export-pdf %s-%02d: %d 位住民，workers=%s → %s", year, month, len(residents), workers, out_dir)
+
+    ok = failed = 0
+    files = []
+    # spawn：不 fork 帶著 thread（log listener、thread pool）的 process
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {
+            pool.submit(_export_resident_pdfs, dict(r), year, month, tuple(kinds), out_dir): r["resident_id"]
+            for r in residents
+        }
+        for fut in as_completed(futures):
+            try:
+                files.extend(fut.result())
+                ok += 1
+            except Exception as e:
+                failed += 1
+                logger.warning("export-pdf resident_id=%s 失敗：%r", futures[fut], e)
+
+    logger.info("export-pdf %s-%02d 完成：ok=%d, failed=%d", year, month, ok, failed)
+    return {"ok": ok, "failed": failed, "files": sorted(files)}
+
+
+# ---------- 本機副本同步 ----------
+
+# (副本資料表, BigQuery 表, 時間欄位, 要抓的欄位, 額外條件)
+REPLICA_SYNC_TABLES = (
+    (local_replica.DAILY, DAILY_TABLE, "created_at", "*", ""),
+    (local_replica.DURATION, DURATION_TABLE, "created_at",
+     "resident_id, created_at, time_start, duration", "AND bed_state = '09'"),
+    (local_replica.TOC_FIG, TOC_FIG_TABLE, "detect_at",
+     "resident_id, detect_at, value", "AND value IN ('00', '07', '08')"),
+)
+
+
+def sync_local_replica(since=None, replica=None):
+    """
+    把 BigQuery 的新資料增量複製到本機副本：
+      - 住民表整份重抓
+      - 其他三張表從 watermark（上次同步到的最後一天，含當天）往後抓；
+        沒同步過就從 since（沒給就是 REPLICA_INITIAL_DAYS 天前）開始
+    回傳 {資料表: 寫入筆數}
+    """
+    replica = replica or LocalReplica(LOCAL_REPLICA_DB)
+    counts = {}
+
+    query = f"""
+    SELECT
+      {", ".join(local_replica.RESIDENT_FIELDS)}
+    FROM {RESIDENT_TABLE}
+    """
+    counts["residents"] = replica.replace_residents(run_bq_query(query, None, "sync_residents").result())
+
+    for name, table, ts_col, columns, extra_filter in REPLICA_SYNC_TABLES:
+        watermark = replica.get_watermark(name)
+        if watermark is None:
+            watermark = since or (date.today() - timedelta(days=REPLICA_INITIAL_DAYS))
+
+        query = f"""
+        SELECT
+          {columns}
+        FROM {table}
+        WHERE
+          DATE({ts_col}) >= @since
+          {extra_filter}
+        ORDER BY {ts_col}
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ScalarQueryParameter("since", "DATE", watermark),
+            ]
+        )
+        rows = run_bq_query(query, job_config, f"sync_{name}").result(page_size=50000)
+        counts[name] = replica.replace_from(name, watermark, rows)
+        logger.info("sync-replica %s: 從 %s 起 %s 筆", name, watermark, counts[name])
+
+    # 同一個 process 內若以副本為資料來源，新資料馬上生效
+    invalidate_resident_caches()
+    return counts
+
+
+def main(argv=None):
+    """
+    指令列入口：
+      python daily_report.py                      → 啟動網頁
+      python daily_report.py prewarm [--year Y --month M] [--workers N] [--agency-id A]
+      python daily_report.py prewarm --schedule   → 常駐預熱排程（每小時檢查，換月後預熱上個月）
+      python daily_report.py sync-replica [--since YYYY-MM-DD]   → 更新本機副本（LOCAL_REPLICA_DB）
+      python daily_report.py export-pdf [--agency-id A] [--year Y --month M] [--kind month|half|all]
+                                        [--workers N] [--out DIR]  → 批次輸出 PDF
+      python daily_report.py staff-password       → 產生照護人員帳號的 password_hash
+    """
+    parser = argparse.ArgumentParser(description="每日 / 月報表服務")
+    sub = parser.add_subparsers(dest="command")
+
+    p_prewarm = sub.add_parser("prewarm", help="預先計算所有住民的月報 / 半年報快照")
+    p_prewarm.add_argument("--year", type=int)
+    p_prewarm.add_argument("--month", type=int)
+    p_prewarm.add_argument("--workers", type=int, default=PREWARM_WORKERS)
+    p_prewarm.add_argument("--agency-id", type=int)
+    p_prewarm.add_argument("--schedule", action="store_true",
+                           help="常駐，每小時檢查一次，換月後自動預熱上個月")
+
+    p_sync = sub.add_parser("sync-replica", help="把 BigQuery 新資料增量複製到本機副本")
+    p_sync.add_argument("--since", type=date.fromisoformat,
+                        help="第一次同步從哪一天開始（YYYY-MM-DD）")
+
+    p_pdf = sub.add_parser("export-pdf", help="批次輸出機構內所有住民的月報 / 半年報 PDF")
+    p_pdf.add_argument("--agency-id", type=int)
+    p_pdf.add_argument("--year", type=int)
+    p_pdf.add_argument("--month", type=int)
+    p_pdf.add_argument("--kind", choices=("month", "half", "all"), default="all")
+    p_pdf.add_argument("--workers", type=int, default=PDF_EXPORT_WORKERS)
+    p_pdf.add_argument("--out", default=PDF_EXPORT_DIR, help="輸出目錄")
+
+    sub.add_parser("staff-password", help="產生照護人員密碼的 password_hash（填進 STAFF_ACCOUNTS）")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "staff-password":
+        import getpass
+        print(generate_password_hash(getpass.getpass("密碼：")))
+        return 0
+
+    if args.command == "sync-replica":
+        sync_local_replica(args.since)
+        return 0
+
+    if args.command == "prewarm" and args.schedule:
+        _prewarm_scheduler_loop()
+        return 0
+
+    if args.command == "prewarm":
+        result = prewarm_reports(args.year, args.month, args.workers, args.agency_id)
+        return 1 if result["failed"] else 0
+
+    if args.command == "export-pdf":
+        kinds = ("month", "half") if args.kind == "all" else (args.kind,)
+        result = export_report_pdfs(args.agency_id, args.year, args.month, kinds, args.out, args.workers)
+        return 1 if result["failed"] else 0
+
+    if PREWARM_SCHEDULER:
+        start_prewarm_scheduler()
+
     import webbrowser
     webbrowser.open("http://127.0.0.1:5000/")
     app.run(host="0.0.0.0", port=5000, debug=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
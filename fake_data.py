@@ -0,0 +1,233 @@
+"""
+固定的假資料來源（DATA_SOURCE=fake）
+
+不連 BigQuery / Google Sheet，用亂數產生住民、每日資料、翻身段落、作息點與評語表，
+讓整個 Flask app 可以在本機跑壓測、量 CPU 時間。
+  - 同樣的 seed 與住民、同一天，產生的資料永遠一樣（跟查詢的日期區間無關）
+  - 介面跟 local_replica.LocalReplica 的查詢方法相同，由 daily_report.RowSourceBackend 包起來用
+  - 登入帳號：serial_id = FAKE-<resident_id>，agency_id = 住民所屬機構（1, 2, ...）
+
+可用環境變數調整：
+  FAKE_AGENCIES（預設 2）、FAKE_RESIDENTS_PER_AGENCY（預設 20）、
+  FAKE_DAYS（預設 400，資料到今天為止）、FAKE_SEED（預設 0）
+"""
+import json
+import os
+import random
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, time, timedelta
+
+# 30 分鐘作息格的優先順序（跟 BigQuery 查詢一致）
+_TOC_PRIORITY = {"08": 3, "07": 2, "00": 1}
+
+SHEET_HEADERS = [
+    "月份", "serial_id", "agency_id",
+    "本月總結_離床", "月呼吸率紀錄_離床", "每月趨勢狀態_離床", "月趨勢狀態總結_離床",
+    "本月總結_臥床", "月呼吸率紀錄_臥床", "日夜翻身間隔_臥床", "月趨勢狀態總結_臥床",
+]
+
+
+class SyntheticDataset:
+    """假資料；每位住民、每一天的資料在第一次用到時才產生，並保留最近用到的一批"""
+
+    def __init__(self, n_agencies: int = 2, residents_per_agency: int = 20,
+                 n_days: int = 400, end_date=None, seed: int = 0,
+                 flips_per_day=(20, 60), toc_points_per_hour: int = 12):
+        self.end_date = end_date or date.today()
+        self.start_date = self.end_date - timedelta(days=n_days - 1)
+        self.seed = seed
+        self.flips_per_day = flips_per_day
+        self.toc_points_per_hour = toc_points_per_hour
+
+        self.residents = []
+        for a in range(1, n_agencies + 1):
+            for i in range(residents_per_agency):
+                rid = a * 1000 + i + 1
+                self.residents.append({
+                    "resident_id": rid,
+                    "resident_name": f"住民{rid}",
+                    "agency_id": a,
+                    "agency_name": f"測試機構{a}",
+                    "codename": f"R{rid}",
+                    "bed_number": f"{i // 4 + 1}-{i % 4 + 1}",
+                    "note": "C",
+                    "serial_id": f"FAKE-{rid}",
+                })
+        self._by_id = {r["resident_id"]: r for r in self.residents}
+        # 一半住民偏「臥床」型、一半偏「離床」型
+        self._bedridden = {r["resident_id"]: r["resident_id"] % 2 == 0 for r in self.residents}
+
+        self._day_cache = OrderedDict()
+        self._day_cache_size = 20000
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            n_agencies=int(os.environ.get("FAKE_AGENCIES", "2")),
+            residents_per_agency=int(os.environ.get("FAKE_RESIDENTS_PER_AGENCY", "20")),
+            n_days=int(os.environ.get("FAKE_DAYS", "400")),
+            seed=int(os.environ.get("FAKE_SEED", "0")),
+        )
+
+    # ---------- 產生資料 ----------
+
+    def _rng(self, resident_id: int, d: date, salt: int) -> random.Random:
+        return random.Random((self.seed * 1000003 + resident_id) * 1000003 + d.toordinal() * 10 + salt)
+
+    def _day(self, resident_id: int, d: date):
+        """某住民某一天的 (daily row 或 None, 翻身段落, 作息點)"""
+        key = (resident_id, d)
+        with self._lock:
+            cached = self._day_cache.get(key)
+            if cached is not None:
+                self._day_cache.move_to_end(key)
+                return cached
+
+        if resident_id not in self._by_id or not (self.start_date <= d <= self.end_date):
+            day = (None, [], [])
+        else:
+            day = (self._make_daily(resident_id, d), self._make_turns(resident_id, d), self._make_toc(resident_id, d))
+
+        with self._lock:
+            self._day_cache[key] = day
+            while len(self._day_cache) > self._day_cache_size:
+                self._day_cache.popitem(last=False)
+        return day
+
+    def _make_daily(self, resident_id: int, d: date):
+        rnd = self._rng(resident_id, d, 1)
+        if rnd.random() < 0.05:
+            return None  # 沒上傳的日子
+        bedridden = self._bedridden[resident_id]
+        night_on_bed = round(rnd.uniform(7, 12) if bedridden else rnd.uniform(1.5, 10), 2)
+        day_on_bed = round(rnd.uniform(5, 12) if bedridden else rnd.uniform(0, 5), 2)
+        night_sleep = round(night_on_bed * rnd.uniform(0.5, 0.95), 2)
+        start = datetime.combine(d, time(20, 0)) + timedelta(minutes=rnd.randint(0, 360))
+        return {
+            "resident_id": resident_id,
+            "created_at": datetime.combine(d, time(3, 0)),
+            "night_on_bed": night_on_bed,
+            "night_sleep": 0 if rnd.random() < 0.03 else night_sleep,
+            "sleep_respiration": round(rnd.uniform(12, 24), 1) if rnd.random() > 0.03 else None,
+            "day_on_bed": day_on_bed,
+            "day_leave": round(max(24 - night_on_bed - day_on_bed, 0), 2),
+            "night_leave": rnd.randint(0, 4),
+            "asleep_leave": 0 if bedridden else rnd.randint(0, 3),
+            "asleep_leave_minute": rnd.randint(0, 60),
+            "asleep_start": start.strftime("%H:%M:%S"),
+            "respiration_analy": json.dumps({"std_dev": round(rnd.uniform(1, 6), 2)}),
+        }
+
+    def _make_turns(self, resident_id: int, d: date):
+        rnd = self._rng(resident_id, d, 2)
+        lo, hi = self.flips_per_day
+        n = rnd.randint(lo, hi) if self._bedridden[resident_id] else rnd.randint(0, lo)
+        seconds = sorted(rnd.randrange(0, 86400) for _ in range(n))
+        return [
+            {
+                "resident_id": resident_id,
+                "d": d,
+                "time_start": time(s // 3600, s % 3600 // 60, s % 60),
+                "duration_sec": None if rnd.random() < 0.02 else round(rnd.uniform(60, 5 * 3600), 1),
+            }
+            for s in seconds
+        ]
+
+    def _make_toc(self, resident_id: int, d: date):
+        """(距離當天 00:00 的分鐘數, value) 的 list"""
+        rnd = self._rng(resident_id, d, 3)
+        points = []
+        for hour in range(24):
+            asleep = hour < 6 or hour >= 21
+            for _ in range(self.toc_points_per_hour):
+                minute = hour * 60 + rnd.randrange(60)
+                r = rnd.random()
+                if asleep:
+                    value = "08" if r < 0.7 else ("07" if r < 0.9 else "00")
+                else:
+                    value = "00" if r < 0.6 else ("07" if r < 0.85 else "05")
+                points.append((minute, value))
+        return points
+
+    # ---------- 查詢（跟 LocalReplica 相同） ----------
+
+    def get_resident_by_login(self, serial_id: str, agency_id: int):
+        for r in self.residents:
+            if r["serial_id"] == serial_id and r["agency_id"] == agency_id:
+                return dict(r)
+        return None
+
+    def list_active_residents(self, agency_id=None):
+        return [dict(r) for r in self.residents if agency_id is None or r["agency_id"] == agency_id]
+
+    def latest_created_dates(self, resident_ids):
+        result = {}
+        for rid in resident_ids:
+            if rid not in self._by_id:
+                continue
+            d = self.end_date
+            while d >= self.start_date and self._day(rid, d)[0] is None:
+                d -= timedelta(days=1)
+            if d >= self.start_date:
+                result[rid] = d
+        return result
+
+    @staticmethod
+    def _dates(start_date: date, end_date: date):
+        for i in range((end_date - start_date).days + 1):
+            yield start_date + timedelta(days=i)
+
+    def daily_rows(self, resident_ids, start_date: date, end_date: date):
+        rows = []
+        for rid in sorted(resident_ids):
+            for d in self._dates(start_date, end_date):
+                row = self._day(rid, d)[0]
+                if row is not None:
+                    rows.append(dict(row))
+        return rows
+
+    def bed_turn_rows(self, resident_ids, start_date: date, end_date: date):
+        rows = []
+        for rid in sorted(resident_ids):
+            for d in self._dates(start_date, end_date):
+                rows.extend(dict(t) for t in self._day(rid, d)[1])
+        return rows
+
+    def toc_slot_priorities(self, resident_id: int, start_dt: datetime, n_windows: int):
+        best = {}
+        first_day = start_dt.date()
+        for d in self._dates(first_day, first_day + timedelta(days=n_windows)):
+            base = int((datetime.combine(d, time()) - start_dt).total_seconds() // 60)
+            for minute, value in self._day(resident_id, d)[2]:
+                p = _TOC_PRIORITY.get(value)
+                minutes = base + minute
+                if p is None or minutes < 0 or minutes >= n_windows * 1440:
+                    continue
+                window = minutes // 1440
+                slot = int(minutes / 30 + 0.5) - 48 * window
+                if 0 <= slot <= 47 and p > best.get((window, slot), 0):
+                    best[(window, slot)] = p
+        return [
+            {"window_index": w, "slot_index": s, "max_p": p}
+            for (w, s), p in sorted(best.items())
+        ]
+
+    def sheet_values(self, spreadsheet_id: str, gid: int):
+        """每位住民、最近 6 個月各一列評語"""
+        values = [list(SHEET_HEADERS)]
+        y, m = self.end_date.year, self.end_date.month
+        months = []
+        for _ in range(6):
+            months.append((y, m))
+            y, m = (y - 1, 12) if m == 1 else (y, m - 1)
+        for r in self.residents:
+            for y, m in months:
+                tag = f"{y}/{m:02d} {r['resident_name']}"
+                values.append([
+                    f"{y}/{m}", r["serial_id"], str(r["agency_id"]),
+                    f"{tag} 離床總結", f"{tag} 呼吸穩定", "持平", f"{tag} 離床趨勢",
+                    f"{tag} 臥床總結", f"{tag} 呼吸穩定", f"{tag} 翻身規律", f"{tag} 臥床趨勢",
+                ])
+        return values
@@ -0,0 +1,386 @@
+"""
+BigQuery 四張表的本機副本（SQLite）
+
+daily_report.py 的 sync-replica 指令把 RESIDENT_TABLE / DAILY_TABLE / DURATION_TABLE /
+TOC_FIG_TABLE 的新資料增量複製進來；設 DATA_SOURCE=replica 時，報表查詢改從這裡讀，
+不需要連 BigQuery。
+
+  - residents：住民清單（表小、沒有時間欄位，每次整份重抓）
+  - daily    ：N_2311_Daily 每一列的完整內容（JSON），/daily 原始資料表也能顯示
+  - duration ：N_bq_Duration24 中 bed_state='09' 的段落（報表只用到這些）
+  - toc_fig  ：N_bq_toC_fig 中 value 為 00 / 07 / 08 的點
+資料表都是 WITHOUT ROWID，主鍵以 (resident_id, 日期, ...) 開頭，
+同一位住民、同一個月的資料在檔案裡是連續存放的。
+
+增量同步以「日期」當 watermark：每次從上次同步到的最後一天（含）重新抓，
+先刪掉本機該日以後的資料再寫入，所以最後一天陸續進來的資料不會漏也不會重複。
+
+回傳的資料格式跟 daily_report.py 裡對應的 BigQuery 查詢結果相同（dict，欄位名稱一樣）。
+"""
+import json
+import os
+import sqlite3
+import threading
+from datetime import date, datetime, time, timedelta, timezone
+from decimal import Decimal
+
+# 同步的資料表名稱（sync_state 的 key）
+DAILY = "daily"
+DURATION = "duration"
+TOC_FIG = "toc_fig"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS residents (
+  resident_id   INTEGER NOT NULL PRIMARY KEY,
+  resident_name TEXT,
+  agency_id     INTEGER,
+  agency_name   TEXT,
+  codename      TEXT,
+  bed_number    TEXT,
+  note          TEXT,
+  serial_id     TEXT
+);
+CREATE INDEX IF NOT EXISTS residents_login ON residents (serial_id, agency_id);
+
+CREATE TABLE IF NOT EXISTS daily (
+  resident_id INTEGER NOT NULL,
+  d           TEXT    NOT NULL,
+  created_at  TEXT    NOT NULL,
+  seq         INTEGER NOT NULL,
+  row_json    TEXT    NOT NULL,
+  PRIMARY KEY (resident_id, d, created_at, seq)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS duration (
+  resident_id  INTEGER NOT NULL,
+  d            TEXT    NOT NULL,
+  time_start   TEXT    NOT NULL,
+  seq          INTEGER NOT NULL,
+  duration_sec REAL,
+  PRIMARY KEY (resident_id, d, time_start, seq)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS toc_fig (
+  resident_id INTEGER NOT NULL,
+  detect_at   TEXT    NOT NULL,
+  seq         INTEGER NOT NULL,
+  d           TEXT    NOT NULL,
+  value       TEXT    NOT NULL,
+  PRIMARY KEY (resident_id, detect_at, seq)
+) WITHOUT ROWID;
+
+-- 增量同步時依日期刪除舊資料用
+CREATE INDEX IF NOT EXISTS daily_d ON daily (d);
+CREATE INDEX IF NOT EXISTS duration_d ON duration (d);
+CREATE INDEX IF NOT EXISTS toc_fig_d ON toc_fig (d);
+
+CREATE TABLE IF NOT EXISTS sync_state (
+  table_name TEXT NOT NULL PRIMARY KEY,
+  watermark  TEXT NOT NULL,
+  synced_at  TEXT NOT NULL
+);
+"""
+
+_INSERT_SQL = {
+    DAILY: "INSERT INTO daily (resident_id, d, created_at, seq, row_json) VALUES (?, ?, ?, ?, ?)",
+    DURATION: "INSERT INTO duration (resident_id, d, time_start, seq, duration_sec) VALUES (?, ?, ?, ?, ?)",
+    TOC_FIG: "INSERT INTO toc_fig (resident_id, detect_at, seq, d, value) VALUES (?, ?, ?, ?, ?)",
+}
+
+RESIDENT_FIELDS = (
+    "resident_id", "resident_name", "agency_id", "agency_name",
+    "codename", "bed_number", "note", "serial_id",
+)
+
+
+# ---------- 值的轉換 ----------
+
+def _json_default(v):
+    if isinstance(v, datetime):
+        return {"__datetime__": v.isoformat()}
+    if isinstance(v, date):
+        return {"__date__": v.isoformat()}
+    if isinstance(v, time):
+        return {"__time__": v.isoformat()}
+    if isinstance(v, Decimal):
+        return float(v)
+    if isinstance(v, bytes):
+        return v.decode("utf-8", "replace")
+    raise TypeError(f"無法存進副本的型別：{type(v)!r}")
+
+
+def _json_hook(obj):
+    if "__datetime__" in obj:
+        return datetime.fromisoformat(obj["__datetime__"])
+    if "__date__" in obj:
+        return date.fromisoformat(obj["__date__"])
+    if "__time__" in obj:
+        return time.fromisoformat(obj["__time__"])
+    return obj
+
+
+def utc_naive(v):
+    """TIMESTAMP（有時區）→ UTC 的 naive datetime；DATETIME 原樣回傳"""
+    if isinstance(v, datetime) and v.tzinfo is not None:
+        return v.astimezone(timezone.utc).replace(tzinfo=None)
+    return v
+
+
+def _ts_text(v) -> str:
+    """時間欄位 → 可依字串排序的 'YYYY-MM-DD HH:MM:SS.ffffff'（UTC）"""
+    v = utc_naive(v)
+    if isinstance(v, datetime):
+        return v.isoformat(sep=" ", timespec="microseconds")
+    if isinstance(v, date):
+        return datetime.combine(v, time()).isoformat(sep=" ", timespec="microseconds")
+    return str(v)
+
+
+def _day_text(v) -> str:
+    return _ts_text(v)[:10]
+
+
+def _time_text(v) -> str:
+    if isinstance(v, datetime):
+        return v.time().isoformat()
+    if isinstance(v, time):
+        return v.isoformat()
+    return "" if v is None else str(v)
+
+
+def _float_or_none(v):
+    """跟 BigQuery 的 SAFE_CAST(... AS FLOAT64) 一樣：轉不了就是 None"""
+    if v is None:
+        return None
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return None
+
+
+class LocalReplica:
+    """SQLite 本機副本；每次操作各自開連線，可以在多個 thread 同時使用"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._init_lock = threading.Lock()
+        self._ready = False
+
+    def _connect(self):
+        if not self._ready:
+            with self._init_lock:
+                if not self._ready:
+                    os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                    conn = sqlite3.connect(self.path, timeout=30)
+                    conn.executescript(_SCHEMA)
+                    conn.close()
+                    self._ready = True
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    # ---------- 同步（寫入） ----------
+
+    def get_watermark(self, table_name: str):
+        """上次同步到的最後一天；沒同步過回傳 None"""
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT watermark FROM sync_state WHERE table_name = ?", (table_name,)
+            ).fetchone()
+        finally:
+            conn.close()
+        return date.fromisoformat(row["watermark"]) if row else None
+
+    def replace_residents(self, rows) -> int:
+        records = [tuple(r.get(name) for name in RESIDENT_FIELDS) for r in rows]
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM residents")
+                conn.executemany(
+                    f"INSERT INTO residents ({', '.join(RESIDENT_FIELDS)}) "
+                    f"VALUES ({', '.join('?' * len(RESIDENT_FIELDS))})",
+                    records,
+                )
+        finally:
+            conn.close()
+        return len(records)
+
+    def replace_from(self, table_name: str, since: date, rows) -> int:
+        """
+        把 since（含）之後的資料換成 rows（BigQuery 查詢結果，依時間排序），
+        並把 watermark 設成 rows 裡最後一天；同一個 transaction 完成
+        """
+        if table_name not in _INSERT_SQL:
+            raise ValueError(f"未知的副本資料表：{table_name}")
+        encode = getattr(self, f"_encode_{table_name}")
+
+        since_text = since.isoformat()
+        state = {"count": 0, "last_day": since_text}
+
+        def records():
+            for seq, row in enumerate(rows):
+                day, rec = encode(row, seq)
+                state["count"] += 1
+                if day > state["last_day"]:
+                    state["last_day"] = day
+                yield rec
+
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(f"DELETE FROM {table_name} WHERE d >= ?", (since_text,))
+                conn.executemany(_INSERT_SQL[table_name], records())
+                conn.execute(
+                    "INSERT OR REPLACE INTO sync_state (table_name, watermark, synced_at) VALUES (?, ?, ?)",
+                    (table_name, state["last_day"], datetime.now().isoformat(timespec="seconds")),
+                )
+        finally:
+            conn.close()
+        return state["count"]
+
+    # 每個 _encode_<table> 回傳 (日期字串, 要寫入的一列)
+
+    @staticmethod
+    def _encode_daily(row, seq):
+        data = dict(row)
+        created_at = data.get("created_at")
+        day = _day_text(created_at)
+        return day, (
+            data["resident_id"],
+            day,
+            _ts_text(created_at),
+            seq,
+            json.dumps(data, default=_json_default, ensure_ascii=False),
+        )
+
+    @staticmethod
+    def _encode_duration(row, seq):
+        day = _day_text(row["created_at"])
+        return day, (
+            row["resident_id"],
+            day,
+            _time_text(row["time_start"]),
+            seq,
+            _float_or_none(row["duration"]),
+        )
+
+    @staticmethod
+    def _encode_toc_fig(row, seq):
+        day = _day_text(row["detect_at"])
+        return day, (
+            row["resident_id"],
+            _ts_text(row["detect_at"]),
+            seq,
+            day,
+            row["value"],
+        )
+
+    # ---------- 查詢（讀取） ----------
+
+    def _query(self, sql: str, params=()):
+        conn = self._connect()
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def get_resident_by_login(self, serial_id: str, agency_id: int):
+        rows = self._query(
+            f"SELECT {', '.join(RESIDENT_FIELDS)} FROM residents "
+            "WHERE serial_id = ? AND agency_id = ? AND note = 'C' "
+            "AND serial_id IS NOT NULL AND serial_id != '' LIMIT 1",
+            (serial_id, agency_id),
+        )
+        return dict(rows[0]) if rows else None
+
+    def list_active_residents(self, agency_id=None):
+        sql = (
+            f"SELECT {', '.join(RESIDENT_FIELDS)} FROM residents "
+            "WHERE note = 'C' AND serial_id IS NOT NULL AND serial_id != ''"
+        )
+        params = ()
+        if agency_id is not None:
+            sql += " AND agency_id = ?"
+            params = (agency_id,)
+        sql += " ORDER BY agency_id, resident_id"
+        return [dict(r) for r in self._query(sql, params)]
+
+    def latest_created_dates(self, resident_ids):
+        """{resident_id: 最後一筆 daily 的日期}；沒有資料的住民不會出現"""
+        resident_ids = list(resident_ids)
+        if not resident_ids:
+            return {}
+        rows = self._query(
+            "SELECT resident_id, MAX(d) AS last_day FROM daily "
+            f"WHERE resident_id IN ({', '.join('?' * len(resident_ids))}) GROUP BY resident_id",
+            resident_ids,
+        )
+        return {r["resident_id"]: date.fromisoformat(r["last_day"]) for r in rows if r["last_day"]}
+
+    def daily_rows(self, resident_ids, start_date: date, end_date: date):
+        """DATE(created_at) 在區間內的 daily 列（完整欄位），依 resident_id、created_at 排序"""
+        result = []
+        for rid in sorted(resident_ids):
+            rows = self._query(
+                "SELECT row_json FROM daily WHERE resident_id = ? AND d BETWEEN ? AND ? "
+                "ORDER BY created_at, seq",
+                (rid, start_date.isoformat(), end_date.isoformat()),
+            )
+            result.extend(json.loads(r["row_json"], object_hook=_json_hook) for r in rows)
+        return result
+
+    def bed_turn_rows(self, resident_ids, start_date: date, end_date: date):
+        """
+        同 get_bed_turn_rows_by_range：bed_state='09'、duration <= 15 小時（或沒有 duration）的段落，
+        回傳 [{"resident_id", "d", "time_start", "duration_sec"}, ...]
+        """
+        result = []
+        for rid in sorted(resident_ids):
+            rows = self._query(
+                "SELECT resident_id, d, time_start, duration_sec FROM duration "
+                "WHERE resident_id = ? AND d BETWEEN ? AND ? "
+                "AND (duration_sec IS NULL OR duration_sec <= 15 * 3600) "
+                "ORDER BY d, time_start, seq",
+                (rid, start_date.isoformat(), end_date.isoformat()),
+            )
+            for r in rows:
+                result.append({
+                    "resident_id": r["resident_id"],
+                    "d": date.fromisoformat(r["d"]),
+                    "time_start": r["time_start"],
+                    "duration_sec": r["duration_sec"],
+                })
+        return result
+
+    def toc_slot_priorities(self, resident_id: int, start_dt: datetime, n_windows: int):
+        """
+        同 get_30min_slots_for_range 的 BigQuery 查詢：
+        回傳 [{"window_index", "slot_index", "max_p"}, ...]（start_dt 視為 UTC）
+        """
+        end_dt = start_dt + timedelta(days=n_windows)
+        rows = self._query(
+            "SELECT detect_at, value FROM toc_fig "
+            "WHERE resident_id = ? AND detect_at >= ? AND detect_at < ?",
+            (resident_id, _ts_text(start_dt), _ts_text(end_dt)),
+        )
+        priority = {"08": 3, "07": 2, "00": 1}
+        best = {}
+        for r in rows:
+            p = priority.get(r["value"])
+            if p is None:
+                continue
+            detect_at = datetime.fromisoformat(r["detect_at"])
+            minutes = int((detect_at - start_dt).total_seconds() // 60)
+            window = minutes // 1440
+            # BigQuery 的 CAST(x / 30 AS INT64) 是四捨五入（.5 進位）
+            slot = int(minutes / 30 + 0.5) - 48 * window
+            if 0 <= slot <= 47:
+                key = (window, slot)
+                if p > best.get(key, 0):
+                    best[key] = p
+        return [
+            {"window_index": w, "slot_index": s, "max_p": p}
+            for (w, s), p in sorted(best.items())
+        ]
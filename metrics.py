@@ -0,0 +1,185 @@
+"""
+簡單的效能量測：Prometheus 文字格式的 Counter / Histogram，以及每個 request 的分段計時
+
+  - Counter / Histogram 登記在 REGISTRY，render_prometheus() 輸出 /metrics 的內容
+    （gunicorn 多 worker 時每個 process 各自計數）
+  - RequestTimings 記錄一個 request 裡各段（BigQuery、Sheets、計算…）花的時間，
+    用 contextvars 傳遞，丟到 thread pool 的查詢（daily_report.submit_fetch）也記得到同一個 request
+  - server_timing_header() 組成 Server-Timing header，瀏覽器 DevTools 直接看得到
+只用標準函式庫
+"""
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# 預設的延遲 bucket（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape_label(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = [f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)]
+    pairs.extend(f'{n}="{_escape_label(v)}"' for n, v in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # key -> [每個 bucket 的次數..., sum, count]
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            if i < len(self.buckets):
+                state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        for key, state in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, state):
+                cumulative += n
+                labels = _format_labels(self.label_names, key, (("le", _format_value(bound)),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, key, (("le", "+Inf"),))
+            lines.append(f"{self.name}_bucket{labels} {state[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {state[-1]}")
+        return lines
+
+
+REGISTRY = []
+
+
+def render_prometheus() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ---------- 每個 request 的分段計時 ----------
+
+class RequestTimings:
+    """一個 request 內各段的累計時間（秒）與次數，以及累計數量（例如 BigQuery 掃描 bytes）；多個 thread 可以同時寫"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._entries = OrderedDict()  # name -> [seconds, count]
+        self._totals = OrderedDict()   # name -> 累計數量
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            entry = self._entries.setdefault(name, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += 1
+
+    def add_total(self, name: str, amount):
+        with self._lock:
+            self._totals[name] = self._totals.get(name, 0) + amount
+
+    def entries(self):
+        with self._lock:
+            return [(name, sec, n) for name, (sec, n) in self._entries.items()]
+
+    def totals(self):
+        with self._lock:
+            return list(self._totals.items())
+
+    def server_timing_header(self) -> str:
+        total = time.perf_counter() - self.started
+        parts = [f"total;dur={total * 1000:.1f}"]
+        for name, sec, n in self.entries():
+            part = f"{name};dur={sec * 1000:.1f}"
+            if n > 1:
+                part += f';desc="{n}x"'
+            parts.append(part)
+        for name, amount in self.totals():
+            parts.append(f'{name};desc="{amount}"')
+        return ", ".join(parts)
+
+
+_current_timings = ContextVar("request_timings", default=None)
+
+
+def begin_request() -> RequestTimings:
+    timings = RequestTimings()
+    _current_timings.set(timings)
+    return timings
+
+
+def current_timings():
+    """目前 request 的 RequestTimings；不在 request 裡（CLI、排程）回傳 None"""
+    return _current_timings.get()
+
+
+def end_request():
+    _current_timings.set(None)
+
+
+def record(name: str, seconds: float, histogram=None, **labels):
+    """記一段時間：寫進目前 request 的分段計時，有給 histogram 也一起 observe"""
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.add(name, seconds)
+    if histogram is not None:
+        histogram.observe(seconds, **labels)
+
+
+@contextmanager
+def timed(name: str, histogram=None, **labels):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - t0, histogram, **labels)
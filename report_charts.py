@@ -0,0 +1,443 @@
+"""
+報表圖表的伺服器端繪製（SVG，可選擇轉 PNG）
+
+跟頁面上原本 Chart.js 畫的圖相同的資料與樣式（折線、長條、夜間休息區段、雙 Y 軸），
+直接從報表計算結果（build_month_report_context / build_half_report_context 的 dict）產生：
+  - month_charts(ctx) / half_charts(ctx) → {"chart1": "<svg ...>", ...}
+  - month_chart_specs / half_chart_specs + draw_chart：同一組圖畫到其他 canvas（report_pdf 的 PDF 頁面）
+  - svg_to_png(svg) → PNG bytes；需要選用套件 cairosvg，沒裝回傳 None
+只用標準函式庫；文字用系統的中文字型（瀏覽器 / cairosvg 自己找）
+"""
+import math
+from html import escape
+
+WIDTH = 760
+HEIGHT = 200
+FONT_FAMILY = "'Noto Sans TC', 'Microsoft JhengHei', 'PingFang TC', 'Heiti TC', sans-serif"
+
+# 跟 Chart.js 預設配色一致
+BLUE = "rgb(54, 162, 235)"
+RED = "rgb(255, 99, 132)"
+GRID = "#e5e5e5"
+AXIS_TEXT = "#666"
+
+# 嵌在頁面時跟著容器寬度縮放
+_INLINE_STYLE = 'style="width:100%;height:auto;display:block"'
+
+
+def _valid(v) -> bool:
+    return v is not None and not (isinstance(v, float) and math.isnan(v))
+
+
+def _fmt_number(v: float) -> str:
+    if abs(v - round(v)) < 1e-9:
+        return str(int(round(v)))
+    return f"{v:.2f}".rstrip("0").rstrip(".")
+
+
+def _fmt_time(v: float) -> str:
+    """小時數（可以超過 24）→ HH:MM"""
+    h = math.floor(v)
+    m = round((v - h) * 60)
+    if m == 60:
+        h, m = h + 1, 0
+    return f"{h % 24:02d}:{m:02d}"
+
+
+_FORMATTERS = {
+    "number": _fmt_number,
+    "time": _fmt_time,
+    "percent": lambda v: _fmt_number(v) + "%",
+}
+
+
+def _nice_step(span: float, max_ticks: int) -> float:
+    raw = span / max(max_ticks - 1, 1)
+    mag = 10 ** math.floor(math.log10(raw))
+    for m in (1, 2, 2.5, 5, 10):
+        if m * mag >= raw:
+            return m * mag
+    return 10 * mag
+
+
+def _axis_scale(axis, values, max_ticks: int = 6):
+    """依軸設定（min / max / begin_at_zero / step）與資料算出 (lo, hi, ticks)"""
+    lo, hi = axis.get("min"), axis.get("max")
+    data_lo = min(values) if values else 0.0
+    data_hi = max(values) if values else 1.0
+    if lo is None:
+        lo = min(0.0, data_lo) if axis.get("begin_at_zero", True) else data_lo
+    if hi is None:
+        hi = max(data_hi, lo + 1e-9)
+    if hi <= lo:
+        hi = lo + 1
+
+    step = axis.get("step") or _nice_step(hi - lo, max_ticks)
+    if axis.get("min") is None:
+        lo = math.floor(lo / step + 1e-9) * step
+    if axis.get("max") is None:
+        hi = math.ceil(hi / step - 1e-9) * step
+        if hi <= lo:
+            hi = lo + step
+    ticks = []
+    t = lo
+    while t <= hi + step * 1e-6:
+        ticks.append(t)
+        t += step
+    return lo, hi, ticks
+
+
+class SvgCanvas:
+    """畫圖指令 → SVG；座標原點在左上、y 向下（report_pdf.PdfCanvas 提供同樣的方法）"""
+
+    def __init__(self, width: int, height: int, title: str = "", inline: bool = True):
+        size = f'width="{width}" height="{height}"' + (f" {_INLINE_STYLE}" if inline else "")
+        self._out = [
+            f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {width} {height}" {size} '
+            f'font-family="{escape(FONT_FAMILY)}" font-size="11" role="img" aria-label="{escape(title)}">',
+            f'<rect x="0" y="0" width="{width}" height="{height}" fill="#fff"/>',
+        ]
+
+    def line(self, x1, y1, x2, y2, color, width=1):
+        self._out.append(f'<line x1="{x1:.1f}" y1="{y1:.1f}" x2="{x2:.1f}" y2="{y2:.1f}" '
+                         f'stroke="{color}" stroke-width="{width}"/>')
+
+    def rect(self, x, y, w, h, fill, stroke=None):
+        border = f' stroke="{stroke}" stroke-width="1"' if stroke else ""
+        self._out.append(f'<rect x="{x:.1f}" y="{y:.1f}" width="{w:.1f}" height="{h:.1f}" fill="{fill}"{border}/>')
+
+    def polyline(self, points, color, width=2, dash=False):
+        pts = " ".join(f"{px:.1f},{py:.1f}" for px, py in points)
+        dasharray = ' stroke-dasharray="4 4"' if dash else ""
+        self._out.append(f'<polyline points="{pts}" fill="none" stroke="{color}" '
+                         f'stroke-width="{width}"{dasharray}/>')
+
+    def circle(self, cx, cy, r, fill):
+        self._out.append(f'<circle cx="{cx:.1f}" cy="{cy:.1f}" r="{r}" fill="{fill}"/>')
+
+    def text(self, x, y, s, color, size=11, anchor="start", rotate=0):
+        attrs = f' text-anchor="{anchor}"' if anchor != "start" else ""
+        if size != 11:
+            attrs += f' font-size="{size}"'
+        if rotate:
+            attrs += f' transform="rotate({rotate} {x:.1f} {y:.1f})"'
+        self._out.append(f'<text x="{x:.1f}" y="{y:.1f}" fill="{color}"{attrs}>{escape(str(s))}</text>')
+
+    def to_svg(self) -> str:
+        return "".join(self._out) + "</svg>"
+
+
+def draw_chart(canvas, width, height, labels, series, y=None, y_right=None, legend=False, title=""):
+    """
+    在 canvas（SvgCanvas / report_pdf.PdfCanvas）上畫一張 width x height 的圖：
+      series：[{"type": "line" | "bar" | "range", "data": [...], "label": str,
+                "color": str, "dash": bool, "points": bool, "axis": "left" | "right"}, ...]
+              range 的 data 是 [[開始, 結束] 或 None, ...]
+      y / y_right：{"min", "max", "step", "begin_at_zero", "label", "format": number | time | percent}
+    """
+    y = dict(y or {})
+    n = len(labels)
+    has_right = y_right is not None and any(s.get("axis") == "right" for s in series)
+
+    legend_h = 22 if legend else 0
+    left = 62 if y.get("label") else 44
+    right = (62 if y_right.get("label") else 44) if has_right else 14
+    top, bottom = 10 + legend_h, 26
+    plot_w, plot_h = width - left - right, height - top - bottom
+
+    def axis_values(axis_name):
+        values = []
+        for s in series:
+            if s.get("axis", "left") != axis_name:
+                continue
+            for v in s["data"]:
+                if s["type"] == "range":
+                    if v and _valid(v[0]) and _valid(v[1]):
+                        values.extend(v)
+                elif _valid(v):
+                    values.append(v)
+        return values
+
+    lo, hi, ticks = _axis_scale(y, axis_values("left"))
+    scales = {"left": (lo, hi)}
+    if has_right:
+        r_lo, r_hi, r_ticks = _axis_scale(y_right, axis_values("right"))
+        scales["right"] = (r_lo, r_hi)
+
+    def y_pos(v, axis_name="left"):
+        a, b = scales[axis_name]
+        v = min(max(v, a), b)
+        return top + plot_h - (v - a) / (b - a) * plot_h
+
+    cat_w = plot_w / n if n else plot_w
+
+    def x_center(i):
+        return left + cat_w * (i + 0.5)
+
+    # ---- 格線與 Y 軸刻度 ----
+    fmt = _FORMATTERS[y.get("format", "number")]
+    for t in ticks:
+        yy = y_pos(t)
+        canvas.line(left, yy, left + plot_w, yy, GRID)
+        canvas.text(left - 6, yy + 4, fmt(t), AXIS_TEXT, anchor="end")
+    if y.get("label"):
+        canvas.text(12, top + plot_h / 2, y["label"], AXIS_TEXT, anchor="middle", rotate=-90)
+    if has_right:
+        r_fmt = _FORMATTERS[y_right.get("format", "number")]
+        for t in r_ticks:
+            canvas.text(left + plot_w + 6, y_pos(t, "right") + 4, r_fmt(t), AXIS_TEXT)
+        if y_right.get("label"):
+            canvas.text(width - 12, top + plot_h / 2, y_right["label"], AXIS_TEXT, anchor="middle", rotate=90)
+    canvas.line(left, top + plot_h, left + plot_w, top + plot_h, "#999")
+
+    # ---- X 軸標籤（最多 10 個，跟 Chart.js 的 autoSkip 類似） ----
+    if n:
+        every = max(1, math.ceil(n / 10))
+        for i in range(0, n, every):
+            canvas.text(x_center(i), height - 8, labels[i], AXIS_TEXT, anchor="middle")
+    if not any(axis_values(a) for a in scales):
+        canvas.text(left + plot_w / 2, top + plot_h / 2, "尚無資料", "#aaa", size=13, anchor="middle")
+
+    # ---- 長條（含區段） ----
+    bar_series = [s for s in series if s["type"] in ("bar", "range")]
+    group_w = cat_w * 0.8
+    bar_w = group_w / len(bar_series) if bar_series else 0
+    for k, s in enumerate(bar_series):
+        axis_name = s.get("axis", "left")
+        color = s.get("color", BLUE)
+        for i, v in enumerate(s["data"][:n]):
+            x = left + cat_w * i + (cat_w - group_w) / 2 + bar_w * k
+            if s["type"] == "range":
+                if not v or not (_valid(v[0]) and _valid(v[1])) or v[1] <= v[0]:
+                    continue
+                y0, y1 = y_pos(v[1], axis_name), y_pos(v[0], axis_name)
+            else:
+                if not _valid(v):
+                    continue
+                base = min(max(0.0, scales[axis_name][0]), scales[axis_name][1])
+                y0, y1 = sorted((y_pos(v, axis_name), y_pos(base, axis_name)))
+            canvas.rect(x, y0, max(bar_w - 1, 1), max(y1 - y0, 0.5), color, s.get("border"))
+
+    # ---- 折線（None 的地方斷開） ----
+    for s in series:
+        if s["type"] != "line":
+            continue
+        axis_name = s.get("axis", "left")
+        color = s.get("color", BLUE)
+        segment = []
+        segments = [segment]
+        for i, v in enumerate(s["data"][:n]):
+            if _valid(v):
+                segment.append((x_center(i), y_pos(v, axis_name)))
+            elif segment:
+                segment = []
+                segments.append(segment)
+        for seg in segments:
+            if len(seg) > 1:
+                canvas.polyline(seg, color, dash=s.get("dash", False))
+            if s.get("points") or len(seg) == 1:
+                for px, py in seg:
+                    canvas.circle(px, py, 3, color)
+
+    # ---- 圖例 ----
+    if legend:
+        x = left
+        for s in series:
+            label = s.get("label")
+            if not label:
+                continue
+            canvas.rect(x, 6, 22, 10, s.get("color", BLUE))
+            canvas.text(x + 28, 15, label, "#333")
+            x += 40 + 12 * len(label)
+
+
+def render_chart(labels, series, y=None, y_right=None, legend=False, title="",
+                 width: int = WIDTH, height: int = HEIGHT, inline: bool = True) -> str:
+    """
+    畫一張圖，回傳 SVG 字串（參數見 draw_chart）
+      inline：True → 寬度 100% 嵌在頁面裡；False → 固定像素大小（存檔 / 轉 PNG）
+    """
+    canvas = SvgCanvas(width, height, title, inline)
+    draw_chart(canvas, width, height, labels, series, y, y_right, legend, title)
+    return canvas.to_svg()
+
+
+def _spec(labels, series, **options):
+    return dict(labels=labels, series=series, **options)
+
+
+# ---------- 月報 ----------
+
+def _scaled(values, factor):
+    return [v * factor if _valid(v) else None for v in values or []]
+
+
+def month_chart_specs(ctx) -> dict:
+    """月報四張圖的設定（draw_chart 的參數）；內容依 ctx["report_type"]（bed / active）跟頁面模板一致"""
+    labels = ctx.get("labels") or []
+    charts = {
+        "chart1": _spec(labels, [{"type": "line", "data": ctx.get("resp_rate") or []}],
+                        y={"min": 5, "label": "呼吸次/分"}, title="每日呼吸紀錄"),
+    }
+    if ctx.get("report_type") == "bed":
+        charts["chart2"] = _spec(
+            labels, [{"type": "bar", "data": ctx.get("night_bed_hours") or []}],
+            y={"label": "小時"}, title="夜間最長臥床時長",
+        )
+        charts["chart3"] = _spec(
+            labels, [{"type": "line", "data": ctx.get("leave_bed_total") or []}],
+            y={"label": "小時"}, title="日間離床總時長",
+        )
+        # 翻身間隔：分鐘 → 小時
+        charts["chart4"] = _spec(
+            labels,
+            [
+                {"type": "line", "data": _scaled(ctx.get("night_turn_interval"), 1 / 60),
+                 "label": "夜間翻身", "color": BLUE},
+                {"type": "line", "data": _scaled(ctx.get("day_turn_interval"), 1 / 60),
+                 "label": "日間翻身", "color": RED},
+            ],
+            y={"label": "小時"}, legend=True, title="日夜平均翻身間隔",
+        )
+        return charts
+
+    ranges = []
+    for r in ctx.get("night_sleep_range") or []:
+        ok = r and len(r) == 2 and _valid(r[0]) and _valid(r[1]) and r[1] > r[0]
+        ranges.append(list(r) if ok else None)
+    valid_starts = [r[0] for r in ranges if r]
+    valid_ends = [r[1] for r in ranges if r]
+    charts["chart2"] = _spec(
+        labels,
+        [{"type": "range", "data": ranges, "color": "rgba(173, 216, 230, 0.8)", "border": "#7db5d6"}],
+        y={
+            "begin_at_zero": False, "step": 1, "format": "time",
+            "min": math.floor(min(valid_starts)) if valid_starts else None,
+            "max": math.ceil(max(valid_ends)) if valid_ends else None,
+        },
+        title="每日夜間休息時段",
+    )
+
+    # 上床時間：下界多抓 1 小時，範圍至少 6 小時（同頁面）
+    starts = ctx.get("asleep_start_hours") or []
+    valid = [v for v in starts if _valid(v)]
+    time_axis = {"begin_at_zero": False, "step": 1, "format": "time"}
+    if valid:
+        time_axis["min"] = math.floor(min(valid)) - 1
+        time_axis["max"] = max(math.ceil(max(valid)), time_axis["min"] + 6)
+    charts["chart3"] = _spec(labels, [{"type": "line", "data": starts}], y=time_axis, title="每日上床休息時間")
+    charts["chart4"] = _spec(
+        labels, [{"type": "line", "data": ctx.get("night_leave_count") or []}],
+        y={"label": "次", "step": 1}, title="夜間休息離床次數",
+    )
+    return charts
+
+
+# ---------- 半年報 ----------
+
+def _dict_or_empty(v):
+    return v if isinstance(v, dict) else {}
+
+
+def half_chart_specs(ctx) -> dict:
+    """半年報五張圖的設定；內容依 ctx["report_type"] 跟 halfreport_report.html 一致"""
+    labels = ctx.get("labels_months") or []
+    is_bed = ctx.get("report_type") == "bed"
+    c1 = _dict_or_empty(ctx.get("chart1_data"))
+    c2 = _dict_or_empty(ctx.get("chart2_data"))
+    c3 = ctx.get("chart3_data") if isinstance(ctx.get("chart3_data"), list) else []
+    c4 = _dict_or_empty(ctx.get("chart4_data"))
+    c5 = _dict_or_empty(ctx.get("chart5_data"))
+    charts = {}
+
+    if is_bed:
+        charts["chart1"] = _spec(
+            labels,
+            [
+                {"type": "line", "data": c1.get("night_turn") or [], "label": "夜間翻身",
+                 "color": "#000000", "points": True},
+                {"type": "line", "data": c1.get("day_turn") or [], "label": "日間翻身",
+                 "color": "#007bff", "points": True},
+            ],
+            y={"begin_at_zero": False, "label": "平均翻身間隔(分鐘)"}, legend=True, title="每月平均日夜翻身間隔",
+        )
+    else:
+        charts["chart1"] = _spec(
+            labels,
+            [
+                {"type": "bar", "data": c1.get("night_on_bed") or [], "label": "夜間在床時間(小時)",
+                 "color": "rgba(80, 150, 255, 0.9)"},
+                {"type": "bar", "data": c1.get("night_sleep") or [], "label": "夜間休息時間(小時)",
+                 "color": "rgba(255, 210, 90, 0.9)"},
+            ],
+            y={"label": "小時"}, legend=True, title="每月平均夜間休息時長",
+        )
+
+    charts["chart2"] = _spec(
+        labels,
+        [
+            {"type": "bar", "data": c2.get("efficiency_percent") or [], "label": "休息效率",
+             "color": "rgba(160, 200, 255, 0.9)"},
+            {"type": "line", "data": c2.get("leave_count") or [], "label": "夜間休息離床次數",
+             "color": "#0044CC", "dash": True, "points": True, "axis": "right"},
+        ],
+        y={"min": 0, "max": 100, "format": "percent", "label": "休息效率(%)"},
+        y_right={"label": "夜間離床次數"}, legend=True, title="每月平均夜間休息品質",
+    )
+    charts["chart3"] = _spec(
+        labels, [{"type": "line", "data": c3, "label": "休息呼吸率", "points": True}],
+        y={"min": 5, "label": "呼吸率"}, legend=True, title="每月平均呼吸紀錄",
+    )
+
+    if is_bed:
+        charts["chart4"] = _spec(
+            labels,
+            [
+                {"type": "bar", "data": c4.get("day_on_bed") or [], "label": "日間在床(小時)",
+                 "color": "rgba(160, 200, 255, 0.9)"},
+                {"type": "bar", "data": c4.get("night_on_bed") or [], "label": "夜間在床(小時)",
+                 "color": "rgba(255, 180, 140, 0.9)"},
+            ],
+            y={"label": "在床時數(小時)"}, legend=True, title="每月日夜在床狀況",
+        )
+        charts["chart5"] = _spec(
+            labels, [{"type": "line", "data": c5.get("day_leave_hours") or [], "label": "日間離床時長(小時)",
+                      "points": True}],
+            y={"begin_at_zero": False, "label": "小時"}, legend=True, title="每月平均日間離床時長",
+        )
+    else:
+        charts["chart4"] = _spec(
+            labels, [{"type": "line", "data": c4.get("leave_min") or [], "label": "夜間離床狀況", "points": True}],
+            y={"label": "分鐘"}, legend=True, title="每月平均夜間離床狀況",
+        )
+        # 16:00 ~ 隔天 04:00
+        charts["chart5"] = _spec(
+            labels, [{"type": "line", "data": c5.get("asleep_start_hour") or [], "label": "上床休息時間",
+                      "points": True}],
+            y={"min": 16, "max": 28, "step": 2, "format": "time", "label": "時間"}, legend=True,
+            title="每月平均上床休息時間",
+        )
+    return charts
+
+
+def month_charts(ctx) -> dict:
+    """月報四張圖 → {"chart1": "<svg ...>", ...}"""
+    return {name: render_chart(**spec) for name, spec in month_chart_specs(ctx).items()}
+
+
+def half_charts(ctx) -> dict:
+    """半年報五張圖 → {"chart1": "<svg ...>", ...}"""
+    return {name: render_chart(**spec) for name, spec in half_chart_specs(ctx).items()}
+
+
+def svg_to_png(svg: str, scale: float = 2.0):
+    """SVG 轉 PNG（需要 cairosvg）；沒裝或轉檔失敗回傳 None"""
+    try:
+        import cairosvg
+    except (ImportError, OSError):
+        return None
+    try:
+        svg = svg.replace(" " + _INLINE_STYLE, "", 1)
+        return cairosvg.svg2png(bytestring=svg.encode("utf-8"), scale=scale)
+    except Exception:
+        return None
@@ -0,0 +1,379 @@
+"""
+月報 / 半年報的伺服器端 PDF
+
+不靠瀏覽器的 html2canvas + jsPDF，直接從報表計算結果（跟頁面同一份 ctx）與評語組出 PDF：
+  - month_report_pdf(ctx, resident, month_comments) → bytes
+  - half_report_pdf(ctx, resident, month_comments, half_summary) → bytes
+圖表用 report_charts 的圖表設定，以向量畫在 PDF 上（跟頁面的 SVG 同一套畫法）
+只用標準函式庫：文字使用 PDF 閱讀器內建的繁體中文字型 MSung-Light（Adobe-CNS1，不嵌入字型檔）
+"""
+import re
+import zlib
+
+import report_charts
+
+PAGE_W, PAGE_H = 595.28, 841.89   # A4（pt）
+MARGIN = 40
+CONTENT_W = PAGE_W - 2 * MARGIN
+
+# 圖表以 report_charts 的座標（寬 CHART_W）畫，再縮放到 CONTENT_W
+CHART_W = 620
+CHART_SCALE = CONTENT_W / CHART_W
+
+TEXT_COLOR = "#333"
+MUTED_COLOR = "#777"
+ACCENT_COLOR = "#3f7fbf"
+
+# 等級 1~3 的顏色與文字（3 最好）
+LEVEL_STYLES = {
+    1: ("#e57373", "待加強"),
+    2: ("#ffb74d", "普通"),
+    3: ("#81c784", "良好"),
+}
+
+_FONT_OBJECTS = (
+    "<< /Type /Font /Subtype /Type0 /BaseFont /MSung-Light /Encoding /UniCNS-UCS2-H "
+    "/DescendantFonts [{cid} 0 R] >>",
+    "<< /Type /Font /Subtype /CIDFontType0 /BaseFont /MSung-Light "
+    "/CIDSystemInfo << /Registry (Adobe) /Ordering (CNS1) /Supplement 0 >> "
+    "/FontDescriptor {desc} 0 R /DW 1000 /W [1 95 500] >>",
+    "<< /Type /FontDescriptor /FontName /MSung-Light /Flags 6 /FontBBox [-160 -249 1015 888] "
+    "/ItalicAngle 0 /Ascent 880 /Descent -120 /CapHeight 880 /StemV 93 >>",
+)
+
+
+# ---------- 基本繪圖 ----------
+
+def _parse_color(color: str):
+    """'#rgb' / '#rrggbb' / 'rgb(...)' / 'rgba(...)' → (r, g, b) 0~1；半透明色當成疊在白底上"""
+    c = color.strip()
+    if c.startswith("#"):
+        h = c[1:]
+        if len(h) == 3:
+            h = "".join(ch * 2 for ch in h)
+        return tuple(int(h[i:i + 2], 16) / 255 for i in (0, 2, 4))
+    m = re.match(r"rgba?\(([^)]*)\)", c)
+    if not m:
+        return (0.0, 0.0, 0.0)
+    parts = [float(p) for p in m.group(1).split(",")]
+    alpha = parts[3] if len(parts) > 3 else 1.0
+    return tuple((v / 255) * alpha + (1 - alpha) for v in parts[:3])
+
+
+def _color_op(color: str, op: str) -> str:
+    r, g, b = _parse_color(color)
+    return f"{r:.3f} {g:.3f} {b:.3f} {op}"
+
+
+def text_width(s: str, size: float) -> float:
+    """估計字串寬度：ASCII 半形、其他全形（MSung-Light 的 /W 也是這樣設定）"""
+    return size * sum(0.5 if ord(ch) < 128 else 1.0 for ch in s)
+
+
+def _encode_text(s: str) -> str:
+    """UCS-2 big-endian 的十六進位字串（UniCNS-UCS2-H）；BMP 以外的字元換成 ?"""
+    return "".join(f"{ord(ch) if ord(ch) <= 0xFFFF else 0x3F:04X}" for ch in s)
+
+
+class PdfCanvas:
+    """report_charts.SvgCanvas 的 PDF 版：座標原點在左上、y 向下；可用 region() 平移 / 縮放"""
+
+    def __init__(self, ops, ox: float = 0.0, oy: float = 0.0, scale: float = 1.0):
+        self._ops = ops
+        self._ox, self._oy, self._scale = ox, oy, scale
+
+    def region(self, x: float, y: float, scale: float = 1.0) -> "PdfCanvas":
+        return PdfCanvas(self._ops, self._ox + x * self._scale, self._oy + y * self._scale, self._scale * scale)
+
+    def _pt(self, x, y):
+        return self._ox + x * self._scale, PAGE_H - (self._oy + y * self._scale)
+
+    def line(self, x1, y1, x2, y2, color, width=1):
+        (a, b), (c, d) = self._pt(x1, y1), self._pt(x2, y2)
+        self._ops.append(f"{_color_op(color, 'RG')} {width * self._scale:.2f} w "
+                         f"{a:.2f} {b:.2f} m {c:.2f} {d:.2f} l S")
+
+    def rect(self, x, y, w, h, fill, stroke=None):
+        px, py = self._pt(x, y + h)
+        paint = "f"
+        ops = _color_op(fill, "rg")
+        if stroke:
+            ops += f" {_color_op(stroke, 'RG')} {self._scale:.2f} w"
+            paint = "B"
+        self._ops.append(f"{ops} {px:.2f} {py:.2f} {w * self._scale:.2f} {h * self._scale:.2f} re {paint}")
+
+    def polyline(self, points, color, width=2, dash=False):
+        path = []
+        for i, (x, y) in enumerate(points):
+            px, py = self._pt(x, y)
+            path.append(f"{px:.2f} {py:.2f} {'m' if i == 0 else 'l'}")
+        dash_on = f"[{4 * self._scale:.2f} {4 * self._scale:.2f}] 0 d " if dash else ""
+        dash_off = " [] 0 d" if dash else ""
+        self._ops.append(f"{_color_op(color, 'RG')} {width * self._scale:.2f} w {dash_on}"
+                         f"{' '.join(path)} S{dash_off}")
+
+    def circle(self, cx, cy, r, fill):
+        x, y = self._pt(cx, cy)
+        r *= self._scale
+        k = 0.5523 * r
+        self._ops.append(
+            f"{_color_op(fill, 'rg')} {x + r:.2f} {y:.2f} m "
+            f"{x + r:.2f} {y + k:.2f} {x + k:.2f} {y + r:.2f} {x:.2f} {y + r:.2f} c "
+            f"{x - k:.2f} {y + r:.2f} {x - r:.2f} {y + k:.2f} {x - r:.2f} {y:.2f} c "
+            f"{x - r:.2f} {y - k:.2f} {x - k:.2f} {y - r:.2f} {x:.2f} {y - r:.2f} c "
+            f"{x + k:.2f} {y - r:.2f} {x + r:.2f} {y - k:.2f} {x + r:.2f} {y:.2f} c f"
+        )
+
+    def text(self, x, y, s, color, size=11, anchor="start", rotate=0):
+        s = str(s)
+        if not s:
+            return
+        size *= self._scale
+        px, py = self._pt(x, y)
+        # SVG 的 rotate 以 y 向下為準；PDF y 向上，角度反過來
+        if rotate == -90:
+            a, b, c, d = 0, 1, -1, 0
+        elif rotate == 90:
+            a, b, c, d = 0, -1, 1, 0
+        else:
+            a, b, c, d = 1, 0, 0, 1
+        shift = {"middle": 0.5, "end": 1.0}.get(anchor, 0.0) * text_width(s, size)
+        px, py = px - a * shift, py - b * shift
+        self._ops.append(f"BT /F1 {size:.2f} Tf {_color_op(color, 'rg')} "
+                         f"{a} {b} {c} {d} {px:.2f} {py:.2f} Tm <{_encode_text(s)}> Tj ET")
+
+
+class PdfDocument:
+    """多頁 PDF；new_page() 拿到整頁的 PdfCanvas"""
+
+    def __init__(self, title: str = ""):
+        self.title = title
+        self._pages = []
+
+    def new_page(self) -> PdfCanvas:
+        ops = []
+        self._pages.append(ops)
+        return PdfCanvas(ops)
+
+    def to_bytes(self) -> bytes:
+        objects = []
+
+        def add(body) -> int:
+            objects.append(body)
+            return len(objects)
+
+        catalog = add(None)
+        pages = add(None)
+        font = add(None)
+        cid_font = add(None)
+        descriptor = add(_FONT_OBJECTS[2])
+        objects[font - 1] = _FONT_OBJECTS[0].format(cid=cid_font)
+        objects[cid_font - 1] = _FONT_OBJECTS[1].format(desc=descriptor)
+        info = add(f"<< /Title <FEFF{_encode_text(self.title)}> /Producer (daily_report) >>")
+
+        page_ids = []
+        for ops in self._pages or [[]]:
+            data = zlib.compress("\n".join(ops).encode("ascii"))
+            content = add(f"<< /Length {len(data)} /Filter /FlateDecode >>".encode("ascii")
+                          + b"\nstream\n" + data + b"\nendstream")
+            page_ids.append(add(
+                f"<< /Type /Page /Parent {pages} 0 R /MediaBox [0 0 {PAGE_W} {PAGE_H}] "
+                f"/Resources << /Font << /F1 {font} 0 R >> >> /Contents {content} 0 R >>"
+            ))
+        objects[catalog - 1] = f"<< /Type /Catalog /Pages {pages} 0 R >>"
+        objects[pages - 1] = (f"<< /Type /Pages /Kids [{' '.join(f'{p} 0 R' for p in page_ids)}] "
+                              f"/Count {len(page_ids)} >>")
+
+        out = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        offsets = []
+        for i, body in enumerate(objects, start=1):
+            offsets.append(len(out))
+            if isinstance(body, str):
+                body = body.encode("ascii")
+            out += f"{i} 0 obj\n".encode("ascii") + body + b"\nendobj\n"
+        xref = len(out)
+        out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("ascii")
+        for off in offsets:
+            out += f"{off:010d} 00000 n \n".encode("ascii")
+        out += (f"trailer\n<< /Size {len(objects) + 1} /Root {catalog} 0 R /Info {info} 0 R >>\n"
+                f"startxref\n{xref}\n%%EOF\n").encode("ascii")
+        return bytes(out)
+
+
+# ---------- 版面（由上往下排，放不下就換頁） ----------
+
+def _wrap(text: str, size: float, width: float):
+    """依寬度斷行（中文逐字、英數字不拆開）"""
+    lines = []
+    for paragraph in str(text).splitlines() or [""]:
+        line, line_w = "", 0.0
+        for token in re.findall(r"[A-Za-z0-9.,:;%/()\-+]+|\s|.", paragraph):
+            w = text_width(token, size)
+            if line and line_w + w > width:
+                lines.append(line.rstrip())
+                line, line_w = token.lstrip(), text_width(token.lstrip(), size)
+            else:
+                line, line_w = line + token, line_w + w
+        lines.append(line.rstrip())
+    return lines
+
+
+class _Flow:
+    def __init__(self, doc: PdfDocument, footer: str):
+        self.doc = doc
+        self.footer = footer
+        self.page = None
+        self.y = 0.0
+
+    def _new_page(self):
+        self.page = self.doc.new_page()
+        self.y = MARGIN
+        if self.footer:
+            self.page.text(MARGIN, PAGE_H - MARGIN / 2, self.footer, MUTED_COLOR, size=8)
+
+    def ensure(self, height: float):
+        if self.page is None or self.y + height > PAGE_H - MARGIN:
+            self._new_page()
+
+    def gap(self, height: float):
+        self.y += height
+
+    def paragraph(self, text, size=10.5, color=TEXT_COLOR, indent=0.0, leading=1.5):
+        for line in _wrap(text, size, CONTENT_W - indent):
+            self.ensure(size * leading)
+            self.page.text(MARGIN + indent, self.y + size, line, color, size=size)
+            self.y += size * leading
+
+    def pill(self, text, size=11):
+        self.ensure(size * 2.2)
+        w = text_width(text, size) + size * 1.6
+        self.page.rect(MARGIN, self.y, w, size * 1.8, ACCENT_COLOR)
+        self.page.text(MARGIN + size * 0.8, self.y + size * 1.3, text, "#fff", size=size)
+        self.y += size * 2.2
+
+    def chart(self, spec, comment=None):
+        """標題 + 評語 + 圖；整塊放不下就換頁"""
+        height = report_charts.HEIGHT
+        title = spec.get("title", "")
+        comment_lines = len(_wrap(comment, 10, CONTENT_W)) if comment else 0
+        self.ensure(11 * 2.2 + comment_lines * 15 + height * CHART_SCALE + 14)
+        self.pill(title)
+        if comment:
+            self.paragraph(comment, size=10)
+        region = self.page.region(MARGIN, self.y, CHART_SCALE)
+        report_charts.draw_chart(region, CHART_W, height, **spec)
+        self.y += height * CHART_SCALE + 14
+
+
+def _header(flow: _Flow, heading: str, resident: dict):
+    flow.ensure(70)
+    page = flow.page
+    page.text(MARGIN, flow.y + 18, heading, TEXT_COLOR, size=18)
+    info = [f"ID：{resident.get('resident_id', '')}", f"序號：{resident.get('serial_id', '')}",
+            f"床號：{resident.get('bed_number', '')}"]
+    if resident.get("agency_name"):
+        info.append(f"機構：{resident['agency_name']}")
+    page.text(PAGE_W - MARGIN, flow.y + 16, "　".join(info), MUTED_COLOR, size=9, anchor="end")
+    flow.y += 34
+    page.text(MARGIN, flow.y + 16, resident.get("resident_name", ""), TEXT_COLOR, size=16)
+    flow.y += 28
+
+
+def _levels(flow: _Flow, items):
+    """[(名稱, 等級 1~3[, 說明]), ...] → 一排圓形等級標記；沒給說明就用等級文字"""
+    flow.ensure(48)
+    x = MARGIN
+    for name, level, *caption in items:
+        color, word = LEVEL_STYLES.get(level, ("#bdbdbd", "－"))
+        word = caption[0] if caption else word
+        flow.page.circle(x + 14, flow.y + 16, 14, color)
+        flow.page.text(x + 14, flow.y + 20, level if level in LEVEL_STYLES else "－", "#fff",
+                       size=12, anchor="middle")
+        flow.page.text(x + 36, flow.y + 13, name, TEXT_COLOR, size=10.5)
+        flow.page.text(x + 36, flow.y + 27, word, MUTED_COLOR, size=9)
+        x += CONTENT_W / 3
+    flow.y += 44
+
+
+def _int_or_none(v):
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return None
+
+
+# ---------- 月報 ----------
+
+# report_type → (標題, 日常分數名稱, 摘要欄位, 摘要預設, 評語預設, [各圖評語欄位])
+_MONTH_LAYOUT = {
+    "active": ("離床月報", "作息狀況", "active_summary", "本月尚無摘要內容。", "尚未提供評語。",
+               ["active_resp", "active_sleep_range", "active_asleep_start", "active_night_leave"]),
+    "bed": ("臥床月報", "臥床照顧", "bed_summary", "", "",
+            ["bed_resp", "bed_night_bed", "bed_leave_total", "bed_turn"]),
+}
+
+
+def month_report_pdf(ctx: dict, resident: dict, month_comments: dict) -> bytes:
+    """月報 PDF：內容同 month_active.html / month_bed.html"""
+    report_type = "bed" if ctx.get("report_type") == "bed" else "active"
+    heading, daily_name, summary_key, summary_default, comment_default, comment_keys = _MONTH_LAYOUT[report_type]
+    month_comments = month_comments or {}
+    year, month = ctx["report_year"], ctx["report_month"]
+
+    title = f"{year}年{month:02d}月　{heading}"
+    doc = PdfDocument(f"{title} - {resident.get('resident_name', '')}")
+    flow = _Flow(doc, f"統計區間：{ctx.get('start_date', '')} 至 {ctx.get('end_date', '')}　"
+                      f"（本頁圖表僅供照護參考，若有不適請儘速就醫）")
+    _header(flow, title, resident)
+    _levels(flow, [
+        ("呼吸狀況", _int_or_none(ctx.get("rr_score"))),
+        (daily_name, _int_or_none(ctx.get("daily_score"))),
+        ("休息品質", _int_or_none(ctx.get("sleep_score"))),
+    ])
+
+    flow.paragraph("本月摘要：", size=12)
+    flow.paragraph(month_comments.get(summary_key) or summary_default or "　", indent=8)
+    flow.gap(8)
+
+    specs = report_charts.month_chart_specs(ctx)
+    for name, key in zip(sorted(specs), comment_keys):
+        flow.chart(specs[name], month_comments.get(key) or comment_default)
+    return doc.to_bytes()
+
+
+# ---------- 半年報 ----------
+
+def half_trend(month_comments: dict, report_type: str):
+    """半年趨勢（同 halfreport_report.html）：回傳 (等級 1~3, 標籤, 趨勢原文)"""
+    text = (month_comments or {}).get("bed_trend" if report_type == "bed" else "active_trend", "") or ""
+    for word, level in (("變佳", 3), ("變差", 1), ("穩定", 2)):
+        if word in text:
+            return level, word, text
+    return 2, ("趨勢" if text else "無趨勢"), text
+
+
+def half_report_pdf(ctx: dict, resident: dict, month_comments: dict, half_summary: str) -> bytes:
+    """半年報 PDF：內容同 halfreport_report.html"""
+    report_type = "bed" if ctx.get("report_type") == "bed" else "active"
+    year, month = ctx["report_year"], ctx["report_month"]
+
+    title = f"半年追蹤（截至 {year}年{month:02d}月）"
+    doc = PdfDocument(f"{title} - {resident.get('resident_name', '')}")
+    flow = _Flow(doc, f"追蹤區間：以 {year}年{month:02d}月 為基準回溯約 6 個月　"
+                      f"（本頁圖表僅供照護參考，若有不適請儘速就醫）")
+    _header(flow, title, resident)
+
+    level, tag, text = half_trend(month_comments, report_type)
+    _levels(flow, [("半年趨勢", level, tag)])
+    if text and text.strip() != tag:
+        flow.paragraph(text, color=MUTED_COLOR)
+        flow.gap(4)
+
+    flow.paragraph("半年摘要：", size=12)
+    flow.paragraph(half_summary or "　", indent=8)
+    flow.gap(8)
+
+    specs = report_charts.half_chart_specs(ctx)
+    for name in sorted(specs):
+        flow.chart(specs[name])
+    return doc.to_bytes()
@@ -0,0 +1,391 @@
+"""
+月報評分引擎（純計算，不碰 BigQuery / Flask / session）
+
+輸入是「一個月每天一格」的欄位陣列（array('d')，缺值用 NaN），
+一次逐日掃描就算出：
+  - 有效天判斷
+  - 呼吸狀況評分（RR Score）
+  - 作息狀況（離床）/ 臥床照顧（臥床）評分（Daily Score）
+  - 作息品質評分（Sleep Score）
+  - 報表類型（bed / active）
+以及所有中間值，方便批次計算大量住民 / 月份。
+
+規則跟 daily_report.py 原本寫在 /report 裡的完全相同。
+"""
+import math
+from array import array
+
+NAN = float("nan")
+
+# 評分需要的每日欄位（長度都要等於該月天數）
+#   night_on_bed / night_sleep / sleep_respiration / day_on_bed / day_leave / asleep_leave：DAILY_TABLE 原值
+#   std_dev：respiration_analy.std_dev
+#   asleep_start_hour：convert_asleep_start_to_hour 的結果（20~32）
+#   night_turn / day_turn：日夜翻身平均間隔（分鐘，已過濾 > 720 的異常值）
+DAY_COLUMNS = (
+    "night_on_bed",
+    "night_sleep",
+    "sleep_respiration",
+    "day_on_bed",
+    "day_leave",
+    "asleep_leave",
+    "std_dev",
+    "asleep_start_hour",
+    "night_turn",
+    "day_turn",
+)
+
+
+def to_column(values):
+    """把 list（None 代表缺值）轉成 array('d')，缺值存成 NaN"""
+    return array("d", (NAN if v is None else float(v) for v in values))
+
+
+def empty_columns(n_days: int):
+    """建立 n_days 天、全部缺值的欄位 dict"""
+    return {name: array("d", [NAN]) * n_days for name in DAY_COLUMNS}
+
+
+def is_valid_day(night_on_bed, night_sleep, resp) -> bool:
+    """
+    有效天規則（None / NaN 視為沒有資料，不會讓這天變無效）：
+      1. night_on_bed / night_sleep / resp 任一為 0 → 無效
+      2. night_on_bed < 2 小時 → 無效
+    """
+    for v in (night_on_bed, night_sleep, resp):
+        if v is not None and v == 0:
+            return False
+    if night_on_bed is not None and night_on_bed < 2:
+        return False
+    return True
+
+
+def valid_day_mask(cols):
+    """回傳每一天是否為有效天的 list[bool]"""
+    return [
+        is_valid_day(nob, ns, rr)
+        for nob, ns, rr in zip(cols["night_on_bed"], cols["night_sleep"], cols["sleep_respiration"])
+    ]
+
+
+def decide_report_type(avg_onbed_total, avg_night_leave, force_mode=None) -> str:
+    """
+    報表類型：
+      - force_mode 為 'bed' / 'active' → 直接使用
+      - (night_on_bed + day_on_bed) 平均 >= 10 且 asleep_leave 平均 <= 1 → 'bed'
+      - 否則 → 'active'
+    """
+    if force_mode in ("bed", "active"):
+        return force_mode
+    if (
+        avg_onbed_total is not None
+        and avg_onbed_total >= 10
+        and avg_night_leave is not None
+        and avg_night_leave <= 1
+    ):
+        return "bed"
+    return "active"
+
+
+def score_rr(avg_rr, avg_std, slope):
+    """呼吸狀況評分，回傳 (score1, score2, score3, rr_score)"""
+    # 1. sleep_respiration 平均值：12–26 → 3；9–12 或 26–30 → 2；其餘 → 1
+    if avg_rr is None:
+        s1 = 2
+    elif 12 <= avg_rr <= 26:
+        s1 = 3
+    elif (9 <= avg_rr < 12) or (26 < avg_rr <= 30):
+        s1 = 2
+    else:
+        s1 = 1
+
+    # 2. std_dev 平均值：≤4 → 3；≤5 → 2；其餘 → 1
+    if avg_std is None:
+        s2 = 2
+    elif avg_std <= 4:
+        s2 = 3
+    elif avg_std <= 5:
+        s2 = 2
+    else:
+        s2 = 1
+
+    # 3. 趨勢斜率絕對值：≤0.05 → 3；≤0.1 → 2；其餘 → 1
+    slope_abs = abs(slope)
+    if slope_abs <= 0.05:
+        s3 = 3
+    elif slope_abs <= 0.1:
+        s3 = 2
+    else:
+        s3 = 1
+
+    return s1, s2, s3, min(s1, s2, s3)
+
+
+def score_active_daily(avg_start, diff_start, diff_end):
+    """離床：作息狀況評分（上床平均時間 / 上床時間差 / 起床時間差），回傳 (s1, s2, s3, score)"""
+    if avg_start is None:
+        s1 = 2
+    else:
+        h = avg_start % 24
+        if (20 <= h < 24) or (0 <= h < 1):
+            s1 = 3
+        elif (17 <= h < 20) or (1 <= h < 2):
+            s1 = 2
+        else:
+            s1 = 1
+
+    def diff_score(diff):
+        if diff is None:
+            return 2
+        if diff <= 3:
+            return 3
+        if diff <= 4:
+            return 2
+        return 1
+
+    s2 = diff_score(diff_start)
+    s3 = diff_score(diff_end)
+    return s1, s2, s3, min(s1, s2, s3)
+
+
+def score_bed_daily(avg_night_turn, avg_day_turn, avg_day_leave):
+    """臥床：臥床照顧評分（夜間翻身 / 日間翻身 / 日間離床），回傳 (s1, s2, s3, score)"""
+    if avg_night_turn is None:
+        s1 = 2
+    elif avg_night_turn < 370:
+        s1 = 3
+    elif avg_night_turn <= 430:
+        s1 = 2
+    else:
+        s1 = 1
+
+    if avg_day_turn is None:
+        s2 = 2
+    elif avg_day_turn < 190:
+        s2 = 3
+    elif avg_day_turn <= 250:
+        s2 = 2
+    else:
+        s2 = 1
+
+    if avg_day_leave is None:
+        s3 = 2
+    elif avg_day_leave > 4:
+        s3 = 3
+    elif avg_day_leave >= 2:
+        s3 = 2
+    else:
+        s3 = 1
+
+    return s1, s2, s3, min(s1, s2, s3)
+
+
+def score_sleep(avg_night_sleep, avg_night_leave, avg_eff):
+    """作息品質評分（休息時間 / 夜離狀況 / 休息效率），回傳 (s1, s2, s3, score)"""
+    if avg_night_sleep is None:
+        s1 = 2
+    elif 6 <= avg_night_sleep <= 10:
+        s1 = 3
+    elif (4 <= avg_night_sleep < 6) or (10 < avg_night_sleep <= 12):
+        s1 = 2
+    else:
+        s1 = 1
+
+    if avg_night_leave is None:
+        s2 = 2
+    elif avg_night_leave <= 5:
+        s2 = 3
+    elif avg_night_leave <= 15:
+        s2 = 2
+    else:
+        s2 = 1
+
+    if avg_eff is None:
+        s3 = 2
+    elif avg_eff > 0.8:
+        s3 = 3
+    elif avg_eff >= 0.6:
+        s3 = 2
+    else:
+        s3 = 1
+
+    return s1, s2, s3, min(s1, s2, s3)
+
+
+class _Acc:
+    """平均值累計器（sum / count，跟原本 sum(list) / len(list) 的加總順序一樣）"""
+
+    __slots__ = ("total", "count")
+
+    def __init__(self):
+        self.total = 0.0
+        self.count = 0
+
+    def add(self, v):
+        self.total += v
+        self.count += 1
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+def score_month(cols, force_mode=None):
+    """
+    一次逐日掃描算出所有評分與中間值。
+    cols：{欄名: array('d')}，欄名見 DAY_COLUMNS，缺值為 NaN
+    回傳 dict（valid 為每天是否有效；其他為平均值、各項分數與 report_type）
+    """
+    isnan = math.isnan
+    n = len(cols["night_on_bed"])
+
+    valid = []
+    rr, std, night_sleep, night_leave, eff = _Acc(), _Acc(), _Acc(), _Acc(), _Acc()
+    day_leave, onbed_total, start, night_turn, day_turn = _Acc(), _Acc(), _Acc(), _Acc(), _Acc()
+    min_start = max_start = min_end = max_end = None
+    n_end = 0
+
+    # 呼吸趨勢斜率：x = 該月第幾天，y = sleep_respiration（線上更新平均與共變異）
+    n_xy = 0
+    mean_x = mean_y = 0.0
+    sxx = sxy = 0.0
+
+    for i in range(n):
+        nob = cols["night_on_bed"][i]
+        ns = cols["night_sleep"][i]
+        resp = cols["sleep_respiration"][i]
+        nob = None if isnan(nob) else nob
+        ns = None if isnan(ns) else ns
+        resp = None if isnan(resp) else resp
+
+        ok = is_valid_day(nob, ns, resp)
+        valid.append(ok)
+        if not ok:
+            continue
+
+        dob = cols["day_on_bed"][i]
+        dob = None if isnan(dob) else dob
+
+        if resp is not None:
+            rr.add(resp)
+            n_xy += 1
+            dx = i - mean_x
+            mean_x += dx / n_xy
+            mean_y += (resp - mean_y) / n_xy
+            sxx += dx * (i - mean_x)
+            sxy += dx * (resp - mean_y)
+
+        v = cols["std_dev"][i]
+        if not isnan(v):
+            std.add(v)
+
+        if ns is not None:
+            night_sleep.add(ns)
+            if nob is not None and nob > 0:
+                eff.add(ns / nob)
+
+        v = cols["asleep_start_hour"][i]
+        if not isnan(v):
+            start.add(v)
+            min_start = v if min_start is None else min(min_start, v)
+            max_start = v if max_start is None else max(max_start, v)
+            if ns is not None:
+                end = v + ns
+                n_end += 1
+                min_end = end if min_end is None else min(min_end, end)
+                max_end = end if max_end is None else max(max_end, end)
+
+        v = cols["night_turn"][i]
+        if not isnan(v):
+            night_turn.add(v)
+        v = cols["day_turn"][i]
+        if not isnan(v):
+            day_turn.add(v)
+
+        v = cols["asleep_leave"][i]
+        if not isnan(v):
+            night_leave.add(v)
+
+        v = cols["day_leave"][i]
+        if not isnan(v):
+            day_leave.add(v)
+
+        if nob is not None and dob is not None:
+            onbed_total.add(nob + dob)
+
+    # ===== 報表類型 =====
+    avg_day_leave = day_leave.mean()
+    avg_onbed_total = onbed_total.mean()
+    avg_night_leave = night_leave.mean()
+    auto_report_type = decide_report_type(avg_onbed_total, avg_night_leave)
+    report_type = decide_report_type(avg_onbed_total, avg_night_leave, force_mode)
+
+    # ===== RR Score =====
+    avg_rr = rr.mean()
+    avg_std = std.mean()
+    slope = (sxy / sxx) if n_xy >= 2 and sxx != 0 else 0.0
+    rr_s1, rr_s2, rr_s3, rr_score = score_rr(avg_rr, avg_std, slope)
+
+    # ===== Daily Score =====
+    avg_start = start.mean()
+    diff_start = (max_start - min_start) if start.count >= 2 else None
+    diff_end = (max_end - min_end) if n_end >= 2 else None
+    active_s1, active_s2, active_s3, active_daily_score = score_active_daily(
+        avg_start, diff_start, diff_end
+    )
+
+    avg_night_turn = night_turn.mean()
+    avg_day_turn = day_turn.mean()
+    bed_s1, bed_s2, bed_s3, bed_daily_score = score_bed_daily(
+        avg_night_turn, avg_day_turn, avg_day_leave
+    )
+
+    daily_score = bed_daily_score if report_type == "bed" else active_daily_score
+
+    # ===== Sleep Score =====
+    avg_night_sleep = night_sleep.mean()
+    avg_eff = eff.mean()
+    sleep_s1, sleep_s2, sleep_s3, sleep_score = score_sleep(
+        avg_night_sleep, avg_night_leave, avg_eff
+    )
+
+    return {
+        "valid": valid,
+        "avg_day_leave": avg_day_leave,
+        "avg_onbed_total": avg_onbed_total,
+        "avg_night_leave": avg_night_leave,
+        "auto_report_type": auto_report_type,
+        "report_type": report_type,
+        "avg_rr": avg_rr,
+        "avg_std": avg_std,
+        "slope": slope,
+        "rr_s1": rr_s1,
+        "rr_s2": rr_s2,
+        "rr_s3": rr_s3,
+        "rr_score": rr_score,
+        "avg_start": avg_start,
+        "avg_start_mod": (avg_start % 24) if avg_start is not None else None,
+        "diff_start": diff_start,
+        "diff_end": diff_end,
+        "active_s1": active_s1,
+        "active_s2": active_s2,
+        "active_s3": active_s3,
+        "active_daily_score": active_daily_score,
+        "avg_night_turn": avg_night_turn,
+        "avg_day_turn": avg_day_turn,
+        "bed_s1": bed_s1,
+        "bed_s2": bed_s2,
+        "bed_s3": bed_s3,
+        "bed_daily_score": bed_daily_score,
+        "daily_score": daily_score,
+        "avg_night_sleep": avg_night_sleep,
+        "avg_eff": avg_eff,
+        "sleep_s1": sleep_s1,
+        "sleep_s2": sleep_s2,
+        "sleep_s3": sleep_s3,
+        "sleep_score": sleep_score,
+    }
+
+
+def score_batch(columns_list, force_mode=None):
+    """批次評分：columns_list 每一個元素是一個住民月份的欄位 dict"""
+    return [score_month(cols, force_mode) for cols in columns_list]
@@ -0,0 +1,358 @@
+"""
+跨 worker 共用的快取
+
+gunicorn 開多個 worker 時，process 內的快取每個 worker 都要各自暖一次、重開就不見。
+這裡把快取抽成同一個介面，依 SHARED_CACHE_URL 選擇存放位置：
+  - memory://                      ：process 內（LRU + TTL，單機單 worker / 開發用）
+  - sqlite:///path/to/cache.sqlite3：本機檔案，同一台機器的所有 worker 共用（LRU + TTL + 總大小上限）
+  - redis://host:6379/0            ：Redis（或相容的 Valkey / KeyDB），多台機器也能共用；需要 redis 套件
+  - none://                        ：不快取（量測用）
+
+key 一律是字串；值用 pickle 存（只放本程式自己算出來的資料，不要拿來存外部輸入）。
+快取壞掉（檔案鎖住、Redis 連不上）只記警告並當作沒命中，不影響頁面。
+"""
+import logging
+import os
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+logger = logging.getLogger("daily_report.shared_cache")
+
+_MISSING = object()
+
+
+def _dumps(value) -> bytes:
+    return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class CacheBackend:
+    """快取介面；ttl 單位是秒，None 用 default_ttl"""
+
+    name = ""
+
+    def __init__(self, default_ttl: float = 300):
+        self.default_ttl = default_ttl
+
+    def get(self, key: str, default=None):
+        raise NotImplementedError
+
+    def set(self, key: str, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def clear(self, prefix: str = ""):
+        """刪掉 key 以 prefix 開頭的項目（空字串 = 全部）"""
+        raise NotImplementedError
+
+    def get_or_set(self, key: str, compute, ttl=None):
+        """有快取就回傳；沒有就呼叫 compute()，結果存進快取（None 不存）"""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            if value is not None:
+                self.set(key, value, ttl)
+        return value
+
+
+class NullCache(CacheBackend):
+    """什麼都不存"""
+
+    name = "none"
+
+    def get(self, key: str, default=None):
+        return default
+
+    def set(self, key: str, value, ttl=None):
+        pass
+
+    def delete(self, key: str):
+        pass
+
+    def clear(self, prefix: str = ""):
+        pass
+
+
+class MemoryCache(CacheBackend):
+    """
+    process 內快取：
+      - 每個值存活 ttl 秒，過期就當作沒有
+      - 最多 maxsize 筆；有給 max_bytes 時另外限制總大小（以 pickle 後的長度估算）
+        超過時丟掉最久沒用到的（LRU）；估算大小每次 set 都要 pickle 一次，
+        所以 create_cache 預設不給 max_bytes，只用筆數限制
+      - 值原樣保存（不複製），拿到的物件不要修改
+      - 用 lock 保護，gunicorn 的多 thread worker 也可以共用
+    """
+
+    name = "memory"
+
+    def __init__(self, maxsize: int = 128, default_ttl: float = 300, max_bytes: int = 0):
+        super().__init__(default_ttl)
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # key -> (expire_at, value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _sizeof(self, value) -> int:
+        if not self.max_bytes:
+            return 0
+        try:
+            return len(_dumps(value))
+        except Exception:
+            return sys.getsizeof(value)
+
+    def _remove(self, key):
+        _, _, size = self._data.pop(key)
+        self._bytes -= size
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                return default
+            if item[0] <= time.monotonic():
+                self._remove(key)
+                return default
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        size = self._sizeof(value)
+        if self.max_bytes and size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (time.monotonic() + ttl, value, size)
+            self._bytes += size
+            while len(self._data) > self.maxsize or (self.max_bytes and self._bytes > self.max_bytes):
+                self._remove(next(iter(self._data)))
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def clear(self, prefix: str = ""):
+        with self._lock:
+            if not prefix:
+                self._data.clear()
+                self._bytes = 0
+                return
+            for key in [k for k in self._data if isinstance(k, str) and k.startswith(prefix)]:
+                self._remove(key)
+
+
+class SQLiteCache(CacheBackend):
+    """
+    本機 SQLite 檔案，同一台機器的 worker 共用：
+      - expires_at 過期就當作沒有
+      - 筆數超過 max_entries 或總大小超過 max_bytes 時，依 accessed_at 丟掉最久沒用到的
+      - accessed_at 最多每 ACCESS_UPDATE_SEC 秒更新一次，避免每次讀取都要寫檔
+    """
+
+    name = "sqlite"
+    ACCESS_UPDATE_SEC = 60
+
+    def __init__(self, path: str, max_entries: int = 10000, max_bytes: int = 256 * 1024 * 1024,
+                 default_ttl: float = 300):
+        super().__init__(default_ttl)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS cache (
+                  key         TEXT PRIMARY KEY,
+                  value       BLOB NOT NULL,
+                  size        INTEGER NOT NULL,
+                  expires_at  REAL NOT NULL,
+                  accessed_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+
+    def _conn(self):
+        # sqlite3 連線不能跨 thread 共用，每個 thread 開一條
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key, default=None):
+        now = time.time()
+        try:
+            conn = self._conn()
+            row = conn.execute(
+                "SELECT value, expires_at, accessed_at FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return default
+            value, expires_at, accessed_at = row
+            if expires_at <= now:
+                with conn:
+                    conn.execute("DELETE FROM cache WHERE key = ? AND expires_at <= ?", (key, now))
+                return default
+            if now - accessed_at > self.ACCESS_UPDATE_SEC:
+                with conn:
+                    conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+            return pickle.loads(value)
+        except (sqlite3.Error, OSError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+            logger.warning("shared cache 讀取失敗 key=%s：%r", key, e)
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        now = time.time()
+        try:
+            data = _dumps(value)
+            if len(data) > self.max_bytes:
+                return
+            conn = self._conn()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache (key, value, size, expires_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, data, len(data), now + ttl, now),
+                )
+                self._evict(conn, now)
+        except (sqlite3.Error, OSError, pickle.PicklingError, TypeError) as e:
+            logger.warning("shared cache 寫入失敗 key=%s：%r", key, e)
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+        count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+        while count > self.max_entries or total > self.max_bytes:
+            # 一次丟掉最舊的一成（至少超出的筆數），再重新計算
+            n = max(count - self.max_entries, count // 10, 1)
+            conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at LIMIT ?)", (n,)
+            )
+            count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+
+    def delete(self, key):
+        try:
+            conn = self._conn()
+            with conn:
+                conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            logger.warning("shared cache 刪除失敗 key=%s：%r", key, e)
+
+    def clear(self, prefix: str = ""):
+        try:
+            conn = self._conn()
+            with conn:
+                if prefix:
+                    conn.execute("DELETE FROM cache WHERE key >= ? AND key < ?", (prefix, prefix + "\U0010ffff"))
+                else:
+                    conn.execute("DELETE FROM cache")
+        except sqlite3.Error as e:
+            logger.warning("shared cache 清除失敗 prefix=%s：%r", prefix, e)
+
+
+class RedisCache(CacheBackend):
+    """
+    Redis（或相容服務）：
+      - 每個 key 用 SET ... EX 設定存活時間
+      - 單一值超過 max_item_bytes 不存
+      - 總大小與 LRU 交給 Redis：請設定 maxmemory 與 maxmemory-policy allkeys-lru
+    所有 key 都加上 key_prefix，clear() 只會動到自己的 key
+    """
+
+    name = "redis"
+
+    def __init__(self, url: str, key_prefix: str = "daily_report:", default_ttl: float = 300,
+                 max_item_bytes: int = 32 * 1024 * 1024):
+        super().__init__(default_ttl)
+        import redis  # 選用套件：只有用 Redis 時才需要安裝
+
+        self._redis_error = redis.RedisError
+        self._client = redis.Redis.from_url(url)
+        self.key_prefix = key_prefix
+        self.max_item_bytes = max_item_bytes
+
+    def get(self, key, default=None):
+        try:
+            data = self._client.get(self.key_prefix + key)
+            return default if data is None else pickle.loads(data)
+        except (self._redis_error, OSError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+            logger.warning("shared cache 讀取失敗 key=%s：%r", key, e)
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        try:
+            data = _dumps(value)
+            if len(data) > self.max_item_bytes:
+                return
+            self._client.set(self.key_prefix + key, data, ex=max(1, int(ttl)))
+        except (self._redis_error, OSError, pickle.PicklingError, TypeError) as e:
+            logger.warning("shared cache 寫入失敗 key=%s：%r", key, e)
+
+    def delete(self, key):
+        try:
+            self._client.delete(self.key_prefix + key)
+        except self._redis_error as e:
+            logger.warning("shared cache 刪除失敗 key=%s：%r", key, e)
+
+    def clear(self, prefix: str = ""):
+        pattern = _redis_glob_escape(self.key_prefix + prefix) + "*"
+        try:
+            batch = []
+            for k in self._client.scan_iter(match=pattern, count=1000):
+                batch.append(k)
+                if len(batch) >= 1000:
+                    self._client.delete(*batch)
+                    batch = []
+            if batch:
+                self._client.delete(*batch)
+        except self._redis_error as e:
+            logger.warning("shared cache 清除失敗 prefix=%s：%r", prefix, e)
+
+
+def _redis_glob_escape(text: str) -> str:
+    return "".join("\\" + c if c in "*?[]\\" else c for c in text)
+
+
+# SQLite / Redis 本來就要序列化，大小限制不用多花成本；預設總大小（Redis 為單筆）上限
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+def create_cache(url: str, max_entries: int = 10000, max_bytes=None,
+                 default_ttl: float = 300) -> CacheBackend:
+    """
+    依 URL 建立快取（見模組說明）；
+    max_bytes 為 None 時：memory:// 不限制大小（只限筆數，set 不用 pickle），其他用 DEFAULT_MAX_BYTES
+    """
+    scheme = urlparse(url).scheme or url.rstrip(":/")
+    if scheme == "memory":
+        return MemoryCache(maxsize=max_entries, default_ttl=default_ttl, max_bytes=max_bytes or 0)
+    if max_bytes is None:
+        max_bytes = DEFAULT_MAX_BYTES
+    if scheme == "sqlite":
+        # sqlite:///relative.sqlite3 → 相對路徑；sqlite:////abs/path.sqlite3 → 絕對路徑
+        path = url[len("sqlite:///"):]
+        if not path:
+            raise ValueError(f"SHARED_CACHE_URL 缺少檔案路徑：{url}")
+        return SQLiteCache(path, max_entries=max_entries, max_bytes=max_bytes, default_ttl=default_ttl)
+    if scheme in ("redis", "rediss", "unix"):
+        return RedisCache(url, default_ttl=default_ttl, max_item_bytes=max_bytes)
+    if scheme == "none":
+        return NullCache(default_ttl)
+    raise ValueError(f"未知的 SHARED_CACHE_URL：{url}")